@@ -15,7 +15,30 @@
 # You should have received a copy of the GNU General Public License along with
 # Gauntlet.  If not, see <http://www.gnu.org/licenses/>.
 
+import os
+
+# gevent has to patch the standard library before anything else imports it,
+# or locks and threads created at import time stay real and can block the
+# whole event loop. `gauntlet-server --async` sets this and starts over.
+if os.environ.get("GAUNTLET_GEVENT"):
+    from gevent import monkey
+    monkey.patch_all()
+
 import config
 import chroot
 import server
 import shard
+import layers
+import resolver
+import snapshot
+import objects
+import gitindex
+import uploads
+import packs
+import headers
+import collector
+import cache
+import cluster
+import mirrors
+import metrics
+import fsutil
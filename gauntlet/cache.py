@@ -0,0 +1,327 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014 Casey Dahlin
+#
+# This file is part of Gauntlet.
+#
+# Gauntlet is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# Gauntlet is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# Gauntlet.  If not, see <http://www.gnu.org/licenses/>.
+
+import atexit
+import errno
+import hashlib
+import os
+import threading
+import time
+import uuid
+from fsutil import link_file, locked_state
+
+__all__ = ["ObjectCache", "CacheError"]
+
+class CacheError(Exception):
+    """
+    An exception indicating an object offered to the cache doesn't match its
+    SHA-1.
+    """
+    pass
+
+def default_root():
+    """
+    Where the cache lives unless we're told otherwise.
+    """
+    base = os.environ.get("XDG_CACHE_HOME",
+            os.path.join(os.path.expanduser("~"), ".cache"))
+    return os.path.join(base, "gauntlet", "objects")
+
+class _CachingReader(object):
+    """
+    File-like object passing a stream through while copying it into the
+    cache. The copy is added once the stream has been read to the end and
+    matches its SHA-1, and thrown away otherwise.
+    """
+
+    def __init__(self, cache, sha, src):
+        self.cache = cache
+        self.sha = sha
+        self.src = src
+        self.digest = hashlib.sha1()
+        self.tmp = cache.tmp_path()
+        self.out = open(self.tmp, 'wb')
+
+    def read(self, size=-1):
+        buf = self.src.read(size)
+
+        if self.out is None:
+            return buf
+
+        self.digest.update(buf)
+        self.out.write(buf)
+
+        if len(buf) == 0 or size < 0:
+            self.out.close()
+            self.out = None
+
+            if self.digest.hexdigest() == self.sha:
+                self.cache.add_file(self.sha, self.tmp)
+            else:
+                os.unlink(self.tmp)
+
+        return buf
+
+    def close(self):
+        if self.out is not None:
+            self.out.close()
+            self.out = None
+            os.unlink(self.tmp)
+
+        self.src.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+class ObjectCache(object):
+    """
+    A local cache of objects downloaded from gauntlet servers, keyed by
+    SHA-1, so a machine never downloads the same object twice while it has
+    room to keep it. Objects are checked against their SHA-1 on the way in.
+
+    Like a LayerStore, the cache may be shared by several build processes.
+    Bookkeeping lives in a state file guarded by a lock file, and objects are
+    evicted least recently used first once the cache grows past its budget.
+    Cached objects are kept read-only, and placed elsewhere by reflink or
+    copy. Uses are recorded in memory and written to the state file at most
+    every `TOUCH_INTERVAL` seconds, when the state is next saved anyway, or
+    at exit, so cache hits don't each rewrite it.
+    """
+
+    TOUCH_INTERVAL = 60
+
+    def __init__(self, root=None, budget=None):
+        """
+        Create or open a cache at `root`, by default under ~/.cache. `budget`
+        is the size in bytes the cache may grow to. None means no limit.
+        """
+        self.root = root or default_root()
+        self.budget = budget
+        self.tmp_dir = os.path.join(self.root, "tmp")
+        self.state_path = os.path.join(self.root, "state.json")
+        self.touched = {}
+        self.touched_lock = threading.Lock()
+        self.flushed = time.time()
+
+        atexit.register(self.flush)
+
+        try:
+            os.makedirs(self.tmp_dir)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    def _locked(self):
+        """
+        Hold the cache lock and yield the cache state. Changes made to the
+        state are saved when the block exits.
+        """
+        return locked_state(os.path.join(self.root, "lock"), self.state_path)
+
+    def path(self, sha):
+        """
+        Where the object with the given SHA-1 lives in the cache.
+        """
+        return os.path.join(self.root, sha[0:2], sha[2:])
+
+    def tmp_path(self):
+        """
+        A fresh temporary path on the same filesystem as the cache.
+        """
+        return os.path.join(self.tmp_dir, str(uuid.uuid4()))
+
+    def __contains__(self, sha):
+        return os.path.exists(self.path(sha))
+
+    def _touch(self, sha):
+        """
+        Mark an object as just used.
+        """
+        now = time.time()
+
+        with self.touched_lock:
+            self.touched[sha] = now
+            due = now - self.flushed >= self.TOUCH_INTERVAL
+
+        if due:
+            self.flush()
+
+    def _apply_touches(self, state):
+        """
+        Record the uses we have been holding on to in `state`. Must be called
+        with the lock held.
+        """
+        with self.touched_lock:
+            touched = self.touched
+            self.touched = {}
+            self.flushed = time.time()
+
+        for sha, atime in touched.iteritems():
+            if sha in state:
+                state[sha]['atime'] = max(state[sha]['atime'], atime)
+
+    def flush(self):
+        """
+        Write out the uses we have been holding on to.
+        """
+        if len(self.touched) == 0:
+            return
+
+        with self._locked() as state:
+            self._apply_touches(state)
+
+    def open(self, sha):
+        """
+        Open a cached object for reading, or return None if we don't have it.
+        """
+        try:
+            f = open(self.path(sha), 'rb')
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            return None
+
+        self._touch(sha)
+        return f
+
+    def tee(self, sha, src):
+        """
+        Wrap a stream of the object with the given SHA-1 so that reading it
+        to the end adds it to the cache.
+        """
+        return _CachingReader(self, sha, src)
+
+    def add_file(self, sha, tmp):
+        """
+        Move the file at `tmp`, which must be on the cache's filesystem and
+        have the given SHA-1, into the cache.
+        """
+        path = self.path(sha)
+
+        try:
+            os.makedirs(os.path.dirname(path))
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+
+        os.chmod(tmp, 0444)
+
+        with self._locked() as state:
+            if os.path.exists(path):
+                os.unlink(tmp)
+                return
+
+            os.rename(tmp, path)
+            state[sha] = { 'size': os.path.getsize(path),
+                    'atime': time.time() }
+            self._apply_touches(state)
+            self._evict(state)
+
+    def add_path(self, sha, path):
+        """
+        Add a copy of the file at `path`, already known to have the given
+        SHA-1, to the cache. The copy is a reflink where possible.
+        """
+        if sha in self:
+            return
+
+        tmp = self.tmp_path()
+        link_file(path, tmp, "clone")
+        self.add_file(sha, tmp)
+
+    def add(self, sha, stream):
+        """
+        Add the content of a file-like object to the cache, checking it has
+        the given SHA-1. Raises CacheError if it doesn't.
+        """
+        tmp = self.tmp_path()
+        digest = hashlib.sha1()
+
+        with open(tmp, 'wb') as f:
+            buf = 'a'
+            while len(buf) > 0:
+                buf = stream.read(1 << 20)
+                digest.update(buf)
+                f.write(buf)
+
+        if digest.hexdigest() != sha:
+            os.unlink(tmp)
+            raise CacheError("Object does not match " + sha)
+
+        self.add_file(sha, tmp)
+
+    def _evict(self, state):
+        """
+        Remove objects, least recently used first, until we are within
+        budget. Must be called with the lock held.
+        """
+        if self.budget is None:
+            return
+
+        total = sum(x['size'] for x in state.values())
+        order = sorted(state, key=lambda x: state[x]['atime'])
+
+        while total > self.budget and len(order) > 0:
+            sha = order.pop(0)
+            total -= state[sha]['size']
+            del state[sha]
+
+            try:
+                os.unlink(self.path(sha))
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+
+    def evict(self):
+        """
+        Bring the cache within its size budget.
+        """
+        with self._locked() as state:
+            self._apply_touches(state)
+            self._evict(state)
+
+    def materialize(self, sha, dest):
+        """
+        Place a writable copy of a cached object at `dest`, reflinked where
+        the filesystem supports it. It never shares an inode with the cache,
+        so the consumer may change it freely. Returns False if we don't have
+        the object.
+        """
+        src = self.path(sha)
+
+        if not os.path.exists(src):
+            return False
+
+        tmp = dest + ".gauntlet-tmp"
+
+        try:
+            link_file(src, tmp, "clone")
+            os.chmod(tmp, 0644)
+        except (OSError, IOError), e:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+            if e.errno != errno.ENOENT:
+                raise
+            # Evicted while we were working.
+            return False
+
+        os.rename(tmp, dest)
+        self._touch(sha)
+        return True
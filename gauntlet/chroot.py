@@ -17,7 +17,12 @@
 
 import os
 import shutil
+import subprocess
 import uuid
+from multiprocessing.pool import ThreadPool
+from resolver import Resolver
+from server import ServerError
+from snapshot import Snapshot
 
 class Chroot(object):
     """
@@ -25,43 +30,142 @@ class Chroot(object):
     tasks within it.
     """
 
-    def __init__(self, server, path = None):
+    def __init__(self, server, path = None, layers = None, jobs = 8):
         """
         In order to create a chroot, we need a server to resolve magic gauntlet
-        files from.
+        files from. If `layers` is a LayerStore, the shards we compose and
+        everything they depend on are linked in from it rather than extracted
+        each time. Up to `jobs` files are downloaded at once.
         """
         self.server = server
+        self.layers = layers
+        self.jobs = jobs
+        self.mounted = []
+        self.snapshot = None
 
         if path == None:
             path = os.path.join("/tmp", str(uuid.uuid4()))
 
         self.path = path
 
+    def add_layer(self, sha, method = "clone"):
+        """
+        Place the contents of the shard with the given SHA-1 into the chroot,
+        over whatever is already there.
+        """
+        self.layers.acquire(sha, self.server)
+
+        try:
+            self.layers.materialize(sha, self.path, method)
+        finally:
+            self.layers.release(sha)
+
+    def mount_layers(self, shas):
+        """
+        Mount the given shards, top-most first, as an overlay filesystem at
+        the chroot path. Anything written in the chroot lands in a separate
+        upper directory, which is returned. Requires root.
+        """
+        upper = self.path + ".upper"
+        work = self.path + ".work"
+
+        for path in [self.path, upper, work]:
+            if not os.path.isdir(path):
+                os.makedirs(path)
+
+        for sha in shas:
+            self.layers.acquire(sha, self.server)
+            self.mounted.append(sha)
+
+        self.layers.mount_overlay(shas, self.path, upper, work)
+        return upper
+
+    def unmount_layers(self):
+        """
+        Undo `mount_layers`.
+        """
+        if len(self.mounted) == 0:
+            return
+
+        subprocess.call(["umount", self.path])
+
+        for sha in self.mounted:
+            self.layers.release(sha)
+
+        self.mounted = []
+
+    def fetch_files(self, files):
+        """
+        Download the objects in `files`, a dict of target paths to SHA-1s, on
+        `jobs` threads. Each download is checked against its SHA-1, and the
+        largest are started first so they don't hold up the end.
+        """
+        sizes = self.server.have(set(files.values()))
+        paths = sorted(files, key=lambda x: sizes.get(files[x], 0),
+                reverse=True)
+
+        pool = ThreadPool(self.jobs)
+
+        try:
+            pool.map(lambda x: self.server.fetch(files[x], x), paths, 1)
+        finally:
+            pool.close()
+            pool.join()
+
+    def send_hints(self, config):
+        """
+        Relay the config's git hints to the server so it can refresh its
+        mirrors before we ask it about their commits.
+        """
+        if len(config['git-hint']) == 0:
+            return
+
+        try:
+            self.server.git_hint(config['git-hint'])
+        except ServerError:
+            # Only a hint; we carry on with what the server already knows.
+            pass
+
     def execute(self, config):
         """
         Run the build task for the given config in the chroot.
         """
-        build_path = os.path.join(self.path, self.config['build-path'])
+        build_path = os.path.join(self.path, config['build-path'])
+
+        self.send_hints(config)
 
         try:
             shutil.rmtree(self.path)
         except OSError:
             pass
 
+        known = {}
+
+        if self.layers is not None:
+            roots = [x['hash'] for x in
+                    config['compose'] + config['compose-buildonly']]
+            resolver = Resolver(self.server, self.layers, self.jobs)
+            plan = resolver.resolve(roots)
+            # Builds write to their root, so nothing in it may be a hard link
+            # into the layer store.
+            resolver.apply(plan, self.path, "clone")
+            known = plan.hashes()
+
         shutil.copytree(".", build_path)
 
-        for (path, sha) in config['file']:
+        files = {}
+
+        for (path, sha) in config['files'].iteritems():
             if os.path.isabs(path):
                 path = os.path.join(self.path, path[1:])
             else:
                 path = os.path.join(build_path, path)
 
-            with open(path, 'w') as location:
-                with self.server.get(sha) as data:
-                    chunk = 'a'
-                    while len(chunk) > 0:
-                        chunk = data.read(4096)
-                        location.write(chunk)
+            known[os.path.relpath(path, self.path)] = sha
+            files[path] = sha
+
+        self.fetch_files(files)
+        self.snapshot = Snapshot.take(self.path, known)
 
         pid = os.fork()
 
@@ -71,3 +175,13 @@ class Chroot(object):
             os.execl(config['task'], config['task'])
         else:
             os.waitpid(pid, 0)
+
+    def collect(self, config):
+        """
+        Get a Shard of everything the last `execute` added, changed or removed
+        in the chroot.
+        """
+        diff = self.snapshot.diff()
+        return diff.shard(config['name'],
+                [x['hash'] for x in config['compose']],
+                [x['hash'] for x in config['compose-buildonly']])
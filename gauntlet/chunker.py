@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014 Casey Dahlin
+#
+# This file is part of Gauntlet.
+#
+# Gauntlet is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# Gauntlet is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# Gauntlet.  If not, see <http://www.gnu.org/licenses/>.
+
+import hashlib
+import struct
+
+__all__ = ["chunks", "MIN_SIZE", "AVG_SIZE", "MAX_SIZE"]
+
+MIN_SIZE = 16 * 1024
+AVG_SIZE = 64 * 1024
+MAX_SIZE = 256 * 1024
+
+# One random 32-bit value per byte value for the gear hash. Derived rather
+# than random so every client and server cuts the same data the same way.
+_GEAR = [struct.unpack(">I", hashlib.sha1("gauntlet" + chr(x)).digest()[:4])[0]
+        for x in range(256)]
+
+def _cut(data, start, end, min_size, max_size, mask):
+    """
+    Find where the chunk starting at `start` in `data` ends, looking no
+    further than `end`.
+    """
+    limit = min(end, start + max_size)
+    pos = start + min_size
+
+    if pos >= limit:
+        return limit
+
+    gear = _GEAR
+    h = 0
+
+    # The gear hash shifts older bytes out of the top, so only the last 32
+    # bytes matter and the mask looks at the high bits.
+    for b in data[pos:limit]:
+        h = ((h << 1) + gear[b]) & 0xFFFFFFFF
+        pos += 1
+
+        if not h & mask:
+            return pos
+
+    return limit
+
+def chunks(stream, min_size=MIN_SIZE, avg_size=AVG_SIZE, max_size=MAX_SIZE):
+    """
+    Split the content of a file-like object into content-defined chunks using
+    a rolling gear hash, and generate them in order. The same content yields
+    the same chunk boundaries wherever it sits in a stream, so objects that
+    differ in a few places share most of their chunks. `avg_size` should be a
+    power of two.
+    """
+    bits = avg_size.bit_length() - 1
+    mask = ((1 << bits) - 1) << (32 - bits)
+
+    data = bytearray()
+    eof = False
+
+    while not eof:
+        buf = stream.read(max_size * 4)
+        eof = len(buf) == 0
+        data += buf
+        start = 0
+
+        # Only cut once a full chunk's worth is buffered, so every boundary
+        # is found exactly once.
+        while len(data) - start >= max_size or (eof and start < len(data)):
+            end = _cut(data, start, len(data), min_size, max_size, mask)
+            yield str(data[start:end])
+            start = end
+
+        del data[:start]
@@ -0,0 +1,407 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014 Casey Dahlin
+#
+# This file is part of Gauntlet.
+#
+# Gauntlet is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# Gauntlet is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# Gauntlet.  If not, see <http://www.gnu.org/licenses/>.
+
+import bisect
+import hashlib
+import itertools
+import os
+import shutil
+import sys
+import tempfile
+import requests
+from argparse import ArgumentParser
+from server import Server, ServerError, GitResult
+
+__all__ = ["HashRing", "Cluster", "connect", "rebalance", "main"]
+
+def _normalize(uri):
+    """
+    A server URI the way Server keeps it, with a trailing slash, so the same
+    server is always keyed and placed on the ring the same way.
+    """
+    return uri if uri.endswith('/') else uri + '/'
+
+def _point(key):
+    """
+    Position of a key on the ring. Object SHA-1s are already uniformly
+    distributed, so anything else is hashed to match.
+    """
+    return int(key[:16], 16)
+
+class HashRing(object):
+    """
+    A consistent hash ring. Each node is placed at `vnodes` points, and an
+    object belongs to the first distinct nodes found walking clockwise from
+    its SHA-1. Adding or removing a node only moves the objects in the
+    ranges next to its points.
+    """
+
+    def __init__(self, nodes, vnodes=64):
+        self.nodes = list(nodes)
+        self.ring = sorted((_point(hashlib.sha1("{}#{}".format(node,
+            i)).hexdigest()), node) for node in self.nodes for i in
+            range(vnodes))
+        self.points = [x[0] for x in self.ring]
+
+    def owners(self, sha, count):
+        """
+        The `count` nodes an object with the given SHA-1 belongs on, in order
+        of preference.
+        """
+        count = min(count, len(self.nodes))
+        found = []
+        i = bisect.bisect(self.points, _point(sha))
+
+        while len(found) < count:
+            node = self.ring[i % len(self.ring)][1]
+
+            if node not in found:
+                found.append(node)
+
+            i += 1
+
+        return found
+
+class Cluster(object):
+    """
+    A proxy object for a cluster of gauntlet servers, with the same interface
+    as a Server. Each object is stored on `replicas` servers chosen from a
+    HashRing. Reads go to the first of those and fail over to the others.
+    Writes go to all of them and succeed if any one does. Git repositories
+    are registered with every server, since a commit's SHA-1 doesn't say
+    which repository it is in.
+    """
+
+    def __init__(self, uris, replicas=2, vnodes=64, cache=None, **kwargs):
+        uris = [_normalize(x) for x in uris]
+        self.servers = dict((x, Server(x, cache=cache, **kwargs)) for x in
+                uris)
+        self.ring = HashRing(uris, vnodes)
+        self.replicas = replicas
+        self.cache = cache
+
+    def owners(self, sha):
+        """
+        The servers an object belongs on, in order of preference.
+        """
+        return [self.servers[x] for x in self.ring.owners(sha,
+            self.replicas)]
+
+    def _read(self, sha, func):
+        """
+        Call `func` with each server holding `sha` in turn until one works.
+        """
+        error = None
+
+        for server in self.owners(sha):
+            try:
+                return func(server)
+            except (ServerError, requests.RequestException), e:
+                error = e
+
+        raise ServerError("No server could provide " + sha + ": " +
+                str(error))
+
+    def _write(self, sha, func):
+        """
+        Call `func` with each server `sha` belongs on. Returns the first
+        result, and raises ServerError only if every server failed.
+        """
+        results = []
+        error = None
+
+        for server in self.owners(sha):
+            try:
+                results.append(func(server))
+            except (ServerError, requests.RequestException), e:
+                error = e
+
+        if len(results) == 0:
+            raise ServerError("No server could store " + sha + ": " +
+                    str(error))
+
+        return results[0]
+
+    def get_size(self, sha):
+        return self._read(sha, lambda x: x.get_size(sha))
+
+    def get(self, sha, start=0, end=None):
+        return self._read(sha, lambda x: x.get(sha, start, end))
+
+    def fetch(self, sha, path, connections=1, progress=None):
+        return self._read(sha, lambda x: x.fetch(sha, path, connections,
+            progress))
+
+    def have(self, shas, batch=10000):
+        """
+        Ask which of the given objects the cluster has, asking each server
+        only about the objects that belong on it.
+        """
+        asking = {}
+
+        for sha in shas:
+            for server in self.owners(sha):
+                asking.setdefault(server.uri, []).append(sha)
+
+        found = {}
+
+        for uri, group in asking.iteritems():
+            try:
+                found.update(self.servers[uri].have(group, batch))
+            except (ServerError, requests.RequestException):
+                pass
+
+        return found
+
+    def closure(self, roots, buildonly=False):
+        """
+        No one server has every header, so clients must walk the graph
+        themselves.
+        """
+        raise ServerError("Closures aren't available from a cluster")
+
+    def get_many(self, shas):
+        """
+        Fetch many objects, one bulk request per server. Objects the first
+        choice server doesn't have are fetched from replicas one at a time.
+        """
+        groups = {}
+
+        for sha in shas:
+            groups.setdefault(self.owners(sha)[0].uri, []).append(sha)
+
+        missing = []
+
+        for uri, group in groups.iteritems():
+            left = set(group)
+
+            try:
+                for sha, stream in self.servers[uri].get_many(group):
+                    left.discard(sha)
+                    yield sha, stream
+            except (ServerError, requests.RequestException):
+                pass
+
+            missing += sorted(left)
+
+        for sha in missing:
+            try:
+                stream = self.get(sha)
+            except ServerError:
+                continue
+
+            if not isinstance(stream, GitResult):
+                yield sha, stream
+
+    def upload(self, path, session=None, part_size=8 << 20, jobs=1,
+            retries=3, progress=None):
+        """
+        Put the file at `path` on every server it belongs on. Upload sessions
+        belong to one server, so `session` isn't supported.
+        """
+        sha = hashlib.sha1()
+
+        with open(path, 'rb') as f:
+            buf = 'a'
+            while len(buf) > 0:
+                buf = f.read(1 << 20)
+                sha.update(buf)
+
+        sha = sha.hexdigest()
+        return self._write(sha, lambda x: x.upload(path, None, part_size,
+            jobs, retries, progress))
+
+    def post(self, data_or_fd):
+        """
+        Put a new object on the cluster. The data is spooled to a temporary
+        file first, since we need its SHA-1 to know where it goes.
+        """
+        fd, tmp = tempfile.mkstemp()
+
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                if hasattr(data_or_fd, 'read'):
+                    shutil.copyfileobj(data_or_fd, f)
+                elif isinstance(data_or_fd, basestring):
+                    f.write(data_or_fd)
+                else:
+                    for buf in data_or_fd:
+                        f.write(buf)
+
+            return self.upload(tmp)
+        finally:
+            os.unlink(tmp)
+
+    def post_chunked(self, f):
+        """
+        Put a new object on the cluster, sending each server only the chunks
+        of it that server doesn't already have.
+        """
+        sha = hashlib.sha1()
+
+        buf = 'a'
+        while len(buf) > 0:
+            buf = f.read(1 << 20)
+            sha.update(buf)
+
+        def post(server):
+            f.seek(0)
+            return server.post_chunked(f)
+
+        return self._write(sha.hexdigest(), post)
+
+    def git_post(self, giturl):
+        """
+        Register a git repository with every server in the cluster. Returns
+        the id of the job on the first server, which git_job checks on.
+        """
+        results = [self.servers[x].git_post(giturl) for x in self.ring.nodes]
+        return results[0]
+
+    def git_job(self, job_id):
+        """
+        Get the (state, error) of a job on the first server.
+        """
+        return self.servers[self.ring.nodes[0]].git_job(job_id)
+
+    def git_hint(self, urls):
+        """
+        Pass hints of the git repositories we might use on to every server.
+        Returns the refreshes queued on the first server that took them.
+        """
+        found = None
+
+        for uri in self.ring.nodes:
+            try:
+                queued = self.servers[uri].git_hint(urls)
+            except (ServerError, requests.RequestException):
+                continue
+
+            if found is None:
+                found = queued
+
+        return found or {}
+
+def connect(uris, replicas=2, **kwargs):
+    """
+    Get a proxy for the server at `uris`, or a Cluster if it lists several
+    URIs separated by commas or whitespace.
+    """
+    uris = uris.replace(',', ' ').split()
+
+    if len(uris) == 1:
+        return Server(uris[0], **kwargs)
+
+    return Cluster(uris, replicas, **kwargs)
+
+def _pages(items, size):
+    """
+    Split an iterable into lists of up to `size` items.
+    """
+    items = iter(items)
+
+    while True:
+        page = list(itertools.islice(items, size))
+
+        if len(page) == 0:
+            return
+
+        yield page
+
+def rebalance(old_uris, new_uris, replicas=2, vnodes=64, prune=False,
+        log=None, batch=10000):
+    """
+    Move objects after the servers in a cluster change from `old_uris` to
+    `new_uris`. Only objects whose owners differ between the two rings are
+    touched: each is copied to its new owners that lack it, and if `prune`
+    is set, deleted from servers that no longer own it once it is safely
+    copied. Servers must allow deletion for pruning. Listings are handled
+    `batch` objects at a time, asking each new owner which of them it has in
+    one request. Returns the number of objects copied.
+    """
+    old_uris = [_normalize(x) for x in old_uris]
+    new_uris = [_normalize(x) for x in new_uris]
+    old_ring = HashRing(old_uris, vnodes)
+    new_ring = HashRing(new_uris, vnodes)
+    servers = dict((x, Server(x)) for x in set(old_uris) | set(new_uris))
+    copied = 0
+
+    for uri in old_uris:
+        for page in _pages(servers[uri].list(), batch):
+            moving = []
+            asking = {}
+
+            for sha in page:
+                old = old_ring.owners(sha, replicas)
+                new = new_ring.owners(sha, replicas)
+
+                if set(old) == set(new):
+                    continue
+
+                moving.append((sha, new))
+
+                for target in new:
+                    asking.setdefault(target, []).append(sha)
+
+            found = dict((x, servers[x].have(group, batch)) for x, group in
+                    asking.iteritems())
+
+            for sha, new in moving:
+                holders = [x for x in new if sha in found[x]]
+
+                for target in new:
+                    if target in holders:
+                        continue
+
+                    src = servers[uri].get(sha)
+
+                    if isinstance(src, GitResult):
+                        break
+
+                    servers[target].post(src)
+                    holders.append(target)
+                    copied += 1
+
+                    if log:
+                        log("{} -> {}".format(sha, target))
+
+                if prune and uri not in new and len(holders) == len(new):
+                    servers[uri].delete(sha)
+
+    return copied
+
+def main():
+    """
+    Main function for the gauntlet-rebalance command.
+    """
+    parser = ArgumentParser(description="Move objects between gauntlet "
+            "servers after the servers in a cluster change")
+    parser.add_argument('old', help="comma-separated URIs of the old cluster")
+    parser.add_argument('new', help="comma-separated URIs of the new cluster")
+    parser.add_argument('--replicas', type=int, default=2)
+    parser.add_argument('--prune', action='store_true',
+            help="delete objects from servers that no longer own them")
+    args = parser.parse_args()
+
+    def log(line):
+        print >>sys.stderr, line
+
+    copied = rebalance(args.old.split(','), args.new.split(','),
+            args.replicas, prune=args.prune, log=log)
+
+    print >>sys.stderr, "Copied {} objects".format(copied)
+    return 0
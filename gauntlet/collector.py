@@ -0,0 +1,369 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014 Casey Dahlin
+#
+# This file is part of Gauntlet.
+#
+# Gauntlet is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# Gauntlet is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# Gauntlet.  If not, see <http://www.gnu.org/licenses/>.
+
+import errno
+import os
+import shutil
+import sys
+import time
+import git as Git
+import yaml
+from argparse import ArgumentParser
+from config import GauntletFile, ConfigError
+from fsutil import prune_dir
+from gitindex import GitIndex
+from headers import HeaderIndex
+from objects import ObjectStore
+
+__all__ = ["GarbageCollector", "main"]
+
+class _Throttle(object):
+    """
+    Sleeps as needed to keep to `rate` operations per second. A rate of None
+    doesn't limit anything.
+    """
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.start = time.time()
+        self.count = 0
+
+    def tick(self):
+        if not self.rate:
+            return
+
+        self.count += 1
+        ahead = self.count / float(self.rate) - (time.time() - self.start)
+
+        if ahead > 0:
+            time.sleep(ahead)
+
+class GarbageCollector(object):
+    """
+    Mark-and-sweep collection for a server's ObjectStore.
+
+    Everything reachable from the roots through the compose and
+    compose-buildonly lists in shard headers is live. The roots are the SHA-1s
+    we are given, those listed in the `pins` file in the store, the files and
+    compose lists of the .gauntlet file at every ref of the registered git
+    repositories, and every object stored less than `grace` seconds ago, so
+    uploads that nothing refers to yet survive. Headers are cached in a
+    HeaderIndex, so each object is only read the first time it is marked.
+
+    Objects are touched when a client is told we have them, which counts as
+    storing them again. Each object's time is checked once more just before
+    it is swept, so one touched while we were marking survives too.
+
+    Unreachable objects are moved into `quarantine` in the store rather than
+    deleted, and are only deleted once they have been there for `grace`
+    seconds, so anything wrongly collected can be put back by hand. All
+    filesystem work is limited to `rate` operations per second, and a run can
+    stop after collecting `limit` objects, so collection can run
+    incrementally on a live server.
+    """
+
+    def __init__(self, store, headers, git_index=None, grace=7 * 24 * 60 * 60,
+            rate=None):
+        self.store = store
+        self.headers = headers
+        self.git_index = git_index
+        self.grace = grace
+        self.throttle = _Throttle(rate)
+        self.quarantine = os.path.join(store.root, "quarantine")
+
+    def pins(self):
+        """
+        Get the SHA-1s listed in the store's `pins` file, one per line.
+        Anything after a '#' is a comment.
+        """
+        try:
+            with open(os.path.join(self.store.root, "pins")) as f:
+                return [x.split('#')[0].strip() for x in f if
+                        x.split('#')[0].strip()]
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            return []
+
+    def git_roots(self):
+        """
+        Get the SHA-1s named by the .gauntlet file at each ref of every
+        registered git repository.
+        """
+        if self.git_index is None:
+            return []
+
+        found = []
+
+        for repo_id, url, directory in self.git_index.repos():
+            repo = Git.Repo(directory)
+
+            for ref in set(repo.git.for_each_ref(
+                '--format=%(objectname)').split()):
+                try:
+                    gfile = GauntletFile(repo.git.show(ref + ":.gauntlet"))
+                except (Git.GitCommandError, ConfigError, yaml.YAMLError):
+                    continue
+
+                found += gfile['files'].values()
+                found += [x['hash'] for x in gfile['compose'] +
+                        gfile['compose-buildonly']]
+
+        return found
+
+    def objects(self):
+        """
+        Generate (SHA-1, kind, modification time) for everything in the
+        store, where kind is "loose", "compressed", "recipe" or "packed".
+        Packed objects take the time their pack was written.
+        """
+        for kind, listing in [("loose", self.store.loose()),
+                ("compressed", self.store.compressed()),
+                ("recipe", self.store.recipes())]:
+            for sha, path in listing:
+                try:
+                    yield sha, kind, os.path.getmtime(path)
+                except OSError, e:
+                    if e.errno != errno.ENOENT:
+                        raise
+
+        self.store.packs.refresh()
+
+        for pack in self.store.packs.packs.values():
+            mtime = os.path.getmtime(pack.path + ".idx")
+
+            for sha, offset, size in pack:
+                yield sha, "packed", mtime
+
+    def mark(self, roots):
+        """
+        Get the set of SHA-1s reachable from `roots`.
+        """
+        live = set(roots)
+        frontier = list(live)
+
+        while len(frontier):
+            batch = frontier[:1000]
+            frontier = frontier[1000:]
+
+            for sha in batch:
+                self.throttle.tick()
+
+            for compose, compose_buildonly in self.headers.get(self.store,
+                    batch).values():
+                for dep in compose + compose_buildonly:
+                    if dep not in live:
+                        live.add(dep)
+                        frontier.append(dep)
+
+        return live
+
+    def _touched(self, sha, kind, cutoff):
+        """
+        Check whether an object we are about to sweep has been touched since
+        `cutoff`.
+        """
+        if kind == "packed":
+            found = self.store.packs.find(sha)
+
+            if found is None:
+                return False
+
+            path = found[0].path + ".idx"
+        elif kind == "compressed":
+            path = self.store.compressed_path(sha)
+        elif kind == "recipe":
+            path = self.store.recipe_path(sha)
+        else:
+            path = self.store.path(sha)
+
+        try:
+            return os.path.getmtime(path) >= cutoff
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            return False
+
+    def _stash(self, path, name):
+        """
+        Move a file into quarantine under `name`, stamped with the time it
+        went in, and remove its directory if that leaves it empty.
+        """
+        target = os.path.join(self.quarantine, name)
+
+        try:
+            os.rename(path, target)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            return False
+
+        os.utime(target, None)
+        prune_dir(os.path.dirname(path))
+        return True
+
+    def sweep(self, live, objects, limit=None):
+        """
+        Quarantine everything in `objects`, a list from objects(), that isn't
+        in `live`. Chunks no live recipe uses go too. Returns the number of
+        objects quarantined.
+        """
+        if not os.path.isdir(self.quarantine):
+            os.makedirs(self.quarantine)
+
+        dead = [(sha, kind) for sha, kind, mtime in objects if sha not in live]
+
+        if limit is not None:
+            dead = dead[:limit]
+
+        packed = []
+        count = 0
+        cutoff = time.time() - self.grace
+
+        for sha, kind in dead:
+            self.throttle.tick()
+
+            if self._touched(sha, kind, cutoff):
+                continue
+
+            if kind == "loose":
+                count += self._stash(self.store.path(sha), sha)
+            elif kind == "compressed":
+                count += self._stash(self.store.compressed_path(sha),
+                        sha + ".gz")
+            elif kind == "recipe":
+                count += self._stash(self.store.recipe_path(sha),
+                        sha + ".recipe")
+            else:
+                packed.append(sha)
+
+        for sha in packed:
+            self.throttle.tick()
+            target = os.path.join(self.quarantine, sha)
+            src = self.store.open(sha)
+
+            try:
+                with open(target, 'wb') as f:
+                    shutil.copyfileobj(src, f)
+            finally:
+                src.close()
+
+        if len(packed):
+            while not self.store.packs.remove(packed):
+                time.sleep(1)
+            count += len(packed)
+
+        self.headers.forget([x[0] for x in dead])
+        self.sweep_chunks()
+        return count
+
+    def sweep_chunks(self):
+        """
+        Quarantine chunks older than the grace period that no recipe uses.
+        """
+        used = set()
+
+        for sha, path in self.store.recipes():
+            recipe = self.store.recipe(sha)
+
+            if recipe is not None:
+                used.update(x[0] for x in recipe)
+
+        cutoff = time.time() - self.grace
+
+        for sha, path in self.store.chunks():
+            if sha in used:
+                continue
+
+            try:
+                if os.path.getmtime(path) >= cutoff:
+                    continue
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+                continue
+
+            self.throttle.tick()
+            self._stash(path, sha + ".chunk")
+
+    def purge(self):
+        """
+        Delete everything that has been in quarantine for the grace period.
+        Returns the number of files deleted.
+        """
+        if not os.path.isdir(self.quarantine):
+            return 0
+
+        cutoff = time.time() - self.grace
+        count = 0
+
+        for name in os.listdir(self.quarantine):
+            path = os.path.join(self.quarantine, name)
+
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    self.throttle.tick()
+                    os.unlink(path)
+                    count += 1
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+
+        return count
+
+    def collect(self, roots=(), limit=None):
+        """
+        Run one collection: purge old quarantined objects, mark everything
+        live and quarantine the rest. Returns (quarantined, deleted).
+        """
+        deleted = self.purge()
+
+        objects = list(self.objects())
+        cutoff = time.time() - self.grace
+        young = [sha for sha, kind, mtime in objects if mtime >= cutoff]
+        live = self.mark(list(roots) + self.pins() + self.git_roots() + young)
+
+        return self.sweep(live, objects, limit), deleted
+
+def main():
+    """
+    Main function for the gauntlet-gc command.
+    """
+    parser = ArgumentParser(description="Collect unreachable objects from a "
+            "gauntlet object store")
+    parser.add_argument('objects_dir')
+    parser.add_argument('roots', nargs='*')
+    parser.add_argument('--grace', type=float, default=7,
+            help="days to keep unreferenced and quarantined objects")
+    parser.add_argument('--rate', type=int, default=None,
+            help="filesystem operations per second")
+    parser.add_argument('--limit', type=int, default=None,
+            help="most objects to collect this run")
+    args = parser.parse_args()
+
+    store = ObjectStore(args.objects_dir)
+    headers = HeaderIndex(os.path.join(args.objects_dir, "headers.sqlite"))
+    index_path = os.path.join(args.objects_dir, "git", "index.sqlite")
+    git_index = GitIndex(index_path) if os.path.exists(index_path) else None
+
+    collector = GarbageCollector(store, headers, git_index,
+            args.grace * 24 * 60 * 60, args.rate)
+    quarantined, deleted = collector.collect(args.roots, args.limit)
+
+    print >>sys.stderr, "Quarantined {} objects, deleted {}".format(
+            quarantined, deleted)
+    return 0
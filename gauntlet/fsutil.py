@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014 Casey Dahlin
+#
+# This file is part of Gauntlet.
+#
+# Gauntlet is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# Gauntlet is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# Gauntlet.  If not, see <http://www.gnu.org/licenses/>.
+
+import errno
+import fcntl
+import json
+import os
+import shutil
+from contextlib import contextmanager
+
+__all__ = ["METHODS", "reflink", "link_file", "locked_state", "prune_dir"]
+
+# From linux/fs.h
+FICLONE = 0x40049409
+
+# Ways of placing a stored file elsewhere, in the order we fall back through
+# them. "clone" reflinks where it can and copies otherwise, so the result
+# never shares an inode with the store.
+METHODS = ["reflink", "hardlink", "copy", "clone"]
+
+# What a filesystem that can't reflink, or can't reflink between these two
+# paths, raises.
+REFLINK_ERRORS = [errno.EOPNOTSUPP, errno.ENOTTY, errno.EXDEV, errno.EINVAL]
+
+def reflink(src, dst):
+    """
+    Clone `src` to `dst` sharing data blocks with copy-on-write. Raises
+    IOError if the filesystem can't do it.
+    """
+    with open(src, 'rb') as s:
+        with open(dst, 'wb') as d:
+            fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+
+    shutil.copystat(src, dst)
+
+def link_file(src, dst, method, try_reflink=True):
+    """
+    Place the file `src` at `dst` using the first workable method at or after
+    `method` in METHODS. With `try_reflink` False we go straight to the
+    fallback, for callers who already know reflinks don't work here. Returns
+    the method used.
+    """
+    if method in ["reflink", "clone"] and try_reflink:
+        try:
+            reflink(src, dst)
+            return "reflink"
+        except IOError, e:
+            if e.errno not in REFLINK_ERRORS:
+                raise
+            os.unlink(dst)
+
+    if method == "reflink":
+        method = "hardlink"
+
+    if method == "hardlink":
+        try:
+            os.link(src, dst)
+            return method
+        except OSError, e:
+            if e.errno not in [errno.EXDEV, errno.EPERM, errno.EMLINK]:
+                raise
+
+    shutil.copy2(src, dst)
+    return "copy"
+
+def prune_dir(path):
+    """
+    Remove the directory `path` if it is empty. Returns whether we did.
+    """
+    try:
+        os.rmdir(path)
+        return True
+    except OSError, e:
+        if e.errno not in [errno.ENOTEMPTY, errno.EEXIST, errno.ENOENT]:
+            raise
+        return False
+
+@contextmanager
+def locked_state(lock_path, state_path):
+    """
+    Hold an exclusive lock on `lock_path` and yield the JSON state kept at
+    `state_path`. Changes made to the state are saved when the block exits.
+    """
+    with open(lock_path, 'a') as lock:
+        fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+
+        try:
+            with open(state_path, 'r') as f:
+                state = json.load(f)
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            state = {}
+
+        yield state
+
+        tmp = state_path + ".tmp"
+        with open(tmp, 'w') as f:
+            json.dump(state, f)
+        os.rename(tmp, state_path)
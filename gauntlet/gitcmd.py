@@ -21,10 +21,13 @@ import os
 import sys
 import git
 import errno
+import hashlib
 import re
 import ConfigParser
 import progressbar
-from server import Server
+from server import ServerError
+from cluster import connect
+from cache import ObjectCache
 from config import GauntletFile, ComposeCollideError
 from ansi.color import fg as ansi_fg
 
@@ -148,7 +151,18 @@ class GitGauntletCmd(object):
         else:
             coloring = os.isatty(1)
 
+        try:
+            budget = int(reader.get_value('gauntlet', 'cache-budget'))
+        except (ConfigParser.NoOptionError, ConfigParser.NoSectionError):
+            budget = 8 << 30
+
+        try:
+            replicas = int(reader.get_value('gauntlet', 'replicas'))
+        except (ConfigParser.NoOptionError, ConfigParser.NoSectionError):
+            replicas = 2
+
         gfile = self.get_gfile()
+        server = connect(server, replicas, cache=ObjectCache(budget=budget))
 
         if self.args.fetch:
             return self.upload_fetch(gfile, server)
@@ -164,9 +178,18 @@ class GitGauntletCmd(object):
             return 0
 
         ret = 0
+        hashes = dict((x, self.hash_file(x)) for x in self.args.path if
+                os.path.isfile(x))
+
+        try:
+            present = server.have(hashes.values())
+        except ServerError, e:
+            print(e, file=sys.stderr)
+            return 1
 
         for path in self.args.path:
-            ret += self.do_upload(path, gfile, server)
+            ret += self.do_upload(path, gfile, server, hashes.get(path),
+                    present)
 
         self.put_gfile(gfile)
         return ret
@@ -195,14 +218,19 @@ class GitGauntletCmd(object):
         Process an upload --fetch command
         """
 
-        server = Server(server)
-
         paths = gfile['files'].keys()
 
         if len(paths) == 0:
             print("No uploaded files to fetch", file=sys.stderr)
             return 1
 
+        if len(gfile['git-hint']):
+            try:
+                server.git_hint(gfile['git-hint'])
+            except ServerError:
+                # Only a hint; the fetch can go ahead without it.
+                pass
+
         ret = 0
 
         if len(self.args.path) > 0:
@@ -213,7 +241,7 @@ class GitGauntletCmd(object):
                 path = os.path.relpath(path, self.repo.working_tree_dir)
 
                 if not path in paths:
-                    printf("No uploaded file at '{}'".format(path),
+                    print("No uploaded file at '{}'".format(path),
                             file=sys.stderr)
                     ret += 1
                 else:
@@ -233,36 +261,35 @@ class GitGauntletCmd(object):
 
     def upload_do_fetch(self, path, repopath, sha, server):
         """
-        Get an upload from the server and put it at the given path
+        Get an upload from the server and put it at the given path. An
+        interrupted download is resumed from where it stopped.
         """
 
-        target = open(abpath, 'w')
-
         if os.isatty(2):
             size = server.get_size(sha)
             progress = self.progress("Downloading", repopath, size)
             progress.start()
+            update = progress.update
         else:
             progress = None
+            update = None
 
-        src = server.get(sha)
-
-        buf = 'a'
-        while len(buf) > 0:
-            buf = src.read(4096)
-            progress.update(len(buf))
-            target.write(buf)
+        try:
+            server.fetch(sha, path, progress=update)
+        except ServerError, e:
+            print(e, file=sys.stderr)
+            return 1
 
         if progress:
             progress.finish()
 
-        target.close()
         return 0
 
-
-    def do_upload(self, path, gfile, server):
+    def do_upload(self, path, gfile, server, sha=None, present={}):
         """
-        Upload a single file to the gauntlet cache
+        Upload a single file to the gauntlet cache. `sha` is the file's SHA-1
+        if we've already hashed it, and if the server is already listed as
+        having it in `present` we don't send it again.
         """
         repopath = os.path.abspath(path)
 
@@ -280,37 +307,11 @@ class GitGauntletCmd(object):
             print("'{}' does not exist".format(repopath), file=sys.stderr)
             return 1
 
-        server = Server(server)
-
-        # The server is in flask, and apparently WSGI can't handle chunked
-        # requests. There's code to implement a progress bar below, but it's
-        # disabled since we have to chunk the request to do it.
-        #
-        # See https://github.com/mitsuhiko/flask/issues/367
-        #
-        #if os.isatty(2): #stderr
-        #    progress = self.progress("Uploading", repopath,
-        #            os.path.getsize(self.args.path))
-        #else:
-        #    progress = None
-
-        with open(path, 'r') as f:
-            #def f_iter():
-            #    data = 'a'
-            #    count = 0
-            #    while len(data):
-            #        data = f.read(4096)
-            #        yield data
-            #        count += len(data)
-            #        progress.update(count)
-
-            #if progress:
-            #    progress.start()
-            #    sha = server.post(f_iter())
-            #    progress.finish()
-            #else:
-            #    sha = server.post(f)
-            sha = server.post(f)
+        if sha is None or sha not in present:
+            sha = self.send_upload(path, repopath, server)
+
+        if sha is None:
+            return 1
 
         gfile['files'][repopath] = str(sha)
 
@@ -320,6 +321,31 @@ class GitGauntletCmd(object):
 
         return 0
 
+    def send_upload(self, path, repopath, server):
+        """
+        Send a file to the gauntlet server and return its SHA-1, or None if
+        it couldn't be sent.
+        """
+        if os.isatty(2): #stderr
+            progress = self.progress("Uploading", repopath,
+                    os.path.getsize(path))
+            progress.start()
+            update = progress.update
+        else:
+            progress = None
+            update = None
+
+        try:
+            sha = server.upload(path, jobs=4, progress=update)
+        except ServerError, e:
+            print(e, file=sys.stderr)
+            return None
+
+        if progress:
+            progress.finish()
+
+        return sha
+
     def get_gfile(self):
         try:
             gfile_fd = os.open(self.gfile_path, os.O_RDONLY)
@@ -360,6 +386,21 @@ class GitGauntletCmd(object):
 
         return {'package': fields.group(1), 'hash': fields.group(2) }
 
+    @staticmethod
+    def hash_file(path):
+        """
+        Get the SHA-1 of a file's content.
+        """
+        sha = hashlib.sha1()
+
+        with open(path, 'rb') as f:
+            buf = 'a'
+            while len(buf) > 0:
+                buf = f.read(1 << 20)
+                sha.update(buf)
+
+        return sha.hexdigest()
+
     @staticmethod
     def progress(task, filename, size):
         """
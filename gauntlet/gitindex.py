@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014 Casey Dahlin
+#
+# This file is part of Gauntlet.
+#
+# Gauntlet is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# Gauntlet is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# Gauntlet.  If not, see <http://www.gnu.org/licenses/>.
+
+import binascii
+import sqlite3
+from contextlib import contextmanager
+
+__all__ = ["GitIndex"]
+
+@contextmanager
+def connect(path):
+    """
+    Open a connection to the sqlite database at `path` for one transaction.
+    Connections can't be shared between threads, so each operation opens its
+    own.
+    """
+    conn = sqlite3.connect(path, timeout=60)
+    conn.text_factory = str
+
+    try:
+        with conn:
+            yield conn
+    finally:
+        conn.close()
+
+class GitIndex(object):
+    """
+    A persistent index from git commit SHA-1s to the URL of a registered
+    repository containing them, kept in an sqlite database. Commits are keyed
+    by their binary SHA-1 in a B-tree, so lookups are O(log n) no matter how
+    many commits are indexed. For each repository we also remember the refs
+    we indexed up to, so refreshing only has to add newer commits.
+    """
+
+    SCHEMA = """
+        PRAGMA journal_mode=WAL;
+        CREATE TABLE IF NOT EXISTS repos (
+            id INTEGER PRIMARY KEY,
+            url TEXT UNIQUE NOT NULL,
+            dir TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS commits (
+            sha BLOB PRIMARY KEY,
+            repo INTEGER NOT NULL
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS heads (
+            repo INTEGER NOT NULL,
+            sha TEXT NOT NULL
+        );
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+        with connect(self.path) as conn:
+            conn.executescript(self.SCHEMA)
+
+    def lookup(self, sha):
+        """
+        Get the URL of a repository containing the given commit, or None.
+        """
+        try:
+            key = sqlite3.Binary(binascii.unhexlify(sha))
+        except TypeError:
+            return None
+
+        with connect(self.path) as conn:
+            row = conn.execute("SELECT repos.url FROM commits JOIN repos ON "
+                    "commits.repo = repos.id WHERE commits.sha = ?",
+                    (key,)).fetchone()
+
+        return row[0] if row else None
+
+    def repo(self, url):
+        """
+        Get the (id, directory) of the registered repository with the given
+        URL, or None.
+        """
+        with connect(self.path) as conn:
+            return conn.execute("SELECT id, dir FROM repos WHERE url = ?",
+                    (url,)).fetchone()
+
+    def repos(self):
+        """
+        Get the (id, URL, directory) of every registered repository.
+        """
+        with connect(self.path) as conn:
+            return conn.execute("SELECT id, url, dir FROM repos").fetchall()
+
+    def add_repo(self, url, directory):
+        """
+        Register a repository cloned into `directory` and return its id.
+        """
+        with connect(self.path) as conn:
+            return conn.execute("INSERT INTO repos (url, dir) VALUES (?, ?)",
+                    (url, directory)).lastrowid
+
+    def heads(self, repo_id):
+        """
+        The ref SHA-1s a repository was last indexed up to.
+        """
+        with connect(self.path) as conn:
+            return [x[0] for x in conn.execute("SELECT sha FROM heads WHERE "
+                "repo = ?", (repo_id,))]
+
+    def add_commits(self, repo_id, shas, heads):
+        """
+        Index the given commit SHA-1s as belonging to a repository, and record
+        `heads` as the refs it is now indexed up to. Commits already indexed
+        for another repository keep pointing there.
+        """
+        with connect(self.path) as conn:
+            conn.executemany("INSERT OR IGNORE INTO commits (sha, repo) "
+                    "VALUES (?, ?)", ((sqlite3.Binary(binascii.unhexlify(x)),
+                        repo_id) for x in shas))
+            conn.execute("DELETE FROM heads WHERE repo = ?", (repo_id,))
+            conn.executemany("INSERT INTO heads (repo, sha) VALUES (?, ?)",
+                    ((repo_id, x) for x in heads))
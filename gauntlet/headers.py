@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014 Casey Dahlin
+#
+# This file is part of Gauntlet.
+#
+# Gauntlet is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# Gauntlet is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# Gauntlet.  If not, see <http://www.gnu.org/licenses/>.
+
+import binascii
+import errno
+import sqlite3
+from gitindex import connect
+from objects import sha_re
+from shard import Shard, InvalidShardError
+
+__all__ = ["HeaderIndex"]
+
+class HeaderIndex(object):
+    """
+    A persistent cache of the compose lists in the headers of stored objects,
+    kept in an sqlite database. Objects never change, so once an object's
+    header has been read it never has to be read again. Objects that aren't
+    shards are remembered too, with no compose lists.
+    """
+
+    SCHEMA = """
+        PRAGMA journal_mode=WAL;
+        CREATE TABLE IF NOT EXISTS headers (
+            sha BLOB PRIMARY KEY,
+            shard INTEGER NOT NULL,
+            compose TEXT NOT NULL,
+            compose_buildonly TEXT NOT NULL
+        ) WITHOUT ROWID;
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+        with connect(self.path) as conn:
+            conn.executescript(self.SCHEMA)
+
+    @staticmethod
+    def _read(store, sha):
+        """
+        Read the header of an object. Returns (is shard, compose,
+        compose_buildonly), or None if we don't have the object.
+        """
+        try:
+            f = store.open(sha)
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            return None
+
+        try:
+            header = Shard.read_header(f)
+        except InvalidShardError:
+            return False, [], []
+        finally:
+            f.close()
+
+        return True, header[2], header[3]
+
+    def get(self, store, shas):
+        """
+        Get the compose lists of objects in `store`. Returns a dict mapping
+        each SHA-1 we have to a (compose, compose_buildonly) pair, both empty
+        for objects that aren't shards. Headers we haven't seen before are
+        read and remembered.
+        """
+        shas = [x for x in set(shas) if sha_re.match(x)]
+        found = {}
+
+        with connect(self.path) as conn:
+            for sha in shas:
+                row = conn.execute("SELECT compose, compose_buildonly FROM "
+                        "headers WHERE sha = ?", (sqlite3.Binary(
+                            binascii.unhexlify(sha)),)).fetchone()
+
+                if row is not None:
+                    found[sha] = (row[0].split(), row[1].split())
+
+        new = []
+
+        for sha in shas:
+            if sha in found:
+                continue
+
+            header = self._read(store, sha)
+
+            if header is None:
+                continue
+
+            shard, compose, compose_buildonly = header
+            found[sha] = (compose, compose_buildonly)
+            new.append((sqlite3.Binary(binascii.unhexlify(sha)), int(shard),
+                " ".join(compose), " ".join(compose_buildonly)))
+
+        if len(new):
+            with connect(self.path) as conn:
+                conn.executemany("INSERT OR REPLACE INTO headers (sha, shard, "
+                        "compose, compose_buildonly) VALUES (?, ?, ?, ?)", new)
+
+        return found
+
+    def closure(self, store, roots, buildonly=False):
+        """
+        Walk the compose lists of the shards in `store` from `roots`. Returns
+        a list of (SHA-1, compose) pairs in which every shard comes after
+        everything it composes. compose-buildonly lists are followed too if
+        `buildonly` is set. Raises KeyError listing any SHA-1s we don't have,
+        and ValueError if the graph has a cycle.
+        """
+        deps = {}
+        frontier = list(set(roots))
+
+        while len(frontier):
+            found = self.get(store, frontier)
+            missing = [x for x in frontier if x not in found]
+
+            if len(missing):
+                raise KeyError(missing)
+
+            for sha in frontier:
+                compose, compose_buildonly = found[sha]
+                deps[sha] = compose + (compose_buildonly if buildonly else [])
+
+            frontier = list(set(x for sha in frontier for x in deps[sha] if x
+                not in deps))
+
+        order = []
+        done = set()
+        visiting = set()
+
+        def visit(sha):
+            if sha in done:
+                return
+            if sha in visiting:
+                raise ValueError("Compose cycle through " + sha)
+
+            visiting.add(sha)
+            for dep in deps[sha]:
+                visit(dep)
+            visiting.remove(sha)
+            done.add(sha)
+            order.append((sha, deps[sha]))
+
+        for sha in roots:
+            visit(sha)
+
+        return order
+
+    def forget(self, shas):
+        """
+        Drop the cached headers of objects that have been deleted.
+        """
+        with connect(self.path) as conn:
+            conn.executemany("DELETE FROM headers WHERE sha = ?",
+                    ((sqlite3.Binary(binascii.unhexlify(x)),) for x in shas))
@@ -0,0 +1,398 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014 Casey Dahlin
+#
+# This file is part of Gauntlet.
+#
+# Gauntlet is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# Gauntlet is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# Gauntlet.  If not, see <http://www.gnu.org/licenses/>.
+
+import errno
+import hashlib
+import os
+import shutil
+import stat
+import subprocess
+import time
+import uuid
+from fsutil import METHODS, link_file, locked_state
+from shard import Shard
+
+__all__ = ["LayerStore", "LayerError"]
+
+class LayerError(Exception):
+    """
+    An exception indicating a problem fetching or materializing a layer.
+    """
+    pass
+
+def _pid_alive(pid):
+    """
+    Check whether a process still exists.
+    """
+    try:
+        os.kill(pid, 0)
+    except OSError, e:
+        return e.errno == errno.EPERM
+
+    return True
+
+def _tree_size(path):
+    """
+    Total size in bytes of everything under `path`.
+    """
+    total = 0
+
+    for dirpath, dirnames, filenames in os.walk(path):
+        for name in dirnames + filenames:
+            total += os.lstat(os.path.join(dirpath, name)).st_size
+
+    return total
+
+def _chown(path, st):
+    """
+    Give `path` the owner and group in `st`, without following links. Only
+    root can give files away, so as anyone else we keep what we can.
+    """
+    try:
+        os.lchown(path, st.st_uid, st.st_gid)
+    except OSError, e:
+        if e.errno != errno.EPERM or os.geteuid() == 0:
+            raise
+
+def _make_node(path, st):
+    """
+    Recreate a FIFO or device node like the one `st` describes at `path`.
+    Their content isn't data we can copy, and opening them could block.
+    """
+    if stat.S_ISFIFO(st.st_mode):
+        os.mkfifo(path)
+    else:
+        os.mknod(path, stat.S_IFMT(st.st_mode) | 0600, st.st_rdev)
+
+class LayerStore(object):
+    """
+    A local store of exploded shards, keyed by shard SHA-1. Each shard is
+    extracted once and image roots are built by linking from the store. Shard
+    files downloaded by the store are kept alongside so their headers can be
+    read again without another download.
+
+    The store may be shared by several build processes. Bookkeeping lives in a
+    state file guarded by a lock file, and every process holding a layer is
+    recorded by pid so layers in use are never evicted, even if a holder died
+    without releasing them. The budget is soft: layers in use stay however
+    far over it they take us.
+    """
+
+    METHODS = METHODS
+
+    def __init__(self, root, budget=None):
+        """
+        Create or open a store at `root`. `budget` is the size in bytes the
+        store may grow to before unused layers are evicted, least recently
+        used first. None means no limit.
+        """
+        self.root = root
+        self.budget = budget
+        self.layer_dir = os.path.join(root, "layers")
+        self.shard_dir = os.path.join(root, "shards")
+        self.tmp_dir = os.path.join(root, "tmp")
+        self.state_path = os.path.join(root, "state.json")
+        self.reflink_ok = None
+
+        for path in [self.layer_dir, self.shard_dir, self.tmp_dir]:
+            try:
+                os.makedirs(path)
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+    def _locked(self):
+        """
+        Hold the store lock and yield the store state. Changes made to the
+        state are saved when the block exits.
+        """
+        return locked_state(os.path.join(self.root, "lock"), self.state_path)
+
+    def path(self, sha):
+        """
+        Where the exploded contents of the given shard live.
+        """
+        return os.path.join(self.layer_dir, sha)
+
+    def __contains__(self, sha):
+        return os.path.isdir(self.path(sha))
+
+    def shard_path(self, sha):
+        """
+        Where the downloaded shard file itself lives, if we have it.
+        """
+        return os.path.join(self.shard_dir, sha)
+
+    def _account(self, state, sha, size):
+        """
+        Charge `size` bytes to the entry for `sha`, creating it if needed.
+        Must be called with the lock held.
+        """
+        entry = state.setdefault(sha, { 'size': 0, 'users': [] })
+        entry['size'] += size
+        entry['atime'] = time.time()
+
+    def _hold(self, state, sha):
+        """
+        Record this process as using the layer `sha`. Must be called with the
+        lock held.
+        """
+        self._account(state, sha, 0)
+        state[sha]['users'].append(os.getpid())
+
+    def add(self, sha, shard, workers=None, hold=False):
+        """
+        Explode `shard` into the store under `sha`, unless it is already
+        there. With `hold` set, the layer is also marked as in use by this
+        process before anything is evicted to make room for it, as if by
+        `acquire`. Returns whether we added it.
+        """
+        if sha in self:
+            return False
+
+        tmp = os.path.join(self.tmp_dir, str(uuid.uuid4()))
+        # A shard with no members extracts nothing, not even the directory.
+        os.makedirs(tmp)
+        shard.explode(tmp, workers)
+        size = _tree_size(tmp)
+
+        with self._locked() as state:
+            try:
+                os.rename(tmp, self.path(sha))
+            except OSError, e:
+                if e.errno not in [errno.EEXIST, errno.ENOTEMPTY]:
+                    raise
+                # Somebody else extracted it first.
+                shutil.rmtree(tmp)
+                return False
+
+            self._account(state, sha, size)
+
+            if hold:
+                self._hold(state, sha)
+
+            self._evict(state)
+
+        return True
+
+    def load(self, sha, server=None):
+        """
+        Load the shard with the given SHA-1, downloading it from `server` into
+        the store first if we don't have it. Only the header is read, so this
+        is cheap for shards we already hold.
+        """
+        path = self.shard_path(sha)
+
+        try:
+            return Shard.load(path)
+        except IOError, e:
+            if e.errno != errno.ENOENT or server is None:
+                raise
+
+        tmp = os.path.join(self.tmp_dir, str(uuid.uuid4()))
+        digest = hashlib.sha1()
+
+        try:
+            src = server.get(sha)
+
+            if not hasattr(src, 'read'):
+                raise LayerError(sha + " is not a shard")
+
+            with open(tmp, 'wb') as f:
+                buf = 'a'
+                while len(buf) > 0:
+                    buf = src.read(1 << 20)
+                    digest.update(buf)
+                    f.write(buf)
+
+            if digest.hexdigest() != sha:
+                raise LayerError("Shard " + sha + " failed verification")
+
+            with self._locked() as state:
+                if not os.path.exists(path):
+                    os.rename(tmp, path)
+                    self._account(state, sha, os.path.getsize(path))
+        finally:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+
+        return Shard.load(path)
+
+    def fetch(self, sha, server, workers=None, hold=False):
+        """
+        Download the shard with the given SHA-1 from `server` and add it to
+        the store. `hold` and the result are as for `add`.
+        """
+        if sha in self:
+            return False
+
+        return self.add(sha, self.load(sha, server), workers, hold)
+
+    def acquire(self, sha, server=None, workers=None):
+        """
+        Mark a layer as in use by this process and return its path. If the
+        layer is missing and `server` is given it is fetched first, and held
+        from the moment it is added, so it can't be evicted before we have
+        it. Every acquire should be paired with a `release`.
+        """
+        while True:
+            with self._locked() as state:
+                if sha in self:
+                    self._hold(state, sha)
+                    return self.path(sha)
+
+            if server is None:
+                raise LayerError("No layer for " + sha)
+
+            # If somebody else adds it first, or it is evicted before we get
+            # the lock again, we go round again.
+            if self.fetch(sha, server, workers, hold=True):
+                return self.path(sha)
+
+    def release(self, sha):
+        """
+        Drop one reference to a layer taken by `acquire`.
+        """
+        with self._locked() as state:
+            try:
+                state[sha]['users'].remove(os.getpid())
+            except (KeyError, ValueError):
+                return
+
+            self._evict(state)
+
+    def _evict(self, state):
+        """
+        Remove unused layers, oldest first, until we are within budget. Must
+        be called with the lock held.
+        """
+        for entry in state.values():
+            entry['users'] = [x for x in entry['users'] if _pid_alive(x)]
+
+        if self.budget is None:
+            return
+
+        total = sum(x['size'] for x in state.values())
+        idle = [x for x in state if len(state[x]['users']) == 0]
+        idle.sort(key=lambda x: state[x]['atime'])
+
+        while total > self.budget and len(idle) > 0:
+            sha = idle.pop(0)
+            total -= state[sha]['size']
+            del state[sha]
+
+            if os.path.exists(self.shard_path(sha)):
+                os.unlink(self.shard_path(sha))
+
+            if sha in self:
+                trash = os.path.join(self.tmp_dir, str(uuid.uuid4()))
+                os.rename(self.path(sha), trash)
+                shutil.rmtree(trash)
+
+    def evict(self):
+        """
+        Bring the store within its size budget.
+        """
+        with self._locked() as state:
+            self._evict(state)
+
+    def _link_file(self, src, dst, method):
+        """
+        Place a single file from a layer at `dst`, remembering whether
+        reflinks work so we only find out once.
+        """
+        used = link_file(src, dst, method, self.reflink_ok != False)
+
+        if method in ["reflink", "clone"] and self.reflink_ok is None:
+            self.reflink_ok = used == "reflink"
+
+        return used
+
+    def materialize(self, sha, dest, method="clone"):
+        """
+        Populate `dest` with the contents of a layer, replacing anything
+        already there. By default files are reflinked where the filesystem
+        supports it and copied otherwise. Hard links share inodes with the
+        store, so only pass `method="reflink"` or `method="hardlink"` if
+        nothing will ever modify files under `dest`. FIFOs and device nodes
+        are made anew, and everything keeps its owner and group.
+        """
+        if method not in self.METHODS:
+            raise LayerError("Unknown materialize method '{}'".format(method))
+
+        src_root = self.path(sha)
+
+        for dirpath, dirnames, filenames in os.walk(src_root):
+            rel = os.path.relpath(dirpath, src_root)
+            target = os.path.normpath(os.path.join(dest, rel))
+
+            if os.path.islink(target) or not os.path.isdir(target):
+                if os.path.lexists(target):
+                    os.unlink(target)
+
+                # Other layers may be materializing into the same tree.
+                try:
+                    os.makedirs(target)
+                except OSError, e:
+                    if e.errno != errno.EEXIST:
+                        raise
+
+            _chown(target, os.lstat(dirpath))
+            shutil.copystat(dirpath, target)
+
+            for name in dirnames + filenames:
+                src = os.path.join(dirpath, name)
+                dst = os.path.join(target, name)
+                st = os.lstat(src)
+
+                if stat.S_ISDIR(st.st_mode):
+                    continue
+
+                if os.path.isdir(dst) and not os.path.islink(dst):
+                    shutil.rmtree(dst)
+                elif os.path.lexists(dst):
+                    os.unlink(dst)
+
+                if stat.S_ISLNK(st.st_mode):
+                    os.symlink(os.readlink(src), dst)
+                    _chown(dst, st)
+                    continue
+
+                if stat.S_ISREG(st.st_mode):
+                    self._link_file(src, dst, method)
+                else:
+                    _make_node(dst, st)
+
+                # Changing the owner clears set-id bits, so the mode goes on
+                # after it.
+                _chown(dst, st)
+                os.chmod(dst, stat.S_IMODE(st.st_mode))
+                os.utime(dst, (st.st_atime, st.st_mtime))
+
+    def mount_overlay(self, shas, target, upper, work):
+        """
+        Mount an overlayfs at `target` with the given layers as lower
+        directories, the first being the top-most, and `upper` and `work` as
+        the writable upper and work directories. Requires root.
+        """
+        lower = ":".join(self.path(x) for x in shas)
+        options = "lowerdir={},upperdir={},workdir={}".format(lower, upper,
+                work)
+
+        if subprocess.call(["mount", "-t", "overlay", "overlay", "-o",
+            options, target]) != 0:
+            raise LayerError("Could not mount overlay at " + target)
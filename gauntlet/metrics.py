@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014 Casey Dahlin
+#
+# This file is part of Gauntlet.
+#
+# Gauntlet is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# Gauntlet is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# Gauntlet.  If not, see <http://www.gnu.org/licenses/>.
+
+import bisect
+import threading
+
+__all__ = ["Metrics"]
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+        30, 60)
+
+SIZE_BUCKETS = tuple(1 << x for x in range(10, 36, 2))
+
+def _number(value):
+    """
+    Format a sample value the way Prometheus reads it.
+    """
+    if isinstance(value, float):
+        if value == float("inf"):
+            return "+Inf"
+        return repr(value)
+
+    return str(value)
+
+def _labels(labels):
+    """
+    Format a sorted tuple of (name, value) label pairs.
+    """
+    if len(labels) == 0:
+        return ""
+
+    return "{" + ",".join('{}="{}"'.format(name, str(value).replace('\\',
+        '\\\\').replace('"', '\\"').replace('\n', '\\n')) for name, value in
+        labels) + "}"
+
+class Metrics(object):
+    """
+    Counters, gauges and histograms, rendered in the Prometheus text format.
+    Each metric is described once and then updated by name, with its labels
+    as keyword arguments. An update is a lock and a dict lookup, cheap
+    enough to make on every request.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.kinds = {}
+        self.values = {}
+
+    def describe(self, name, kind, description, buckets=LATENCY_BUCKETS):
+        """
+        Declare a metric. `kind` is "counter", "gauge" or "histogram", and
+        histograms count observations into the given upper `buckets`.
+        """
+        self.kinds[name] = (kind, description, tuple(buckets))
+
+    def inc(self, name, amount=1, **labels):
+        """
+        Add to a counter or gauge.
+        """
+        key = (name, tuple(sorted(labels.items())))
+
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def set(self, name, value, **labels):
+        """
+        Set a gauge.
+        """
+        with self.lock:
+            self.values[(name, tuple(sorted(labels.items())))] = value
+
+    def observe(self, name, value, **labels):
+        """
+        Count an observation into a histogram.
+        """
+        buckets = self.kinds[name][2]
+        key = (name, tuple(sorted(labels.items())))
+
+        with self.lock:
+            counts = self.values.get(key)
+
+            if counts is None:
+                # A count per bucket, then +Inf, then the sum.
+                counts = self.values[key] = [0] * (len(buckets) + 1) + [0]
+
+            counts[bisect.bisect_left(buckets, value)] += 1
+            counts[-1] += value
+
+    def render(self):
+        """
+        Get every metric in the Prometheus text exposition format.
+        """
+        with self.lock:
+            values = sorted((key, list(value) if isinstance(value, list) else
+                value) for key, value in self.values.iteritems())
+
+        out = []
+        described = set()
+
+        for (name, labels), value in values:
+            kind, description, buckets = self.kinds[name]
+
+            if name not in described:
+                described.add(name)
+                out.append("# HELP {} {}\n".format(name, description))
+                out.append("# TYPE {} {}\n".format(name, kind))
+
+            if kind != "histogram":
+                out.append("{}{} {}\n".format(name, _labels(labels),
+                    _number(value)))
+                continue
+
+            total = 0
+
+            for bound, count in zip(buckets + (float("inf"),), value[:-1]):
+                total += count
+                out.append("{}_bucket{} {}\n".format(name, _labels(labels +
+                    (("le", _number(float(bound))),)), total))
+
+            out.append("{}_sum{} {}\n".format(name, _labels(labels),
+                _number(value[-1])))
+            out.append("{}_count{} {}\n".format(name, _labels(labels), total))
+
+        return "".join(out)
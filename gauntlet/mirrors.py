@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014 Casey Dahlin
+#
+# This file is part of Gauntlet.
+#
+# Gauntlet is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# Gauntlet is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# Gauntlet.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import shutil
+import threading
+import time
+import Queue
+import git as Git
+
+__all__ = ["MirrorQueue", "index_repo"]
+
+def index_repo(index, repo_id, repo):
+    """
+    Add the commits of a registered repository that aren't indexed yet.
+    """
+    heads = repo.git.for_each_ref('--format=%(objectname)').split()
+    old = index.heads(repo_id)
+
+    try:
+        if len(old):
+            shas = repo.git.rev_list('--all', '--not', *old).split()
+        else:
+            shas = repo.git.rev_list('--all').split()
+    except Git.GitCommandError:
+        # Our old heads were pruned, so start over.
+        shas = repo.git.rev_list('--all').split()
+
+    index.add_commits(repo_id, shas, heads)
+
+class _Job(object):
+    """
+    One clone or refresh of a repository. `state` goes from "queued" to
+    "running" to "done" or "failed", in which case `error` says why.
+    """
+
+    def __init__(self, job_id, url):
+        self.id = job_id
+        self.url = url
+        self.state = "queued"
+        self.error = None
+        self.finished = None
+
+class MirrorQueue(object):
+    """
+    Clones and refreshes of the git repositories registered with a server,
+    run in the background by a pool of `workers` threads so no request waits
+    on git. Mirrors are bare clones in numbered directories under `gitroot`,
+    and their commits are recorded in a GitIndex. Refreshing fetches the
+    repository and indexes only the commits that are new since last time.
+
+    Asking for a repository that already has a job queued gets that job
+    rather than a new one. Hints, which clients send for repositories they
+    might use, only refresh a repository last refreshed more than
+    `min_interval` seconds ago. The last `keep` finished jobs are remembered
+    so their outcome can be looked up. If `metrics` is a Metrics, finished
+    jobs are counted and timed in it.
+    """
+
+    def __init__(self, gitroot, index, workers=4, min_interval=5 * 60,
+            keep=1000, metrics=None):
+        self.gitroot = gitroot
+        self.index = index
+        self.metrics = metrics
+        self.min_interval = min_interval
+        self.keep = keep
+        self.lock = threading.Lock()
+        self.queue = Queue.Queue()
+        self.jobs = {}
+        self.queued = {}
+        self.refreshed = {}
+        self.url_locks = {}
+        self.next_id = 1
+
+        for i in range(workers):
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+
+    def submit(self, url):
+        """
+        Queue a clone of `url`, or a refresh if it is already registered.
+        Returns the id of the job.
+        """
+        with self.lock:
+            job = self.queued.get(url)
+
+            if job is not None:
+                return job.id
+
+            job = _Job(self.next_id, url)
+            self.next_id += 1
+            self.jobs[job.id] = job
+            self.queued[url] = job
+
+        self.queue.put(job)
+        return job.id
+
+    def hint(self, url):
+        """
+        Queue a refresh of a registered repository unless it was refreshed
+        within the minimum interval. Returns the id of the job, or None if
+        no refresh is needed or the repository isn't registered.
+        """
+        if self.index.repo(url) is None:
+            return None
+
+        with self.lock:
+            if time.time() - self.refreshed.get(url, 0) < self.min_interval:
+                return None
+
+        return self.submit(url)
+
+    def job(self, job_id):
+        """
+        Get a job by its id, or None if we don't know of it.
+        """
+        return self.jobs.get(job_id)
+
+    def _allocate(self):
+        """
+        Create a fresh numbered directory for a new mirror.
+        """
+        with self.lock:
+            numbers = set(int(x) for x in os.listdir(self.gitroot) if
+                    os.path.isdir(os.path.join(self.gitroot, x)))
+
+            idx = 0
+
+            while idx in numbers:
+                idx += 1
+
+            gitdir = os.path.join(self.gitroot, str(idx))
+            os.mkdir(gitdir)
+            return gitdir
+
+    def _mirror(self, url):
+        """
+        Clone or refresh the repository at `url` and index its new commits.
+        """
+        known = self.index.repo(url)
+
+        if known is not None:
+            repo_id, gitdir = known
+            repo = Git.Repo(gitdir)
+            repo.git.fetch(url, '+refs/heads/*:refs/heads/*',
+                    '+refs/tags/*:refs/tags/*')
+            index_repo(self.index, repo_id, repo)
+            return
+
+        gitdir = self._allocate()
+
+        try:
+            repo = Git.Repo.clone_from(url, gitdir, bare=True)
+        except Exception:
+            shutil.rmtree(gitdir, ignore_errors=True)
+            raise
+
+        index_repo(self.index, self.index.add_repo(url, gitdir), repo)
+
+    def _work(self):
+        """
+        Run jobs from the queue forever. Jobs for the same repository run
+        one at a time.
+        """
+        while True:
+            job = self.queue.get()
+
+            with self.lock:
+                # From here on, asking again needs a new job to see any
+                # commits pushed after our fetch starts.
+                if self.queued.get(job.url) is job:
+                    del self.queued[job.url]
+
+                job.state = "running"
+                url_lock = self.url_locks.setdefault(job.url,
+                        threading.Lock())
+
+            with url_lock:
+                start = time.time()
+                kind = "fetch" if self.index.repo(job.url) else "clone"
+
+                try:
+                    self._mirror(job.url)
+                    state = "done"
+                except Exception, e:
+                    # Anything could go wrong with a remote repository, and
+                    # a worker that dies shrinks the pool for good.
+                    job.error = str(e)
+                    state = "failed"
+
+            if self.metrics is not None:
+                self.metrics.inc("gauntlet_git_jobs_total", kind=kind,
+                        state=state)
+                self.metrics.observe("gauntlet_git_job_seconds",
+                        time.time() - start, kind=kind)
+
+            with self.lock:
+                job.state = state
+                job.finished = time.time()
+                self.refreshed[job.url] = job.finished
+                self._forget()
+
+    def _forget(self):
+        """
+        Drop the oldest finished jobs beyond the `keep` most recent. Must be
+        called with the lock held.
+        """
+        finished = sorted((x.finished, x.id) for x in self.jobs.values() if
+                x.finished is not None)
+
+        for finished_at, job_id in finished[:max(len(finished) - self.keep,
+            0)]:
+            del self.jobs[job_id]
@@ -0,0 +1,732 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014 Casey Dahlin
+#
+# This file is part of Gauntlet.
+#
+# Gauntlet is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# Gauntlet is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# Gauntlet.  If not, see <http://www.gnu.org/licenses/>.
+
+import errno
+import hashlib
+import os
+import re
+import struct
+import uuid
+import zlib
+import chunker
+from fsutil import prune_dir
+from packs import PackSet
+
+__all__ = ["ObjectStore", "ObjectStoreError", "ObjectStoreBusyError",
+        "sha_re"]
+
+# Objects are named by their SHA-1 in lower case hex, and nothing else.
+sha_re = re.compile(r'^[0-9a-f]{40}$')
+
+class ObjectStoreError(Exception):
+    """
+    An exception indicating an object or chunk could not be stored.
+    """
+    pass
+
+class ObjectStoreBusyError(ObjectStoreError):
+    """
+    An exception indicating the packs are being rewritten by someone else, so
+    the operation should be retried later.
+    """
+    pass
+
+def _makedirs(path):
+    """
+    Create a directory and its parents unless it already exists.
+    """
+    try:
+        os.makedirs(path)
+    except OSError, e:
+        if e.errno != errno.EEXIST:
+            raise
+
+def _listdir(path):
+    """
+    List a directory, which is empty if it has been pruned.
+    """
+    try:
+        return os.listdir(path)
+    except OSError, e:
+        if e.errno != errno.ENOENT:
+            raise
+        return []
+
+def _rename(src, dst):
+    """
+    Rename `src` to `dst`, creating the fan-out directory `dst` goes in. Once
+    empty, that directory can be pruned at any time, so it is made again if
+    it disappears under us.
+    """
+    while True:
+        _makedirs(os.path.dirname(dst))
+
+        try:
+            os.rename(src, dst)
+            return
+        except OSError, e:
+            if e.errno != errno.ENOENT or not os.path.exists(src):
+                raise
+
+_pack_sets = {}
+
+def _fan_out(root, sha):
+    """
+    Path of a content-addressed file under a two-hex-char fan-out directory.
+    """
+    return os.path.join(root, sha[0:2], sha[2:])
+
+class _RecipeReader(object):
+    """
+    File-like object reading a chunked object back from its chunks.
+    """
+
+    def __init__(self, store, recipe, offset=0):
+        self.store = store
+        self.recipe = list(recipe)
+        self.current = None
+
+        while len(self.recipe) and offset >= self.recipe[0][1]:
+            offset -= self.recipe.pop(0)[1]
+
+        if len(self.recipe) and offset > 0:
+            sha, length = self.recipe.pop(0)
+            self.current = open(self.store.chunk_path(sha), 'rb')
+            self.current.seek(offset)
+
+    def read(self, size=-1):
+        ret = []
+
+        while size != 0:
+            if self.current is None:
+                if len(self.recipe) == 0:
+                    break
+
+                sha, length = self.recipe.pop(0)
+                self.current = open(self.store.chunk_path(sha), 'rb')
+
+            buf = self.current.read(size)
+
+            if len(buf) == 0:
+                self.current.close()
+                self.current = None
+                continue
+
+            ret.append(buf)
+
+            if size > 0:
+                size -= len(buf)
+
+        return "".join(ret)
+
+    def close(self):
+        if self.current is not None:
+            self.current.close()
+
+# A gzip member header with one extra field, "GS", holding the size of the
+# uncompressed content, which the gzip trailer only gives modulo 2**32.
+_GZIP_HEADER = struct.Struct("<4sIBBH2sHQ")
+_GZIP_MAGIC = "\x1f\x8b\x08\x04"
+
+def _gzip(src, dest, size, level=6):
+    """
+    Compress `size` bytes read from the file-like object `src` into a gzip
+    file at `dest`.
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    crc = 0
+
+    with open(dest, 'wb') as out:
+        out.write(_GZIP_HEADER.pack(_GZIP_MAGIC, 0, 0, 255, 12, "GS", 8,
+            size))
+
+        buf = 'a'
+        while len(buf) > 0:
+            buf = src.read(1 << 16)
+            crc = zlib.crc32(buf, crc)
+            out.write(compressor.compress(buf))
+
+        out.write(compressor.flush())
+        out.write(struct.pack("<II", crc & 0xffffffff, size & 0xffffffff))
+
+def _gzip_size(path):
+    """
+    Get the uncompressed size recorded in a gzip file we wrote, or None if
+    there is no such file.
+    """
+    try:
+        with open(path, 'rb') as f:
+            header = f.read(_GZIP_HEADER.size)
+    except IOError, e:
+        if e.errno != errno.ENOENT:
+            raise
+        return None
+
+    magic, mtime, xfl, os_type, xlen, field, length, size = \
+            _GZIP_HEADER.unpack(header)
+
+    if magic != _GZIP_MAGIC or field != "GS":
+        raise ObjectStoreError("Bad compressed object " + path)
+
+    return size
+
+class _GzipReader(object):
+    """
+    File-like object decompressing a gzip stream read from `f`, starting
+    `offset` bytes into the uncompressed content.
+    """
+
+    def __init__(self, f, offset=0):
+        self.f = f
+        self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self.buf = ""
+        self.eof = False
+
+        while offset > 0:
+            skipped = len(self.read(min(offset, 1 << 20)))
+
+            if skipped == 0:
+                break
+
+            offset -= skipped
+
+    def read(self, size=-1):
+        while (size < 0 or len(self.buf) < size) and not self.eof:
+            data = self.decompressor.unconsumed_tail
+
+            if len(data) == 0:
+                data = self.f.read(1 << 16)
+
+            if len(data) == 0:
+                self.buf += self.decompressor.flush()
+                self.eof = True
+            else:
+                # Bounded, so a highly compressible object can't balloon.
+                self.buf += self.decompressor.decompress(data, 1 << 20)
+
+        if size < 0:
+            size = len(self.buf)
+
+        ret = self.buf[:size]
+        self.buf = self.buf[size:]
+        return ret
+
+    def close(self):
+        self.f.close()
+
+class ObjectStore(object):
+    """
+    The on-disk content-addressable store behind a gauntlet server.
+
+    Objects live at `root/xx/yyyy...`, named by their SHA-1. In chunked mode
+    `chunk_loose` later splits newly stored objects into content-defined
+    chunks, which are stored once each under `root/chunks/xx/yyyy...`, and
+    the object is kept as a recipe listing its chunks at
+    `root/xx/yyyy....recipe`. Objects stored either way can be read back
+    either way.
+
+    Small objects can be moved into packs under `root/packs` by `repack`,
+    after which they are read from there. Fan-out directories are removed
+    once nothing is left in them.
+
+    With `compress` set, whole objects that gzip well are stored compressed
+    at `root/xx/yyyy....gz`, still named by the SHA-1 of their content, and
+    decompressed as they are read. The compressed file can also be served
+    as is to clients that accept gzip.
+    """
+
+    # Objects are only kept compressed if that saves at least this much.
+    COMPRESS_RATIO = 0.9
+
+    def __init__(self, root, chunked=False, compress=False):
+        self.root = root
+        self.chunked = chunked
+        self.compress = compress
+        self.chunk_root = os.path.join(root, "chunks")
+
+        pack_root = os.path.join(root, "packs")
+
+        if pack_root not in _pack_sets:
+            _pack_sets[pack_root] = PackSet(pack_root)
+
+        self.packs = _pack_sets[pack_root]
+
+    def path(self, sha):
+        """
+        Where the whole object with the given SHA-1 lives, if stored whole.
+        """
+        return _fan_out(self.root, sha)
+
+    def recipe_path(self, sha):
+        """
+        Where the recipe for a chunked object lives.
+        """
+        return self.path(sha) + ".recipe"
+
+    def compressed_path(self, sha):
+        """
+        Where the object with the given SHA-1 lives, if stored compressed.
+        """
+        return self.path(sha) + ".gz"
+
+    def chunk_path(self, sha):
+        """
+        Where the chunk with the given SHA-1 lives.
+        """
+        return _fan_out(self.chunk_root, sha)
+
+    def tmp_path(self):
+        """
+        A fresh temporary path on the same filesystem as the store.
+        """
+        return os.path.join(self.root, str(uuid.uuid4()))
+
+    def recipe(self, sha):
+        """
+        Get the (chunk SHA-1, size) list for a chunked object, or None if it
+        isn't stored chunked.
+        """
+        try:
+            with open(self.recipe_path(sha), 'r') as f:
+                return [(x, int(y)) for x, y in
+                        (line.split() for line in f)]
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            return None
+
+    def size(self, sha):
+        """
+        Size of the object with the given SHA-1, or None if we don't have it.
+        """
+        try:
+            return os.path.getsize(self.path(sha))
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+
+        size = _gzip_size(self.compressed_path(sha))
+
+        if size is not None:
+            return size
+
+        recipe = self.recipe(sha)
+
+        if recipe is not None:
+            return sum(x[1] for x in recipe)
+
+        packed = self.packs.find(sha)
+
+        if packed is None:
+            return None
+
+        return packed[2]
+
+    def __contains__(self, sha):
+        return self.size(sha) is not None
+
+    def open(self, sha, offset=0):
+        """
+        Open the object with the given SHA-1 for reading, starting `offset`
+        bytes in. Raises IOError if we don't have it.
+        """
+        try:
+            f = open(self.path(sha), 'rb')
+            f.seek(offset)
+            return f
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                raise
+
+        try:
+            return _GzipReader(open(self.compressed_path(sha), 'rb'), offset)
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                raise
+
+        recipe = self.recipe(sha)
+
+        if recipe is not None:
+            return _RecipeReader(self, recipe, offset)
+
+        packed = self.packs.find(sha)
+
+        if packed is None:
+            raise IOError(errno.ENOENT, "No such object", sha)
+
+        pack, start, size = packed
+        offset = min(offset, size)
+        return pack.open(start + offset, size - offset)
+
+    def open_file(self, sha, offset=0):
+        """
+        Open the file holding the object with the given SHA-1, positioned
+        `offset` bytes into the object, so it can be sent with sendfile.
+        Returns (file, bytes of the object left from there), or None if the
+        object isn't stored whole in one file, as chunked and compressed
+        objects aren't. Raises IOError if we don't have it.
+        """
+        try:
+            f = open(self.path(sha), 'rb')
+            f.seek(offset)
+            return f, max(os.fstat(f.fileno()).st_size - offset, 0)
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                raise
+
+        if os.path.exists(self.compressed_path(sha)) or \
+                self.recipe(sha) is not None:
+            return None
+
+        packed = self.packs.find(sha)
+
+        if packed is None:
+            raise IOError(errno.ENOENT, "No such object", sha)
+
+        pack, start, size = packed
+        offset = min(offset, size)
+
+        try:
+            # Our own descriptor, since the pack's is shared between threads.
+            f = open(pack.path + ".pack", 'rb')
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            # Repacked away; the mapping still reads fine.
+            return None
+
+        f.seek(start + offset)
+        return f, size - offset
+
+    def open_compressed(self, sha):
+        """
+        Open the gzip file of an object stored compressed. Returns (file,
+        compressed size), or None if the object isn't stored compressed.
+        """
+        try:
+            f = open(self.compressed_path(sha), 'rb')
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            return None
+
+        return f, os.fstat(f.fileno()).st_size
+
+    def loose(self):
+        """
+        Generate (SHA-1, path) for every object stored whole.
+        """
+        for prefix in os.listdir(self.root):
+            if len(prefix) != 2 or not os.path.isdir(os.path.join(self.root,
+                prefix)):
+                continue
+
+            for name in _listdir(os.path.join(self.root, prefix)):
+                if len(name) == 38 and not name.endswith(".recipe"):
+                    yield prefix + name, os.path.join(self.root, prefix, name)
+
+    def recipes(self):
+        """
+        Generate (SHA-1, recipe path) for every object stored chunked.
+        """
+        for prefix in os.listdir(self.root):
+            if len(prefix) != 2 or not os.path.isdir(os.path.join(self.root,
+                prefix)):
+                continue
+
+            for name in _listdir(os.path.join(self.root, prefix)):
+                if len(name) == 45 and name.endswith(".recipe"):
+                    yield (prefix + name[:-7], os.path.join(self.root, prefix,
+                        name))
+
+    def compressed(self):
+        """
+        Generate (SHA-1, path) for every object stored compressed.
+        """
+        for prefix in os.listdir(self.root):
+            if len(prefix) != 2 or not os.path.isdir(os.path.join(self.root,
+                prefix)):
+                continue
+
+            for name in _listdir(os.path.join(self.root, prefix)):
+                if len(name) == 41 and name.endswith(".gz"):
+                    yield (prefix + name[:-3], os.path.join(self.root, prefix,
+                        name))
+
+    def chunks(self):
+        """
+        Generate (SHA-1, path) for every stored chunk.
+        """
+        if not os.path.isdir(self.chunk_root):
+            return
+
+        for prefix in os.listdir(self.chunk_root):
+            for name in _listdir(os.path.join(self.chunk_root, prefix)):
+                yield prefix + name, os.path.join(self.chunk_root, prefix, name)
+
+    def shas(self):
+        """
+        Generate the SHA-1 of every object we have, however it is stored.
+        """
+        for sha, path in self.loose():
+            yield sha
+
+        for sha, path in self.compressed():
+            yield sha
+
+        for sha, path in self.recipes():
+            yield sha
+
+        self.packs.refresh()
+
+        for pack in self.packs.packs.values():
+            for sha, offset, size in pack:
+                yield sha
+
+    def touch(self, sha):
+        """
+        Mark an object as just referred to, so garbage collection treats it
+        as newly stored. Packed objects can't be touched one at a time, so
+        their whole pack is. Returns False if we don't have the object.
+        """
+        for path in [self.path(sha), self.compressed_path(sha),
+                self.recipe_path(sha)]:
+            try:
+                os.utime(path, None)
+                return True
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+
+        return self.packs.touch(sha)
+
+    def delete(self, sha):
+        """
+        Remove an object, however it is stored. Chunks it used are left for
+        garbage collection. Returns False if we didn't have it. Raises
+        ObjectStoreBusyError if it is packed and another repack is running.
+        """
+        found = False
+
+        for path in [self.path(sha), self.compressed_path(sha),
+                self.recipe_path(sha)]:
+            try:
+                os.unlink(path)
+                found = True
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+
+        prune_dir(os.path.dirname(self.path(sha)))
+
+        if self.packs.find(sha) is not None:
+            if not self.packs.remove([sha]):
+                raise ObjectStoreBusyError("Packs are being rewritten")
+            found = True
+
+        return found
+
+    def repack(self, threshold, max_packs=16):
+        """
+        Move whole objects smaller than `threshold` bytes into a pack. Returns
+        False if a repack was already running.
+        """
+        small = []
+
+        for sha, path in self.loose():
+            try:
+                if os.path.getsize(path) < threshold:
+                    small.append((sha, path))
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+
+        if len(small) == 0:
+            return True
+
+        return self.packs.repack(small, max_packs)
+
+    def add(self, stream):
+        """
+        Store the content of a file-like object and return its SHA-1.
+        """
+        tmp = self.tmp_path()
+        sha = hashlib.sha1()
+
+        with open(tmp, 'wb') as output:
+            buf = 'a'
+            while len(buf) > 0:
+                buf = stream.read(1 << 16)
+                sha.update(buf)
+                output.write(buf)
+
+        sha = sha.hexdigest()
+        self.add_file(tmp, sha)
+        return sha
+
+    def add_file(self, tmp, sha):
+        """
+        Move a file we already know the SHA-1 of into the store. In
+        compressed mode it is compressed if that is worth it. In chunked mode
+        it is stored whole, to be split into chunks by `chunk_loose` later.
+        If we already have the object it is touched instead.
+        """
+        if self.touch(sha):
+            os.unlink(tmp)
+            return
+
+        if self.chunked or not self.compress or \
+                not self._add_compressed(tmp, sha):
+            _rename(tmp, self.path(sha))
+
+    def chunk_loose(self, min_size=chunker.MAX_SIZE):
+        """
+        Split whole objects of at least `min_size` bytes into chunks and keep
+        them as recipes. Chunking runs at Python speed, so chunked stores do
+        it in the background rather than while a client waits for an object
+        to be stored. Returns the number of objects chunked.
+        """
+        count = 0
+
+        for sha, path in self.loose():
+            recipe = []
+
+            try:
+                if os.path.getsize(path) < min_size:
+                    continue
+
+                with open(path, 'rb') as f:
+                    for chunk in chunker.chunks(f):
+                        chunk_sha = hashlib.sha1(chunk).hexdigest()
+                        self.add_chunk(chunk_sha, chunk)
+                        recipe.append((chunk_sha, len(chunk)))
+            except (OSError, IOError), e:
+                if e.errno != errno.ENOENT:
+                    raise
+                # Packed or deleted while we looked.
+                continue
+
+            # The recipe goes in first, so the object is never missing.
+            self._write_recipe(sha, recipe)
+
+            try:
+                os.unlink(path)
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+
+            count += 1
+
+        return count
+
+    def _add_compressed(self, tmp, sha):
+        """
+        Store the file at `tmp` compressed and remove it, unless compressing
+        it doesn't save enough to be worth it. Returns whether we did.
+        """
+        size = os.path.getsize(tmp)
+        gz = self.tmp_path()
+
+        with open(tmp, 'rb') as src:
+            _gzip(src, gz, size)
+
+        if os.path.getsize(gz) >= size * self.COMPRESS_RATIO:
+            os.unlink(gz)
+            return False
+
+        _rename(gz, self.compressed_path(sha))
+        os.unlink(tmp)
+        return True
+
+    def _write_recipe(self, sha, recipe):
+        """
+        Atomically store a recipe.
+        """
+        tmp = self.tmp_path()
+
+        with open(tmp, 'w') as f:
+            for chunk_sha, size in recipe:
+                f.write("{} {}\n".format(chunk_sha, size))
+
+        _rename(tmp, self.recipe_path(sha))
+
+    def missing_chunks(self, shas):
+        """
+        Filter a list of chunk SHA-1s down to those we don't have. Those we
+        do have are touched, so garbage collection leaves them for the recipe
+        about to use them.
+        """
+        missing = []
+
+        for sha in shas:
+            try:
+                os.utime(self.chunk_path(sha), None)
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+                missing.append(sha)
+
+        return missing
+
+    def add_chunk(self, sha, data):
+        """
+        Store one chunk, verifying it matches its SHA-1.
+        """
+        if hashlib.sha1(data).hexdigest() != sha:
+            raise ObjectStoreError("Chunk does not match " + sha)
+
+        path = self.chunk_path(sha)
+
+        try:
+            os.utime(path, None)
+            return
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+
+        tmp = self.tmp_path()
+
+        with open(tmp, 'wb') as f:
+            f.write(data)
+
+        _rename(tmp, path)
+
+    def add_recipe(self, sha, recipe):
+        """
+        Store an object given as a list of (chunk SHA-1, size) pairs, all of
+        which we must already have. The chunks are read back to check they
+        really make up the object.
+        """
+        missing = self.missing_chunks([x[0] for x in recipe])
+
+        if len(missing):
+            raise ObjectStoreError("Missing {} chunks".format(len(missing)))
+
+        recipe = [(x, os.path.getsize(self.chunk_path(x))) for x, y in recipe]
+        digest = hashlib.sha1()
+        reader = _RecipeReader(self, recipe)
+
+        buf = 'a'
+        while len(buf) > 0:
+            buf = reader.read(1 << 16)
+            digest.update(buf)
+
+        if digest.hexdigest() != sha:
+            raise ObjectStoreError("Chunks do not make up " + sha)
+
+        if not self.touch(sha):
+            self._write_recipe(sha, recipe)
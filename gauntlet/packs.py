@@ -0,0 +1,404 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014 Casey Dahlin
+#
+# This file is part of Gauntlet.
+#
+# Gauntlet is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# Gauntlet is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# Gauntlet.  If not, see <http://www.gnu.org/licenses/>.
+
+import binascii
+import errno
+import fcntl
+import hashlib
+import mmap
+import os
+import struct
+import threading
+import uuid
+from fsutil import prune_dir
+
+__all__ = ["Pack", "PackSet", "PackError"]
+
+class PackError(Exception):
+    """
+    An exception indicating a pack file is corrupt.
+    """
+    pass
+
+class _PackReader(object):
+    """
+    File-like object reading one object out of a mapped pack.
+    """
+
+    def __init__(self, data, offset, size):
+        self.data = data
+        self.pos = offset
+        self.end = offset + size
+
+    def read(self, size=-1):
+        if size < 0 or self.pos + size > self.end:
+            size = self.end - self.pos
+
+        buf = self.data[self.pos:self.pos + size]
+        self.pos += size
+        return buf
+
+    def close(self):
+        pass
+
+class Pack(object):
+    """
+    Many small objects stored in one file. `name.pack` holds the objects'
+    content back to back, and `name.idx` is a header followed by a record of
+    (binary SHA-1, offset, size) for each object, sorted by SHA-1. Both are
+    mapped into memory, so looking an object up is a binary search over the
+    mapped index without reading it in.
+    """
+
+    MAGIC = "gauntpk"
+    VERSION = 1
+    HEADER = struct.Struct(">7sBI")
+    RECORD = struct.Struct(">20sQQ")
+
+    def __init__(self, path):
+        """
+        Open the pack at `path`, given without the .idx/.pack suffix.
+        """
+        self.path = path
+
+        with open(path + ".idx", 'rb') as f:
+            self.index = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, self.count = self.HEADER.unpack_from(self.index, 0)
+
+        if magic != self.MAGIC or version != self.VERSION:
+            raise PackError("Bad pack index " + path + ".idx")
+
+        if len(self.index) != self.HEADER.size + self.count * \
+                self.RECORD.size:
+            raise PackError("Truncated pack index " + path + ".idx")
+
+        self.file = open(path + ".pack", 'rb')
+        self.fd = self.file.fileno()
+
+        if os.fstat(self.fd).st_size:
+            self.data = mmap.mmap(self.fd, 0, access=mmap.ACCESS_READ)
+        else:
+            self.data = ""
+
+    def _record(self, i):
+        """
+        Get the (binary SHA-1, offset, size) of the i'th object.
+        """
+        return self.RECORD.unpack_from(self.index,
+                self.HEADER.size + i * self.RECORD.size)
+
+    def lookup(self, sha):
+        """
+        Get the (offset, size) of an object in the pack, or None.
+        """
+        try:
+            key = binascii.unhexlify(sha)
+        except TypeError:
+            return None
+
+        lo = 0
+        hi = self.count
+
+        while lo < hi:
+            mid = (lo + hi) // 2
+            found, offset, size = self._record(mid)
+
+            if found == key:
+                return offset, size
+            if found < key:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        return None
+
+    def __iter__(self):
+        """
+        Generate (hex SHA-1, offset, size) for every object in the pack.
+        """
+        for i in range(self.count):
+            key, offset, size = self._record(i)
+            yield binascii.hexlify(key), offset, size
+
+    def open(self, offset, size):
+        """
+        Get a file-like object reading the object at `offset`.
+        """
+        return _PackReader(self.data, offset, size)
+
+    @classmethod
+    def write(cls, path, objects):
+        """
+        Write a pack at `path` from a list of (hex SHA-1, size, opener)
+        tuples, where calling `opener` gives a file-like object with the
+        content. The index goes in last, so a pack is never seen half
+        written.
+        """
+        objects = sorted(objects)
+        records = []
+        offset = 0
+        tmp = path + "." + str(uuid.uuid4())
+
+        with open(tmp, 'wb') as f:
+            for sha, size, opener in objects:
+                digest = hashlib.sha1()
+                left = size
+                src = opener()
+
+                try:
+                    while left > 0:
+                        buf = src.read(min(left, 1 << 20))
+
+                        if len(buf) == 0:
+                            raise PackError("Object " + sha + " is truncated")
+
+                        digest.update(buf)
+                        f.write(buf)
+                        left -= len(buf)
+                finally:
+                    src.close()
+
+                if digest.hexdigest() != sha:
+                    raise PackError("Object " + sha + " is corrupt")
+
+                records.append(cls.RECORD.pack(binascii.unhexlify(sha),
+                    offset, size))
+                offset += size
+
+            f.flush()
+            os.fsync(f.fileno())
+
+        os.rename(tmp, path + ".pack")
+
+        with open(tmp, 'wb') as f:
+            f.write(cls.HEADER.pack(cls.MAGIC, cls.VERSION, len(records)))
+            f.write("".join(records))
+            f.flush()
+            os.fsync(f.fileno())
+
+        os.rename(tmp, path + ".idx")
+
+class PackSet(object):
+    """
+    All the packs in a directory. Packs are opened once and kept; when an
+    object isn't found we look for new packs before giving up, since a
+    repack may have moved it.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.packs = {}
+        self.lock = threading.Lock()
+
+    def refresh(self):
+        """
+        Open packs that have appeared and forget those that have gone.
+        """
+        try:
+            names = set(x[:-4] for x in os.listdir(self.root) if
+                    x.endswith(".idx"))
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            names = set()
+
+        with self.lock:
+            for name in list(self.packs):
+                if name not in names:
+                    del self.packs[name]
+
+            for name in names:
+                if name not in self.packs:
+                    self.packs[name] = Pack(os.path.join(self.root, name))
+
+    def find(self, sha):
+        """
+        Get the (pack, offset, size) of an object, or None.
+        """
+        for retry in [False, True]:
+            if retry:
+                self.refresh()
+
+            for pack in self.packs.values():
+                found = pack.lookup(sha)
+
+                if found is not None:
+                    return (pack,) + found
+
+        return None
+
+    def touch(self, sha):
+        """
+        Bring forward the modification time of the pack holding an object,
+        which garbage collection takes as when its objects were stored.
+        Returns False if no pack holds the object.
+        """
+        while True:
+            found = self.find(sha)
+
+            if found is None:
+                return False
+
+            try:
+                os.utime(found[0].path + ".idx", None)
+                return True
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+                # Repacked away, so look again.
+                self.refresh()
+
+    def _lock(self):
+        """
+        Take the lock that keeps two processes from rewriting packs at once.
+        Returns the locked file, or None if someone else holds it.
+        """
+        try:
+            os.makedirs(self.root)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+
+        lock = open(os.path.join(self.root, "lock"), 'w')
+
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError, e:
+            lock.close()
+            if e.errno not in [errno.EAGAIN, errno.EACCES]:
+                raise
+            return None
+
+        return lock
+
+    def repack(self, loose, max_packs=16):
+        """
+        Move the loose objects in `loose`, a list of (hex SHA-1, path) pairs,
+        into a new pack and delete them. If that would leave more than
+        `max_packs` packs, the existing packs are merged into the new one.
+        Only one repack runs at a time; returns False if another is already
+        running.
+        """
+        lock = self._lock()
+
+        if lock is None:
+            return False
+
+        try:
+            self.refresh()
+            old = []
+
+            if len(self.packs) + 1 > max_packs:
+                old = self.packs.values()
+
+            self._repack(loose, old)
+        finally:
+            lock.close()
+
+        return True
+
+    def remove(self, shas):
+        """
+        Rewrite the packs holding any of the given objects without them.
+        Returns False if another repack is running.
+        """
+        lock = self._lock()
+
+        if lock is None:
+            return False
+
+        try:
+            self.refresh()
+            shas = set(shas)
+            old = [x for x in self.packs.values() if
+                    any(x.lookup(y) is not None for y in shas)]
+
+            self._repack([], old, shas)
+        finally:
+            lock.close()
+
+        return True
+
+    def _repack(self, loose, old, exclude=()):
+        """
+        Write a pack of the given loose objects and the contents of the packs
+        in `old`, leaving out anything in `exclude`, then delete the loose
+        objects, and any directories they leave empty, and the old packs. The
+        new pack takes the modification time of
+        the newest thing that went into it, so garbage collection sees its
+        objects as no older than they were.
+        """
+        objects = {}
+        path = None
+
+        for pack in old:
+            for sha, offset, size in pack:
+                if sha not in exclude:
+                    objects[sha] = (sha, size, lambda p=pack, o=offset,
+                            s=size: p.open(o, s))
+
+        for sha, loose_path in loose:
+            try:
+                size = os.path.getsize(loose_path)
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+                continue
+
+            objects[sha] = (sha, size, lambda p=loose_path: open(p, 'rb'))
+
+        if len(objects):
+            name = hashlib.sha1("".join(sorted(objects))).hexdigest()
+            path = os.path.join(self.root, "pack-" + name)
+            Pack.write(path, objects.values())
+            newest = 0
+
+            for src in [x.path + ".idx" for x in old] + [x[1] for x in loose]:
+                try:
+                    newest = max(newest, os.path.getmtime(src))
+                except OSError, e:
+                    if e.errno != errno.ENOENT:
+                        raise
+
+            os.utime(path + ".idx", (newest, newest) if newest else None)
+
+        for pack in old:
+            if pack.path == path:
+                continue
+
+            os.unlink(pack.path + ".idx")
+            os.unlink(pack.path + ".pack")
+
+        emptied = set()
+
+        for sha, loose_path in loose:
+            if sha not in objects:
+                continue
+
+            try:
+                os.unlink(loose_path)
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+
+            emptied.add(os.path.dirname(loose_path))
+
+        for directory in emptied:
+            prune_dir(directory)
+
+        self.refresh()
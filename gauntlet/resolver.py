@@ -0,0 +1,311 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014 Casey Dahlin
+#
+# This file is part of Gauntlet.
+#
+# Gauntlet is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# Gauntlet is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# Gauntlet.  If not, see <http://www.gnu.org/licenses/>.
+
+import errno
+import os
+import shutil
+from multiprocessing.pool import ThreadPool
+from server import ServerError
+
+__all__ = ["Resolver", "ComposePlan", "ComposeError", "LayerConflictError"]
+
+class ComposeError(Exception):
+    """
+    An exception indicating the compose graph of a shard can't be applied.
+    """
+    pass
+
+class LayerConflictError(ComposeError):
+    """
+    Exception indicating two shards, neither of which depends on the other,
+    both provide or modify the same path.
+    """
+    def __init__(self, conflicts):
+        self.conflicts = conflicts
+        lines = ["{}: {} and {}".format(path, a, b) for (path, a, b) in
+                conflicts[:10]]
+
+        if len(conflicts) > 10:
+            lines += ["... and {} more".format(len(conflicts) - 10)]
+
+        ComposeError.__init__(self, "Conflicting layers:\n" + "\n".join(lines))
+
+def _norm(path):
+    """
+    Normalize a path from a shard so paths from tar members, drop lists and
+    chmod lists compare equal.
+    """
+    return os.path.normpath("/" + path).lstrip("/")
+
+class ComposePlan(object):
+    """
+    The resolved compose closure of one or more shards. `order` lists every
+    shard SHA-1 so each comes after everything it composes, `shards` maps
+    SHA-1s to loaded Shard objects and `levels` groups the order into runs of
+    shards that don't depend on each other.
+    """
+
+    def __init__(self, order, shards):
+        self.order = order
+        self.shards = shards
+        self.deps = {}
+
+        level_of = {}
+        for sha in order:
+            level_of[sha] = max([level_of[x] + 1 for x in
+                shards[sha].compose] + [0])
+
+        self.levels = [[] for x in range(max(level_of.values() + [-1]) + 1)]
+        for sha in order:
+            self.levels[level_of[sha]].append(sha)
+
+    def ancestors(self, sha):
+        """
+        Everything the given shard composes, directly or indirectly.
+        """
+        if sha in self.deps:
+            return self.deps[sha]
+
+        found = set()
+        for dep in self.shards[sha].compose:
+            found.add(dep)
+            found |= self.ancestors(dep)
+
+        self.deps[sha] = found
+        return found
+
+    def indexed(self, shas):
+        """
+        Check whether all the given shards have a member index.
+        """
+        return all(self.shards[x].members is not None for x in shas)
+
+    def hashes(self):
+        """
+        Map the normalized path of each regular file the plan lays down to the
+        SHA-1 of its content, as far as the member indexes tell us. Paths
+        from shards without an index may hide earlier ones, so nothing before
+        such a shard is reported.
+        """
+        found = {}
+
+        for sha in self.order:
+            shard = self.shards[sha]
+
+            if shard.members is None:
+                found = {}
+                continue
+
+            for item in shard.drop_list:
+                path = _norm(item)
+                found.pop(path, None)
+
+                for key in [x for x in found if x.startswith(path + "/")]:
+                    del found[key]
+
+            for member in shard.members:
+                path = _norm(member.path)
+
+                if member.isreg():
+                    found[path] = member.sha
+                else:
+                    found.pop(path, None)
+
+        return found
+
+    def conflicts(self):
+        """
+        Find paths touched by two shards neither of which composes the other.
+        Returns a list of (path, sha, sha) tuples. Directories present in
+        several layers are not conflicts unless one of them replaces the
+        directory with something else. Shards without a member index are only
+        checked through their drop and chmod lists.
+        """
+        touched = {}
+
+        for sha in self.order:
+            shard = self.shards[sha]
+
+            for member in shard.members or []:
+                touched.setdefault(_norm(member.path), []).append((sha,
+                    member.isdir()))
+
+            for path in list(shard.drop_list) + shard.chmod_list.keys():
+                touched.setdefault(_norm(path), []).append((sha, False))
+
+        found = []
+
+        for path in sorted(touched):
+            users = touched[path]
+
+            for i in range(len(users)):
+                for j in range(i + 1, len(users)):
+                    (a, a_dir), (b, b_dir) = users[i], users[j]
+
+                    if a == b or (a_dir and b_dir):
+                        continue
+
+                    if a in self.ancestors(b) or b in self.ancestors(a):
+                        continue
+
+                    found.append((path, a, b))
+
+        return found
+
+class Resolver(object):
+    """
+    Resolves the compose lists of shards into their full dependency graph and
+    lays the result down in a directory, using a LayerStore to hold the
+    exploded shards.
+    """
+
+    def __init__(self, server, layers, jobs=8):
+        """
+        Create a resolver fetching from `server` into the LayerStore `layers`.
+        Up to `jobs` shards are fetched or applied at once.
+        """
+        self.server = server
+        self.layers = layers
+        self.jobs = jobs
+
+    def resolve(self, roots):
+        """
+        Walk the compose closure of the given shard SHA-1s and return a
+        ComposePlan for it. If the server can tell us the whole closure up
+        front, every shard in it is fetched at once. Otherwise each round
+        fetches every newly discovered shard concurrently.
+        """
+        shards = {}
+        frontier = list(roots)
+        pool = ThreadPool(self.jobs)
+
+        try:
+            closure = self.server.closure(roots)
+        except ServerError:
+            closure = []
+
+        try:
+            if len(closure):
+                frontier = [x[0] for x in closure]
+                shards = dict(zip(frontier, pool.map(lambda x:
+                    self.layers.load(x, self.server), frontier)))
+                frontier = [x for x in set(y for shard in shards.values() for
+                    y in shard.compose) if x not in shards]
+
+            while len(frontier):
+                loaded = pool.map(lambda x: self.layers.load(x, self.server),
+                        frontier)
+                found = []
+
+                for sha, shard in zip(frontier, loaded):
+                    shards[sha] = shard
+
+                    for dep in shard.compose:
+                        if dep not in shards and dep not in found:
+                            found.append(dep)
+
+                frontier = [x for x in found if x not in shards]
+        finally:
+            pool.close()
+            pool.join()
+
+        order = []
+        visiting = set()
+
+        def visit(sha):
+            if sha in order:
+                return
+            if sha in visiting:
+                raise ComposeError("Compose cycle through " + sha)
+
+            visiting.add(sha)
+            for dep in shards[sha].compose:
+                visit(dep)
+            visiting.remove(sha)
+            order.append(sha)
+
+        for sha in roots:
+            visit(sha)
+
+        return ComposePlan(order, shards)
+
+    def _prepare(self, shard, path):
+        """
+        Apply a shard's drop and chmod lists to the tree at `path`.
+        """
+        for item in shard.drop_list:
+            target = os.path.join(path, _norm(item))
+
+            if os.path.isdir(target) and not os.path.islink(target):
+                shutil.rmtree(target)
+                continue
+
+            try:
+                os.unlink(target)
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+
+        for item, mod in shard.chmod_list.iteritems():
+            target = os.path.join(path, _norm(item))
+
+            # Don't change the mode of a file shared with the layer store.
+            if os.path.isfile(target) and os.stat(target).st_nlink > 1:
+                shutil.copy2(target, target + ".gauntlet-tmp")
+                os.rename(target + ".gauntlet-tmp", target)
+
+            os.chmod(target, mod)
+
+    def apply(self, plan, path, method="clone"):
+        """
+        Lay down the shards in `plan` at `path`. Path conflicts are checked
+        before anything is touched. Layers are then extracted into the store
+        concurrently and linked into place one level at a time, each shard's
+        drop and chmod lists being applied just before its contents. Shards
+        within a level don't depend on each other, so they are linked in
+        concurrently too.
+        """
+        conflicts = plan.conflicts()
+        if len(conflicts):
+            raise LayerConflictError(conflicts)
+
+        pool = ThreadPool(self.jobs)
+        acquired = []
+
+        def acquire(sha):
+            self.layers.acquire(sha, self.server, 1)
+            acquired.append(sha)
+
+        try:
+            pool.map(acquire, plan.order)
+
+            for level in plan.levels:
+                for sha in level:
+                    self._prepare(plan.shards[sha], path)
+
+                link = lambda x: self.layers.materialize(x, path, method)
+
+                if plan.indexed(level):
+                    pool.map(link, level)
+                else:
+                    map(link, level)
+        finally:
+            pool.close()
+            pool.join()
+
+            for sha in acquired:
+                self.layers.release(sha)
@@ -15,108 +15,1025 @@
 # You should have received a copy of the GNU General Public License along with
 # Gauntlet.  If not, see <http://www.gnu.org/licenses/>.
 
-from flask import Flask, abort, request, send_file, redirect
+from flask import Flask, Response, abort, request, redirect, g
+from werkzeug.wsgi import wrap_file
+from argparse import ArgumentParser
+from multiprocessing.pool import ThreadPool
 import re
 import os
-import uuid
+import errno
 import hashlib
+import itertools
 import shutil
+import struct
 import requests
-import git as Git
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.exceptions import HTTPError as UrllibError
+from requests.packages.urllib3.util.retry import Retry
+import sys
+import threading
+import time
+import chunker
+from objects import ObjectStore, ObjectStoreError, ObjectStoreBusyError, \
+        sha_re, _GzipReader
+from gitindex import GitIndex
+from uploads import UploadSessions, UploadError
+from packs import PackError
+from fsutil import prune_dir
+from headers import HeaderIndex
+from mirrors import MirrorQueue
+from metrics import Metrics, SIZE_BUCKETS
 
-__all__ = ["app", "Server"]
+__all__ = ["app", "Server", "main"]
 
-sha_re = re.compile(r'[a-zA-Z0-9]{40}')
+range_re = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+BULK_FRAME = ">40sQ"
 
 app = Flask(__name__)
 
-git_redirs = {}
+git_indexes = {}
+header_indexes = {}
+indexes_lock = threading.Lock()
+upstreams = {}
+pulls = {}
+pulls_lock = threading.Lock()
+mirror_queues = {}
+mirror_queues_lock = threading.Lock()
+
+metrics = Metrics()
+metrics.describe("gauntlet_requests_total", "counter",
+        "Requests handled, by route, method and status.")
+metrics.describe("gauntlet_request_seconds", "histogram",
+        "Time from receiving a request to starting the response, by route.")
+metrics.describe("gauntlet_requests_in_flight", "gauge",
+        "Requests being handled.")
+metrics.describe("gauntlet_received_bytes_total", "counter",
+        "Request body bytes received, by route.")
+metrics.describe("gauntlet_sent_bytes_total", "counter",
+        "Response body bytes sent, by route.")
+metrics.describe("gauntlet_object_requests_total", "counter",
+        "Object requests by result: hit, miss, git redirect or upstream pull.")
+metrics.describe("gauntlet_object_size_bytes", "histogram",
+        "Sizes of objects retrieved and sent.", SIZE_BUCKETS)
+metrics.describe("gauntlet_git_jobs_total", "counter",
+        "Finished git mirror clones and fetches, by state.")
+metrics.describe("gauntlet_git_job_seconds", "histogram",
+        "Time taken by git mirror clones and fetches.")
+metrics.describe("gauntlet_git_jobs_queued", "gauge",
+        "Git mirror jobs waiting for a worker.")
+metrics.describe("gauntlet_uploads_in_flight", "gauge",
+        "Unfinished multi-part upload sessions.")
+metrics.describe("gauntlet_upload_bytes_in_flight", "gauge",
+        "Bytes received for unfinished upload sessions.")
+metrics.describe("gauntlet_upload_largest_bytes", "gauge",
+        "Bytes received for the largest unfinished upload session.")
+metrics.describe("gauntlet_disk_size_bytes", "gauge",
+        "Size of the filesystem holding the objects directory.")
+metrics.describe("gauntlet_disk_free_bytes", "gauge",
+        "Free space on the filesystem holding the objects directory.")
+
+def object_store():
+    """
+    Get the object store for our configured objects directory. Setting
+    GAUNTLET_CHUNKED lets a background job split new objects into
+    deduplicated chunks, and GAUNTLET_COMPRESS stores them gzipped where
+    that helps.
+    """
+    return ObjectStore(app.config["GAUNTLET_OBJECTS_DIR"],
+            app.config.get("GAUNTLET_CHUNKED", False),
+            app.config.get("GAUNTLET_COMPRESS", False))
+
+def upload_sessions():
+    """
+    Get the upload sessions in progress. GAUNTLET_UPLOAD_TTL sets how many
+    seconds an idle session lives.
+    """
+    root = os.path.join(app.config["GAUNTLET_OBJECTS_DIR"], "uploads")
+    return UploadSessions(root, app.config.get("GAUNTLET_UPLOAD_TTL",
+        24 * 60 * 60))
+
+def request_range(sha, size):
+    """
+    Work out which bytes of an object of `size` bytes the current request
+    wants. Returns (start, end) with `end` inclusive, or None for the whole
+    object. Only single ranges are supported; anything else gets the whole
+    object. Objects never change, so the SHA-1 is a strong ETag to check
+    If-Range against. Raises ValueError if the range can't be satisfied.
+    """
+    header = request.headers.get('Range')
+
+    if header is None:
+        return None
+
+    if_range = request.headers.get('If-Range')
+
+    if if_range is not None and if_range.strip('"') != sha:
+        return None
+
+    match = range_re.match(header.strip())
+
+    if match is None:
+        return None
+
+    first, last = match.groups()
+
+    if first == '':
+        if last == '' or int(last) == 0:
+            raise ValueError("Empty suffix range")
+
+        return max(size - int(last), 0), size - 1
+
+    start = int(first)
+    end = size - 1
+
+    if last != '':
+        end = min(int(last), end)
+
+    if start > end:
+        raise ValueError("Unsatisfiable range")
+
+    return start, end
+
+def stream_object(store, sha, start, length):
+    """
+    Generate `length` bytes of an object starting at `start`.
+    """
+    reader = store.open(sha, start)
+
+    try:
+        while length > 0:
+            buf = reader.read(min(length, 1 << 16))
+
+            if len(buf) == 0:
+                break
+
+            length -= len(buf)
+            yield buf
+    finally:
+        reader.close()
+
+class _ObjectFile(object):
+    """
+    File-like object giving at most `length` bytes of an open file. WSGI
+    servers whose file_wrapper uses sendfile(2), such as gunicorn, send from
+    fileno() up to the response's Content-Length instead, so the bytes never
+    pass through Python.
+    """
+
+    def __init__(self, f, length):
+        self.f = f
+        self.left = length
+
+    def read(self, size=-1):
+        if size < 0 or size > self.left:
+            size = self.left
+
+        buf = self.f.read(size)
+        self.left -= len(buf)
+        return buf
+
+    def fileno(self):
+        return self.f.fileno()
+
+    def close(self):
+        self.f.close()
+
+def object_body(store, sha, start, length):
+    """
+    Get a response body of `length` bytes of an object starting at `start`.
+    Objects stored whole in one file, loose or packed, go to the WSGI
+    server's file_wrapper to be sent straight from the file. Chunked objects
+    are streamed.
+    """
+    try:
+        opened = store.open_file(sha, start)
+    except IOError, e:
+        if e.errno != errno.ENOENT:
+            raise
+        abort(404)
+
+    if opened is None:
+        return stream_object(store, sha, start, length)
+
+    f, left = opened
+    return wrap_file(request.environ, _ObjectFile(f, min(length, left)),
+            1 << 16)
+
+def compressed_response(store, sha, size):
+    """
+    Get a response sending an object stored compressed as it is, gzip
+    encoded, or None if it isn't stored compressed. The uncompressed size
+    goes in X-Gauntlet-Size.
+    """
+    opened = store.open_compressed(sha)
+
+    if opened is None:
+        return None
+
+    f, length = opened
+    response = Response(wrap_file(request.environ, _ObjectFile(f, length),
+        1 << 16), mimetype="application/octet-stream",
+        direct_passthrough=True)
+    response.headers['Content-Length'] = str(length)
+    response.headers['Content-Encoding'] = "gzip"
+    response.headers['X-Gauntlet-Size'] = str(size)
+    return response
+
+def offload_object(store, sha):
+    """
+    Get a response telling a fronting web server to send a loose object
+    itself. GAUNTLET_OFFLOAD is "x-accel" for nginx, which is given a path
+    under the internal location GAUNTLET_OFFLOAD_PREFIX, or "x-sendfile" for
+    Apache's mod_xsendfile or lighttpd, which are given the file's path.
+    Returns None if offloading isn't configured.
+    """
+    mode = app.config.get("GAUNTLET_OFFLOAD")
+
+    if mode is None:
+        return None
+
+    response = Response("", mimetype="application/octet-stream")
+
+    if mode == "x-accel":
+        prefix = app.config.get("GAUNTLET_OFFLOAD_PREFIX", "/objects/")
+        response.headers['X-Accel-Redirect'] = prefix.rstrip('/') + \
+                "/{}/{}".format(sha[0:2], sha[2:])
+    else:
+        response.headers['X-Sendfile'] = os.path.abspath(store.path(sha))
+
+    return response
+
+def request_body():
+    """
+    Get a stream for the body of the current request. Werkzeug only gives us
+    bodies with a Content-Length, so for chunked requests we read the WSGI
+    input directly, which the server has already de-chunked.
+    """
+    if request.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+        return request.environ['wsgi.input']
+
+    return request.stream
+
+def git_index():
+    """
+    Get the index of commits in our registered git repositories.
+    """
+    gitroot = os.path.join(app.config["GAUNTLET_OBJECTS_DIR"], "git")
+
+    # Two threads creating the schema at once can fail with "database schema
+    # has changed".
+    with indexes_lock:
+        if gitroot not in git_indexes:
+            if not os.path.exists(gitroot):
+                os.makedirs(gitroot)
+
+            git_indexes[gitroot] = GitIndex(os.path.join(gitroot,
+                "index.sqlite"))
+
+    return git_indexes[gitroot]
+
+def header_index():
+    """
+    Get the cache of compose lists from the headers of our objects.
+    """
+    path = os.path.join(app.config["GAUNTLET_OBJECTS_DIR"], "headers.sqlite")
+
+    with indexes_lock:
+        if path not in header_indexes:
+            header_indexes[path] = HeaderIndex(path)
+
+    return header_indexes[path]
+
+def mirror_queue():
+    """
+    Get the background queue cloning and refreshing our git mirrors.
+    GAUNTLET_GIT_WORKERS sets how many run at once, and
+    GAUNTLET_GIT_INTERVAL how many seconds apart hints may refresh a
+    repository.
+    """
+    gitroot = os.path.join(app.config["GAUNTLET_OBJECTS_DIR"], "git")
+
+    with mirror_queues_lock:
+        if gitroot not in mirror_queues:
+            mirror_queues[gitroot] = MirrorQueue(gitroot, git_index(),
+                    app.config.get("GAUNTLET_GIT_WORKERS", 4),
+                    app.config.get("GAUNTLET_GIT_INTERVAL", 5 * 60),
+                    metrics=metrics)
+
+    return mirror_queues[gitroot]
+
+class _Pull(object):
+    """
+    An object being fetched from our upstream server into `tmp`. Requests
+    for it while the fetch runs all read from `tmp` as it grows, so each
+    object is fetched only once however many clients want it.
+    """
+
+    def __init__(self, tmp):
+        self.tmp = tmp
+        self.cond = threading.Condition()
+        self.ready = False
+        self.size = None
+        self.git_url = None
+        self.written = 0
+        self.done = False
+        self.failed = False
+
+    def update(self, **kwargs):
+        """
+        Change the state of the fetch and wake anyone waiting on it.
+        """
+        with self.cond:
+            for key, value in kwargs.iteritems():
+                setattr(self, key, value)
+            self.cond.notify_all()
+
+    def wait(self, condition):
+        """
+        Wait until `condition` holds, or the fetch is over.
+        """
+        with self.cond:
+            while not condition() and not self.done:
+                self.cond.wait(1)
+
+def upstream():
+    """
+    Get the server we pull objects through from in proxy mode, or None.
+    """
+    uri = app.config.get("GAUNTLET_UPSTREAM")
+
+    if uri is None:
+        return None
+
+    if uri not in upstreams:
+        upstreams[uri] = Server(uri)
+
+    return upstreams[uri]
+
+def pull(store, sha, fetch):
+    """
+    Fetch an object from upstream into the store, keeping `fetch` up to date
+    as we go.
+    """
+    try:
+        try:
+            src = upstream().get(sha)
+        except (ServerError, requests.RequestException):
+            fetch.update(failed=True)
+            return
+
+        if isinstance(src, GitResult):
+            fetch.update(git_url=src.url, ready=True)
+            return
+
+        # A gzip encoded response's Content-Length is its compressed size.
+        size = src.headers.get('x-gauntlet-size',
+                src.headers.get('content-length'))
+        digest = hashlib.sha1()
+
+        with open(fetch.tmp, 'wb') as out:
+            fetch.update(size=int(size) if size else None, ready=True)
+
+            buf = 'a'
+            while len(buf) > 0:
+                buf = src.read(1 << 16)
+                digest.update(buf)
+                out.write(buf)
+                out.flush()
+                fetch.update(written=fetch.written + len(buf))
+
+        if digest.hexdigest() == sha:
+            store.add_file(fetch.tmp, sha)
+        else:
+            os.unlink(fetch.tmp)
+            fetch.update(failed=True)
+    except Exception:
+        fetch.update(failed=True)
+        raise
+    finally:
+        with pulls_lock:
+            del pulls[sha]
+
+        fetch.update(done=True)
+
+def stream_pull(store, sha, fetch):
+    """
+    Generate the content of an object as it is pulled from upstream.
+    """
+    try:
+        f = open(fetch.tmp, 'rb')
+    except IOError, e:
+        if e.errno != errno.ENOENT:
+            raise
+        # Already finished and moved into the store.
+        f = store.open(sha)
+        fetch = None
+
+    try:
+        pos = 0
+
+        while True:
+            if fetch is not None:
+                fetch.wait(lambda: fetch.written > pos)
+
+            buf = f.read(1 << 16)
+
+            if len(buf) == 0:
+                if fetch is None or fetch.done:
+                    break
+                continue
+
+            pos += len(buf)
+            yield buf
+
+        if fetch is not None and fetch.failed:
+            raise ServerError("Pull of " + sha + " failed")
+    finally:
+        f.close()
+
+def retrieve_upstream(store, sha):
+    """
+    Serve an object we don't have by pulling it from upstream, joining the
+    pull already in flight if there is one.
+    """
+    with pulls_lock:
+        fetch = pulls.get(sha)
+
+        if fetch is None:
+            if sha in store:
+                return None
+
+            fetch = _Pull(store.tmp_path())
+            pulls[sha] = fetch
+            thread = threading.Thread(target=pull, args=(store, sha, fetch))
+            thread.daemon = True
+            thread.start()
+
+    fetch.wait(lambda: fetch.ready)
+
+    if fetch.git_url is not None:
+        response = app.make_response(redirect(fetch.git_url, 301))
+        response.headers['X-Gauntlet-Type'] = "git"
+        return response
+
+    if not fetch.ready:
+        abort(404)
+
+    response = Response(stream_pull(store, sha, fetch),
+            mimetype="application/octet-stream")
+
+    if fetch.size is not None:
+        response.headers['Content-Length'] = str(fetch.size)
+
+    response.set_etag(sha)
+    response.headers['X-Gauntlet-Type'] = "raw"
+    return response
+
+def evict_loose(store, budget):
+    """
+    Delete the least recently used loose objects until they take up no more
+    than `budget` bytes.
+    """
+    objects = []
+
+    for sha, path in itertools.chain(store.loose(), store.compressed()):
+        try:
+            st = os.stat(path)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            continue
+
+        objects.append((st.st_mtime, st.st_size, path))
+
+    objects.sort()
+    total = sum(x[1] for x in objects)
+
+    while total > budget and len(objects):
+        mtime, size, path = objects.pop(0)
+        total -= size
+
+        try:
+            os.unlink(path)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+
+        prune_dir(os.path.dirname(path))
+
+class _CountingInput(object):
+    """
+    Wrap a WSGI input stream, counting the bytes read from it, however the
+    body was framed.
+    """
+
+    def __init__(self, f):
+        self.f = f
+        self.count = 0
+
+    def read(self, *args):
+        buf = self.f.read(*args)
+        self.count += len(buf)
+        return buf
+
+    def readline(self, *args):
+        buf = self.f.readline(*args)
+        self.count += len(buf)
+        return buf
+
+    def readlines(self, *args):
+        lines = self.f.readlines(*args)
+        self.count += sum(len(x) for x in lines)
+        return lines
+
+    def __iter__(self):
+        return iter(self.readline, '')
+
+class _CountingBody(object):
+    """
+    Wrap a WSGI response iterable, counting the bytes the server takes from
+    it. `done` is called with the count when the server closes it.
+    """
+
+    def __init__(self, result, done):
+        self.result = result
+        self.done = done
+        self.sent = 0
+
+    def __iter__(self):
+        for buf in self.result:
+            self.sent += len(buf)
+            yield buf
+
+    def close(self):
+        try:
+            if hasattr(self.result, 'close'):
+                self.result.close()
+        finally:
+            self.done(self.sent)
+
+class _ByteCounter(object):
+    """
+    WSGI middleware counting the request body bytes the app actually reads
+    and the response body bytes actually sent, under the route `start_request`
+    notes in the environ. Responses the server sends through its own
+    file_wrapper are left alone so it can still use sendfile(2), and counted
+    by their Content-Length.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    def __call__(self, environ, start_response):
+        body = _CountingInput(environ['wsgi.input'])
+        environ['wsgi.input'] = body
+        length = []
+
+        def start(status, headers, exc_info=None):
+            length[:] = [int(v) for k, v in headers if
+                    k.lower() == "content-length"]
+            return start_response(status, headers, exc_info)
+
+        result = self.app(environ, start)
+        done = lambda sent: self.count(environ, body.count, sent)
+        wrapper = environ.get('wsgi.file_wrapper')
+
+        if isinstance(wrapper, type) and isinstance(result, wrapper):
+            done(sum(length))
+            return result
+
+        return _CountingBody(result, done)
+
+    def count(self, environ, received, sent):
+        route = environ.get('gauntlet.route', "unmatched")
+
+        if received:
+            metrics.inc("gauntlet_received_bytes_total", received,
+                    route=route)
+
+        if sent:
+            metrics.inc("gauntlet_sent_bytes_total", sent, route=route)
+
+app.wsgi_app = _ByteCounter(app.wsgi_app)
+
+def request_route():
+    """
+    Get the rule of the route the current request matched, for metrics.
+    """
+    return request.url_rule.rule if request.url_rule else "unmatched"
+
+@app.before_request
+def start_request():
+    """
+    Note when a request started, for its latency, and its route, for
+    `_ByteCounter`.
+    """
+    g.gauntlet_start = time.time()
+    request.environ['gauntlet.route'] = request_route()
+    metrics.inc("gauntlet_requests_in_flight")
+
+@app.after_request
+def count_request(response):
+    """
+    Count a request and its time under its route.
+    """
+    route = request_route()
+
+    g.gauntlet_counted = True
+    metrics.inc("gauntlet_requests_total", route=route,
+            method=request.method, status=response.status_code)
+    metrics.observe("gauntlet_request_seconds",
+            time.time() - g.gauntlet_start, route=route)
+
+    return response
+
+@app.teardown_request
+def finish_request(exc):
+    """
+    Take a finished request off the in-flight count. Requests that raised
+    may not have reached count_request, so they are counted as errors here.
+    """
+    metrics.inc("gauntlet_requests_in_flight", -1)
+
+    if exc is not None and not getattr(g, 'gauntlet_counted', False):
+        metrics.inc("gauntlet_requests_total", route=request_route(),
+                method=request.method, status=500)
+
+@app.route("/metrics")
+def metrics_text():
+    """
+    Get the server's metrics in the Prometheus text format. Disk space,
+    uploads in progress and the git job queue are sampled as we're asked.
+    """
+    objdir = app.config["GAUNTLET_OBJECTS_DIR"]
+    fs = os.statvfs(objdir)
+    metrics.set("gauntlet_disk_size_bytes", fs.f_blocks * fs.f_frsize)
+    metrics.set("gauntlet_disk_free_bytes", fs.f_bavail * fs.f_frsize)
+
+    sizes = [x[1] for x in upload_sessions().sessions()]
+    metrics.set("gauntlet_uploads_in_flight", len(sizes))
+    metrics.set("gauntlet_upload_bytes_in_flight", sum(sizes))
+    metrics.set("gauntlet_upload_largest_bytes", max(sizes or [0]))
+
+    metrics.set("gauntlet_git_jobs_queued", mirror_queue().queue.qsize())
+
+    return Response(metrics.render(),
+            content_type="text/plain; version=0.0.4; charset=utf-8")
 
 @app.route("/<sha>")
 def retrieve(sha):
     """
     Return an object from our database given its SHA-1 handle
     """
-    if sha in git_redirs.keys():
-        response = app.make_response(redirect(git_redirs[sha], 301))
+    if not sha_re.match(sha):
+        abort(404)
+
+    git_url = git_index().lookup(sha)
+
+    if git_url is not None:
+        metrics.inc("gauntlet_object_requests_total", result="git")
+        response = app.make_response(redirect(git_url, 301))
         response.headers['X-Gauntlet-Type'] = "git"
         return response
 
-    if not sha_re.match(sha):
+    store = object_store()
+    size = store.size(sha)
+
+    if size is None and upstream() is not None:
+        response = retrieve_upstream(store, sha)
+
+        if response is not None:
+            metrics.inc("gauntlet_object_requests_total", result="upstream")
+            return response
+
+        size = store.size(sha)
+
+    if size is None:
+        metrics.inc("gauntlet_object_requests_total", result="miss")
         abort(404)
 
-    obj_folder = app.config["GAUNTLET_OBJECTS_DIR"]
-    folder = sha[0:2]
-    obj = sha[2:]
+    metrics.inc("gauntlet_object_requests_total", result="hit")
+    metrics.observe("gauntlet_object_size_bytes", size, op="retrieve")
+
+    if upstream() is not None:
+        # Our LRU clock for eviction.
+        for path in [store.path(sha), store.compressed_path(sha)]:
+            if os.path.exists(path):
+                os.utime(path, None)
+
+    response = None
+
+    if os.path.exists(store.path(sha)):
+        # The fronting server handles ranges for offloaded objects.
+        response = offload_object(store, sha)
+
+    if response is None:
+        try:
+            byte_range = request_range(sha, size)
+        except ValueError:
+            response = app.make_response(("", 416))
+            response.headers['Content-Range'] = "bytes */{}".format(size)
+            return response
+
+        # Ranges are always of the uncompressed content.
+        if byte_range is None and request.accept_encodings['gzip'] > 0:
+            response = compressed_response(store, sha, size)
+
+    if response is None:
+        if byte_range is None:
+            start, end = 0, size - 1
+            status = 200
+        else:
+            start, end = byte_range
+            status = 206
+
+        response = Response(object_body(store, sha, start, end - start + 1),
+                status, mimetype="application/octet-stream",
+                direct_passthrough=True)
+        response.headers['Content-Length'] = str(end - start + 1)
+
+        if byte_range is not None:
+            response.headers['Content-Range'] = "bytes {}-{}/{}".format(
+                    start, end, size)
+
+    if response.headers.get('Content-Encoding') == "gzip":
+        # A different representation, so it can't share the plain ETag.
+        response.set_etag(sha + "-gzip")
+    else:
+        response.set_etag(sha)
+
+    response.headers['Vary'] = "Accept-Encoding"
+    response.headers['Accept-Ranges'] = "bytes"
+    response.headers['X-Gauntlet-Type'] = "raw"
+    return response
+
+@app.route("/<sha>", methods=["DELETE"])
+def delete(sha):
+    """
+    Remove an object. Only allowed if the server was started with deletion
+    enabled, for rebalancing a cluster. If its pack is being rewritten we
+    answer 503, so the client retries later.
+    """
+    if not app.config.get("GAUNTLET_ALLOW_DELETE") or not sha_re.match(sha):
+        abort(403)
 
-    path = os.path.join(obj_folder, folder, obj)
     try:
-        response = app.make_response(send_file(path))
-        response.headers['X-Gauntlet-Type'] = "raw"
+        found = object_store().delete(sha)
+    except ObjectStoreBusyError:
+        response = app.make_response(("", 503))
+        response.headers['Retry-After'] = "1"
         return response
-    except IOError:
+
+    if not found:
         abort(404)
 
+    return sha
+
+@app.route("/objects")
+def objects():
+    """
+    List every object we have as lines of "<sha>".
+    """
+    store = object_store()
+    return Response(("{}\n".format(x) for x in store.shas()),
+            mimetype="text/plain")
+
 @app.route("/", methods=["POST"])
 def send():
     """
     Place a new object into our database
     """
-    tmp_loc = os.path.join(app.config["GAUNTLET_OBJECTS_DIR"],
-            str(uuid.uuid4()))
-    output = open(tmp_loc, "w")
-    sha = hashlib.sha1()
+    store = object_store()
+    sha = store.add(request_body())
+    metrics.observe("gauntlet_object_size_bytes", store.size(sha), op="send")
+    return sha
 
-    buf = "a"
+@app.route("/have", methods=["POST"])
+def have():
+    """
+    Given a newline-separated list of SHA-1s, return lines of "<sha> <size>"
+    for the objects we have.
+    """
+    store = object_store()
+    found = []
 
-    while len(buf) > 0:
-        buf = request.stream.read(4096)
-        sha.update(buf)
-        output.write(buf)
+    for sha in request.data.split():
+        if not sha_re.match(sha):
+            continue
 
-    sha = sha.hexdigest()
-    output.close()
+        size = store.size(sha)
 
-    folder = os.path.join(app.config["GAUNTLET_OBJECTS_DIR"], sha[0:2])
-    path = os.path.join(folder, sha[2:])
+        # The client may now skip uploading it, so it must survive a
+        # collection that starts before the client refers to it.
+        if size is not None and store.touch(sha):
+            found.append("{} {}\n".format(sha, size))
+
+    return "".join(found)
+
+@app.route("/closure", methods=["POST"])
+def closure():
+    """
+    Given a newline-separated list of shard SHA-1s, return everything they
+    compose, directly or indirectly, as lines of "<sha> <size> <compose>..."
+    with each shard after everything it composes. Set `buildonly` in the
+    query string to follow compose-buildonly lists too.
+    """
+    store = object_store()
+    roots = [x for x in request.data.split() if sha_re.match(x)]
+    buildonly = request.args.get('buildonly') is not None
 
     try:
-        os.mkdir(folder)
-    except OSError:
-        pass
+        order = header_index().closure(store, roots, buildonly)
+    except KeyError, e:
+        return app.make_response(("\n".join(e.args[0]), 404))
+    except ValueError, e:
+        return app.make_response((str(e), 400))
+
+    return "".join("{} {}{}\n".format(sha, store.size(sha),
+        "".join(" " + x for x in deps)) for sha, deps in order)
+
+@app.route("/bulk", methods=["POST"])
+def bulk():
+    """
+    Given a newline-separated list of SHA-1s, stream back every one of them
+    we have in a single response. Each object is framed by its SHA-1 in hex
+    and its size as a 64-bit big-endian integer, followed by its content.
+    Objects we don't have are left out.
+    """
+    store = object_store()
+    shas = [x for x in request.data.split() if sha_re.match(x)]
+
+    def generate():
+        for sha in shas:
+            size = store.size(sha)
+
+            if size is None:
+                continue
+
+            yield struct.pack(BULK_FRAME, sha, size)
+
+            for buf in stream_object(store, sha, 0, size):
+                yield buf
+
+    return Response(generate(), mimetype="application/octet-stream")
+
+@app.route("/uploads", methods=["POST"])
+def upload_create():
+    """
+    Start a multi-part upload and return its session id.
+    """
+    return upload_sessions().create()
+
+@app.route("/uploads/<session>", methods=["GET"])
+def upload_parts(session):
+    """
+    List the parts of an upload we have, as lines of "<number> <size>".
+    """
+    try:
+        parts = upload_sessions().parts(session)
+    except UploadError:
+        abort(404)
+
+    return "".join("{} {}\n".format(x, y) for x, y in parts)
+
+@app.route("/uploads/<session>/<int:number>", methods=["PUT"])
+def upload_part(session, number):
+    """
+    Store one part of an upload and return its SHA-1.
+    """
+    try:
+        return upload_sessions().add_part(session, number, request_body())
+    except UploadError:
+        abort(404)
+
+@app.route("/uploads/<session>", methods=["POST"])
+def upload_commit(session):
+    """
+    Finish an upload, joining its parts into an object. The body may give
+    the SHA-1 the object should have.
+    """
+    sha = request.data.strip() or None
+    sessions = upload_sessions()
+
+    try:
+        sessions.path(session)
+    except UploadError:
+        abort(404)
+
+    try:
+        return sessions.commit(session, object_store(), sha)
+    except UploadError:
+        abort(400)
+
+@app.route("/uploads/<session>", methods=["DELETE"])
+def upload_abort(session):
+    """
+    Throw away an upload.
+    """
+    try:
+        upload_sessions().abort(session)
+    except UploadError:
+        abort(404)
+
+    return ""
+
+@app.route("/chunks", methods=["POST"])
+def chunks_missing():
+    """
+    Given a newline-separated list of chunk SHA-1s, return the ones we don't
+    have. Only available in chunked mode.
+    """
+    store = object_store()
+
+    if not store.chunked:
+        abort(404)
+
+    shas = [x for x in request.data.split() if sha_re.match(x)]
+    return "\n".join(store.missing_chunks(shas))
+
+@app.route("/chunks/<sha>", methods=["POST"])
+def chunk_send(sha):
+    """
+    Store a single chunk of a chunked object.
+    """
+    store = object_store()
+
+    if not store.chunked or not sha_re.match(sha):
+        abort(404)
+
+    try:
+        store.add_chunk(sha, request.data)
+    except ObjectStoreError:
+        abort(400)
+
+    return sha
+
+@app.route("/recipes/<sha>", methods=["POST"])
+def recipe_send(sha):
+    """
+    Store an object as a list of chunks we already have, given as lines of
+    "<chunk sha> <size>".
+    """
+    store = object_store()
 
-    shutil.move(tmp_loc, path)
+    if not store.chunked or not sha_re.match(sha):
+        abort(404)
+
+    recipe = [x.split() for x in request.data.splitlines() if x.strip()]
+
+    try:
+        store.add_recipe(sha, [(x, int(y)) for x, y in recipe])
+    except (ObjectStoreError, ValueError):
+        abort(400)
 
     return sha
 
 @app.route("/git", methods = ['POST'])
 def git():
     """
-    Add a new git repository to our list.
+    Add a new git repository to our list. If it is already registered, fetch
+    it and index only the new commits. The work happens in the background;
+    we return the id of the job doing it.
     """
-    objdir = app.config["GAUNTLET_OBJECTS_DIR"]
-    gitroot = os.path.join(objdir, "git")
+    if len(request.data.strip()) == 0:
+        abort(400)
+
+    return str(mirror_queue().submit(request.data.strip()))
 
-    if not os.path.exists(gitroot):
-        os.makedirs(gitroot)
+@app.route("/git/jobs/<int:job_id>")
+def git_job(job_id):
+    """
+    Get the state of a clone or refresh job: "queued", "running", "done",
+    or "failed" followed by the error on the next line.
+    """
+    job = mirror_queue().job(job_id)
 
-    numbers = [ int(x) for x in os.listdir(gitroot) if
-            os.path.isdir(os.path.join(gitroot,x)) ]
-    numbers.sort()
+    if job is None:
+        abort(404)
 
-    idx = 0
+    if job.error is not None:
+        return "{}\n{}\n".format(job.state, job.error)
 
-    while idx < len(numbers) and idx == numbers[idx]:
-        idx += 1
+    return job.state + "\n"
 
-    gitdir = os.path.join(gitroot, str(idx))
+@app.route("/git/hint", methods = ['POST'])
+def git_hint():
+    """
+    Take a list of URLs of git repositories a client might use, one per
+    line, and refresh those that are registered and haven't been refreshed
+    lately. Returns a line with the URL and job id for each refresh queued.
+    """
+    queue = mirror_queue()
+    out = []
 
-    repo = Git.Repo.clone_from(request.data, gitdir, bare=True)
+    for url in set(request.data.split()):
+        job_id = queue.hint(url)
 
-    for sha in repo.git.log('--pretty=%H').split():
-        git_redirs[sha] = request.data
+        if job_id is not None:
+            out.append("{} {}\n".format(url, job_id))
 
-    return str(idx)
+    return "".join(out)
 
 class ServerError(Exception):
     """
@@ -129,65 +1046,761 @@ class GitResult(object):
         self.sha = sha
         self.url = url
 
+class _FrameReader(object):
+    """
+    File-like object reading the content of one object in a bulk response.
+    """
+
+    def __init__(self, raw, size):
+        self.raw = raw
+        self.left = size
+
+    def read(self, size=-1):
+        if size < 0 or size > self.left:
+            size = self.left
+
+        ret = []
+
+        while size > 0:
+            buf = self.raw.read(size)
+
+            if len(buf) == 0:
+                raise ServerError("Bulk response ended early")
+
+            ret.append(buf)
+            size -= len(buf)
+            self.left -= len(buf)
+
+        return "".join(ret)
+
+    def drain(self):
+        """
+        Skip whatever the reader of this object didn't read.
+        """
+        while self.left > 0:
+            self.read(1 << 16)
+
+    def close(self):
+        pass
+
+class _ServerAdapter(HTTPAdapter):
+    """
+    Transport adapter which gives every request a default timeout.
+    """
+
+    def __init__(self, timeout, **kwargs):
+        self.timeout = timeout
+        HTTPAdapter.__init__(self, **kwargs)
+
+    def send(self, request, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.timeout
+
+        return HTTPAdapter.send(self, request, **kwargs)
+
+class _DecodedResponse(_GzipReader):
+    """
+    A gzip encoded response body, decoded as it is read. Like the raw
+    response, it carries the response's headers.
+    """
+
+    def __init__(self, raw):
+        super(_DecodedResponse, self).__init__(raw)
+        self.headers = raw.headers
+
 class Server(object):
     """
     A proxy object for a Gauntlet server
     """
-    def __init__(self, uri):
+    def __init__(self, uri, pool_size=16, retries=3, backoff=0.5,
+            timeout=(10, 300), cache=None):
         """
         Create a new proxy object for the gauntlet server at the given uri.
+        Connections are kept alive in a pool of up to `pool_size`, so one
+        proxy can be shared by everything talking to the server, from many
+        threads. Idempotent requests that fail to connect or get a 5xx error
+        from a proxy are retried up to `retries` times, backing off
+        exponentially by `backoff` seconds. `timeout` is a (connect, read)
+        pair of seconds. If `cache` is an ObjectCache, objects are served
+        from it when we have them and added to it when we download them.
         """
         if uri[-1] != '/':
             uri += '/'
 
         self.uri = uri
+        self.cache = cache
+
+        retry = Retry(total=retries, backoff_factor=backoff,
+                status_forcelist=[502, 503, 504], raise_on_status=False)
+        adapter = _ServerAdapter(timeout, pool_connections=pool_size,
+                pool_maxsize=pool_size, max_retries=retry)
+
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
 
     def get_size(self, sha):
         """
         Get the size of an object
         """
-        req = requests.head(self.uri + str(sha))
+        if self.cache is not None and sha in self.cache:
+            return os.path.getsize(self.cache.path(sha))
+
+        req = self.session.head(self.uri + str(sha),
+                headers={'Accept-Encoding': "identity"})
         return int(req.headers['content-length'])
 
-    def get(self, sha):
+    def have(self, shas, batch=10000):
         """
-        Fetch a hash from the gauntlet server
+        Ask which of the given objects the server has. Returns a dict of
+        SHA-1 to size for those it has, asking about up to `batch` at a time.
         """
-        req = requests.get(self.uri + str(sha), stream=True,
-                allow_redirects=False)
+        shas = list(shas)
+        found = {}
+
+        for i in range(0, len(shas), batch):
+            req = self.session.post(self.uri + 'have',
+                    data="\n".join(shas[i:i + batch]))
+
+            if req.status_code != requests.codes.ok:
+                raise ServerError("Could not query objects")
+
+            for line in req.text.splitlines():
+                sha, size = line.split()
+                found[str(sha)] = int(size)
+
+        return found
+
+    def closure(self, roots, buildonly=False):
+        """
+        Get the compose closure of the given shards from the server in one
+        request. Returns a list of (SHA-1, size, compose) tuples with every
+        shard after everything it composes.
+        """
+        params = {'buildonly': 1} if buildonly else {}
+        req = self.session.post(self.uri + 'closure', data="\n".join(roots),
+                params=params)
+
+        if req.status_code != requests.codes.ok:
+            raise ServerError("Could not get closure of " + " ".join(roots))
+
+        found = []
+
+        for line in req.text.splitlines():
+            fields = [str(x) for x in line.split()]
+            found.append((fields[0], int(fields[1]), fields[2:]))
+
+        return found
+
+    def get(self, sha, start=0, end=None):
+        """
+        Fetch a hash from the gauntlet server. If `start` or `end` are given,
+        only that range of bytes (`end` inclusive) is fetched. Whole objects
+        the server keeps compressed are sent gzipped and decoded as read.
+        """
+        headers = {'Accept-Encoding': "identity"}
+        whole = not start and end is None
+
+        if whole and self.cache is not None:
+            cached = self.cache.open(sha)
+
+            if cached is not None:
+                return cached
+
+        if whole:
+            headers['Accept-Encoding'] = "gzip"
+        else:
+            headers['Range'] = "bytes={}-{}".format(start,
+                    "" if end is None else end)
+            headers['If-Range'] = '"{}"'.format(sha)
+
+        req = self.session.get(self.uri + str(sha), stream=True,
+                allow_redirects=False, headers=headers)
 
         if req.status_code == requests.codes.moved and req.headers['X-Gauntlet-Type'] == 'git':
             return GitResult(req.headers['Location'], sha)
 
-        if req.status_code != requests.codes.ok:
+        if not whole and req.status_code != requests.codes.partial:
+            raise ServerError("Could not fetch range of " + sha + " from " +
+                    self.uri)
+
+        if req.status_code not in [requests.codes.ok, requests.codes.partial]:
             raise ServerError("Could not fetch " + sha + " from " + self.uri)
 
-        return req.raw
+        src = req.raw
+
+        if req.headers.get('Content-Encoding') == "gzip":
+            src = _DecodedResponse(req.raw)
+
+        if whole and self.cache is not None:
+            return self.cache.tee(sha, src)
+
+        return src
+
+    def get_many(self, shas):
+        """
+        Fetch many objects in one request. Generates (SHA-1, stream) pairs as
+        the objects arrive, leaving out any the server doesn't have. Each
+        stream is only good until the next pair is generated.
+        """
+        req = self.session.post(self.uri + 'bulk', data="\n".join(shas),
+                stream=True)
+
+        if req.status_code != requests.codes.ok:
+            raise ServerError("Could not fetch objects from " + self.uri)
+
+        frame_size = struct.calcsize(BULK_FRAME)
+
+        try:
+            while True:
+                frame = _FrameReader(req.raw, frame_size)
+
+                try:
+                    header = frame.read()
+                except ServerError:
+                    if frame.left == frame_size:
+                        break
+                    raise
+
+                sha, size = struct.unpack(BULK_FRAME, header)
+                stream = _FrameReader(req.raw, size)
+                yield sha, stream
+                stream.drain()
+        finally:
+            req.close()
+
+    def fetch(self, sha, path, connections=1, progress=None):
+        """
+        Download an object to `path`, verifying its SHA-1. Data goes to
+        `path`.part first, and if that is left over from an interrupted
+        download we resume from where it stopped. With `connections` above 1,
+        a fresh download is split into ranges fetched in parallel.
+        `progress`, if given, is called with the number of bytes we have so
+        far.
+        """
+        if self.cache is not None and self.cache.materialize(sha, path):
+            if progress:
+                progress(os.path.getsize(path))
+            return
+
+        part = path + ".part"
+
+        try:
+            have = os.path.getsize(part)
+        except OSError:
+            have = 0
+
+        if connections > 1 and have == 0:
+            digest = self._fetch_parallel(sha, part, connections, progress)
+        else:
+            digest = self._fetch_resume(sha, part, have, progress)
+
+        if digest.hexdigest() != sha:
+            os.unlink(part)
+            raise ServerError("Download of " + sha + " failed verification")
+
+        os.rename(part, path)
+
+        if self.cache is not None:
+            self.cache.add_path(sha, path)
+
+    def _fetch_resume(self, sha, part, have, progress):
+        """
+        Download an object into `part`, keeping the first `have` bytes that
+        are already there. Returns a SHA-1 hash object of the whole content.
+        """
+        digest = hashlib.sha1()
+
+        with open(part, 'ab+') as f:
+            f.seek(0)
+            f.truncate(have)
+
+            buf = 'a'
+            while len(buf) > 0:
+                buf = f.read(1 << 20)
+                digest.update(buf)
+
+            # A leftover part file may already be complete, and asking for
+            # an empty range would fail.
+            if have and have >= self.get_size(sha):
+                return digest
+
+            src = self.get(sha, have) if have else self.get(sha)
+
+            if isinstance(src, GitResult):
+                raise ServerError(sha + " is a git commit")
+
+            buf = 'a'
+            while len(buf) > 0:
+                buf = src.read(1 << 20)
+                digest.update(buf)
+                f.write(buf)
+                have += len(buf)
+
+                if progress:
+                    progress(have)
+
+        return digest
+
+    def _fetch_parallel(self, sha, part, connections, progress, retries=3):
+        """
+        Download an object into `part` as `connections` ranges at once. A
+        range that fails or comes up short is fetched again from where it
+        stopped, up to `retries` times. If that still doesn't give us the
+        object, we fall back to fetching it whole. Returns a SHA-1 hash
+        object of the content.
+        """
+        size = self.get_size(sha)
+        step = max(size // connections, 1 << 20)
+        ranges = [(x, min(x + step, size) - 1) for x in range(0, size, step)]
+        done = [0]
+        lock = threading.Lock()
+
+        with open(part, 'wb') as f:
+            f.truncate(size)
+
+        def fetch_range(byte_range):
+            start, end = byte_range
+
+            try:
+                src = self.get(sha, start, end)
+            except (ServerError, requests.RequestException):
+                return byte_range
+
+            if isinstance(src, GitResult):
+                raise ServerError(sha + " is a git commit")
+
+            with open(part, 'r+b') as f:
+                f.seek(start)
+
+                buf = 'a'
+                while len(buf) > 0 and start <= end:
+                    try:
+                        buf = src.read(min(1 << 20, end - start + 1))
+                    except (IOError, UrllibError, requests.RequestException):
+                        break
+
+                    f.write(buf)
+                    start += len(buf)
+
+                    with lock:
+                        done[0] += len(buf)
+                        if progress:
+                            progress(done[0])
+
+            if start <= end:
+                return start, end
+
+            return None
+
+        pool = ThreadPool(connections)
+
+        try:
+            for attempt in range(retries + 1):
+                ranges = [x for x in pool.map(fetch_range, ranges) if x]
+
+                if len(ranges) == 0:
+                    break
+        finally:
+            pool.close()
+            pool.join()
+
+        digest = hashlib.sha1()
+
+        if len(ranges) == 0:
+            with open(part, 'rb') as f:
+                buf = 'a'
+                while len(buf) > 0:
+                    buf = f.read(1 << 20)
+                    digest.update(buf)
+
+            if digest.hexdigest() == sha:
+                return digest
+
+        return self._fetch_resume(sha, part, 0, progress)
 
     def post(self, data_or_fd):
         """
         Put a new object on the gauntlet server
         """
-        req = requests.post(self.uri, data=data_or_fd)
+        req = self.session.post(self.uri, data=data_or_fd)
+
+        if req.status_code != requests.codes.ok:
+            raise ServerError("Could not post item")
+
+        return req.text
+
+    def upload(self, path, session=None, part_size=8 << 20, jobs=1,
+            retries=3, progress=None):
+        """
+        Put the file at `path` on the gauntlet server as a multi-part upload,
+        sending up to `jobs` parts at once. Each part is retried up to
+        `retries` times. If `session` names an unfinished upload of the same
+        file, parts the server already has are skipped. `progress`, if
+        given, is called with the number of bytes sent so far. The server
+        checks the parts make up the file before storing it. Returns the
+        SHA-1 of the object.
+        """
+        if session is None:
+            req = self.session.post(self.uri + 'uploads')
+
+            if req.status_code != requests.codes.ok:
+                raise ServerError("Could not start upload")
+
+            session = req.text
+            have = {}
+        else:
+            req = self.session.get(self.uri + 'uploads/' + session)
+
+            if req.status_code != requests.codes.ok:
+                raise ServerError("No upload session " + session)
+
+            have = dict(tuple(int(y) for y in x.split()) for x in
+                    req.text.splitlines())
+
+        size = os.path.getsize(path)
+        count = max((size + part_size - 1) // part_size, 1)
+        done = [0]
+        lock = threading.Lock()
+
+        def put(number):
+            length = min(part_size, size - number * part_size)
+
+            if have.get(number) != length:
+                with open(path, 'rb') as f:
+                    f.seek(number * part_size)
+                    data = f.read(length)
+
+                sha = hashlib.sha1(data).hexdigest()
+
+                for attempt in range(retries + 1):
+                    try:
+                        req = self.session.put(self.uri + 'uploads/' + session +
+                                '/' + str(number), data=data)
+
+                        if req.status_code == requests.codes.ok and \
+                                req.text == sha:
+                            break
+                    except (requests.ConnectionError, requests.Timeout):
+                        pass
+                else:
+                    raise ServerError("Could not send part {} of {}".format(
+                        number, path))
+
+            with lock:
+                done[0] += length
+                if progress:
+                    progress(done[0])
+
+        pool = ThreadPool(jobs)
+        digest = hashlib.sha1()
+
+        try:
+            sent = pool.map_async(put, range(count))
+
+            # Hash the whole file while the parts go out, so the server can
+            # check they make it up.
+            with open(path, 'rb') as f:
+                buf = 'a'
+                while len(buf) > 0:
+                    buf = f.read(1 << 20)
+                    digest.update(buf)
+
+            sent.get()
+        finally:
+            pool.close()
+            pool.join()
+
+        sha = digest.hexdigest()
+        req = self.session.post(self.uri + 'uploads/' + session, data=sha)
+
+        if req.status_code != requests.codes.ok:
+            raise ServerError("Could not finish upload of " + path)
+
+        if req.text != sha:
+            raise ServerError("Server stored " + path + " as " + req.text +
+                    " but we sent " + sha)
+
+        return sha
+
+    def post_chunked(self, f):
+        """
+        Put a new object on the gauntlet server, sending only the chunks of it
+        the server doesn't already have. `f` must be a seekable file. Falls
+        back to a plain post if the server doesn't store chunks.
+        """
+        whole = hashlib.sha1()
+        recipe = []
+        offset = 0
+
+        for chunk in chunker.chunks(f):
+            whole.update(chunk)
+            recipe.append((hashlib.sha1(chunk).hexdigest(), offset,
+                len(chunk)))
+            offset += len(chunk)
+
+        sha = whole.hexdigest()
+        req = self.session.post(self.uri + 'chunks',
+                data="\n".join(x[0] for x in recipe))
+
+        if req.status_code == requests.codes.not_found:
+            f.seek(0)
+            return self.post(f)
+
+        if req.status_code != requests.codes.ok:
+            raise ServerError("Could not query chunks")
+
+        missing = set(req.text.split())
+
+        for chunk_sha, offset, size in recipe:
+            if chunk_sha not in missing:
+                continue
+
+            missing.remove(chunk_sha)
+            f.seek(offset)
+            req = self.session.post(self.uri + 'chunks/' + chunk_sha,
+                    data=f.read(size))
+
+            if req.status_code != requests.codes.ok:
+                raise ServerError("Could not post chunk")
+
+        req = self.session.post(self.uri + 'recipes/' + sha,
+                data="".join("{} {}\n".format(x[0], x[2]) for x in recipe))
 
         if req.status_code != requests.codes.ok:
             raise ServerError("Could not post item")
 
         return req.text
 
+    def list(self):
+        """
+        Generate the SHA-1 of every object on the server.
+        """
+        req = self.session.get(self.uri + 'objects', stream=True)
+
+        if req.status_code != requests.codes.ok:
+            raise ServerError("Could not list objects on " + self.uri)
+
+        for line in req.iter_lines():
+            if line.strip():
+                yield str(line.strip())
+
+    def delete(self, sha):
+        """
+        Remove an object from the server, if it allows that.
+        """
+        req = self.session.delete(self.uri + str(sha))
+
+        if req.status_code not in [requests.codes.ok,
+                requests.codes.not_found]:
+            raise ServerError("Could not delete " + sha + " from " +
+                    self.uri)
+
     def git_post(self, giturl):
         """
         Register a new git repository with the gauntlet server. The server will
         redirect to the git repository when we query for the hashes of commits
-        therein.
+        therein. The server clones it in the background; we return the id of
+        the job, which git_job can check on.
         """
-        req = requests.post(self.uri + 'git', data=giturl)
+        req = self.session.post(self.uri + 'git', data=giturl)
 
         if req.status_code != requests.codes.ok:
             raise ServerError("Could not post git URL")
 
         return int(req.text)
 
+    def git_job(self, job_id):
+        """
+        Get the (state, error) of a clone or refresh job. The state is
+        "queued", "running", "done" or "failed", and the error is None unless
+        the job failed.
+        """
+        req = self.session.get(self.uri + 'git/jobs/' + str(job_id))
+
+        if req.status_code != requests.codes.ok:
+            raise ServerError("No git job " + str(job_id))
+
+        lines = req.text.splitlines()
+        return str(lines[0]), "\n".join(lines[1:]) or None
+
+    def git_hint(self, urls):
+        """
+        Tell the server which git repositories we might use, so it can
+        refresh those it hasn't lately. Returns a dict of URL to the id of
+        the refresh job for each one it refreshes.
+        """
+        req = self.session.post(self.uri + 'git/hint', data="\n".join(urls))
+
+        if req.status_code != requests.codes.ok:
+            raise ServerError("Could not send git hints")
+
+        return dict((str(x), int(y)) for x, y in (line.split() for line in
+            req.text.splitlines()))
+
+def repack_forever(threshold, interval):
+    """
+    Every `interval` seconds, move loose objects smaller than `threshold`
+    bytes into packs.
+    """
+    while True:
+        time.sleep(interval)
+
+        try:
+            object_store().repack(threshold)
+        except (OSError, IOError, PackError), e:
+            print >>sys.stderr, "Repack failed:", e
+
+def chunk_forever(interval):
+    """
+    Every `interval` seconds, split newly stored objects into chunks.
+    """
+    while True:
+        time.sleep(interval)
+
+        try:
+            object_store().chunk_loose()
+        except (OSError, IOError, ObjectStoreError), e:
+            print >>sys.stderr, "Chunking failed:", e
+
+def start_chunker(interval):
+    """
+    Start chunking newly stored objects in a background thread.
+    """
+    thread = threading.Thread(target=chunk_forever, args=(interval,))
+    thread.daemon = True
+    thread.start()
+    return thread
+
+def start_repacker(threshold, interval):
+    """
+    Start repacking small objects in a background thread.
+    """
+    thread = threading.Thread(target=repack_forever, args=(threshold,
+        interval))
+    thread.daemon = True
+    thread.start()
+    return thread
+
+def evict_forever(budget, interval):
+    """
+    Every `interval` seconds, evict loose objects beyond `budget` bytes.
+    """
+    while True:
+        time.sleep(interval)
+
+        try:
+            evict_loose(object_store(), budget)
+        except OSError, e:
+            print >>sys.stderr, "Eviction failed:", e
+
+def start_evicter(budget, interval):
+    """
+    Start evicting objects in a background thread.
+    """
+    thread = threading.Thread(target=evict_forever, args=(budget, interval))
+    thread.daemon = True
+    thread.start()
+    return thread
+
+def serve_async(host, port):
+    """
+    Serve the app from a gevent event loop, so each connection costs a
+    greenlet rather than a worker, and large uploads and downloads can run by
+    the thousand in one process. Request bodies may use chunked encoding.
+    The standard library must already be patched, by importing gauntlet
+    with GAUNTLET_GEVENT set in the environment.
+    """
+    try:
+        from gevent import monkey
+        from gevent.pywsgi import WSGIServer
+    except ImportError:
+        raise ServerError("Async mode needs gevent installed")
+
+    if not monkey.is_module_patched("threading"):
+        raise ServerError("Async mode needs GAUNTLET_GEVENT set before "
+                "gauntlet is imported")
+
+    WSGIServer((host, port), app).serve_forever()
+
+def main():
+    """
+    Main function for the gauntlet-server command.
+    """
+    parser = ArgumentParser(description="Run a gauntlet object server")
+    parser.add_argument('objects_dir')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--chunked', action='store_true')
+    parser.add_argument('--chunk-interval', type=int, default=60,
+            help="seconds between chunking newly stored objects")
+    parser.add_argument('--compress', action='store_true',
+            help="store objects gzipped where that saves space")
+    parser.add_argument('--async', action='store_true', dest='use_async')
+    parser.add_argument('--pack-threshold', type=int, default=0,
+            help="pack objects smaller than this many bytes")
+    parser.add_argument('--repack-interval', type=int, default=600)
+    parser.add_argument('--upstream', default=None,
+            help="pull objects we don't have through from this server")
+    parser.add_argument('--budget', type=int, default=None,
+            help="bytes of loose objects to keep when proxying")
+    parser.add_argument('--allow-delete', action='store_true',
+            help="let clients delete objects, for cluster rebalancing")
+    parser.add_argument('--git-workers', type=int, default=4,
+            help="git mirrors to clone or refresh at once")
+    parser.add_argument('--git-interval', type=int, default=5 * 60,
+            help="least seconds between hinted refreshes of a mirror")
+    parser.add_argument('--offload', choices=["x-accel", "x-sendfile"],
+            default=None, help="have a fronting web server send loose "
+            "objects")
+    parser.add_argument('--offload-prefix', default="/objects/",
+            help="nginx internal location serving the objects directory")
+    args = parser.parse_args()
+
+    if args.use_async and not os.environ.get("GAUNTLET_GEVENT"):
+        try:
+            import gevent
+        except ImportError:
+            print >>sys.stderr, "Async mode needs gevent installed"
+            return 1
+
+        # Patching now would be too late for everything already imported,
+        # so start over with gevent patching from the top of the package.
+        os.environ["GAUNTLET_GEVENT"] = "1"
+        os.execv(sys.executable, [sys.executable] + sys.argv)
+
+    app.config["GAUNTLET_ALLOW_DELETE"] = args.allow_delete
+    app.config["GAUNTLET_GIT_WORKERS"] = args.git_workers
+    app.config["GAUNTLET_GIT_INTERVAL"] = args.git_interval
+    app.config["GAUNTLET_OFFLOAD"] = args.offload
+    app.config["GAUNTLET_OFFLOAD_PREFIX"] = args.offload_prefix
+
+    app.config["GAUNTLET_OBJECTS_DIR"] = args.objects_dir
+    app.config["GAUNTLET_CHUNKED"] = args.chunked
+    app.config["GAUNTLET_COMPRESS"] = args.compress
+    app.config["GAUNTLET_UPSTREAM"] = args.upstream
+
+    if args.upstream is not None and args.budget is not None:
+        start_evicter(args.budget, 60)
+
+    if args.chunked:
+        start_chunker(args.chunk_interval)
+
+    if args.pack_threshold > 0:
+        start_repacker(args.pack_threshold, args.repack_interval)
+
+    if not args.use_async:
+        app.run(args.host, args.port, threaded=True)
+        return 0
+
+    try:
+        serve_async(args.host, args.port)
+    except ServerError, e:
+        print >>sys.stderr, e
+        return 1
+
+    return 0
+
 if __name__ == "__main__":
     app.config["GAUNTLET_OBJECTS_DIR"] = "/tmp/test"
     try:
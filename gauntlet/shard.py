@@ -15,12 +15,21 @@
 # You should have received a copy of the GNU General Public License along with
 # Gauntlet.  If not, see <http://www.gnu.org/licenses/>.
 
+import binascii
+import bisect
+import collections
+import gzip
 import hashlib
+import multiprocessing
+import stat
 import struct
 import sys
 import tarfile
 import os
 import shutil
+import zlib
+from cStringIO import StringIO
+from multiprocessing.pool import ThreadPool
 
 class InvalidShardError(Exception):
     """
@@ -28,17 +37,308 @@ class InvalidShardError(Exception):
     """
     pass
 
+class ShardMember(object):
+    """
+    An entry in the member index of a shard. `offset` is the position within
+    the shard payload of the compressed block the member's tar header starts
+    in, and `start` is where the header starts once that block is
+    decompressed. `size` is the uncompressed size of its content, `mode` is a
+    full st_mode style value (file type and permission bits) and `sha` is the
+    SHA-1 of its content, or of the link target for links.
+    """
+
+    def __init__(self, path, offset, size, mode, sha, start=0):
+        self.path = path
+        self.offset = offset
+        self.size = size
+        self.mode = mode
+        self.sha = sha
+        self.start = start
+
+    def isreg(self):
+        return stat.S_ISREG(self.mode)
+
+    def isdir(self):
+        return stat.S_ISDIR(self.mode)
+
+    def __repr__(self):
+        return "<ShardMember {} {:o} {}>".format(self.path, self.mode,
+                self.size)
+
+def _member_mode(info):
+    """
+    Get a full st_mode style value for a tar member.
+    """
+    if info.isdir():
+        kind = stat.S_IFDIR
+    elif info.issym():
+        kind = stat.S_IFLNK
+    elif info.ischr():
+        kind = stat.S_IFCHR
+    elif info.isblk():
+        kind = stat.S_IFBLK
+    elif info.isfifo():
+        kind = stat.S_IFIFO
+    else:
+        kind = stat.S_IFREG
+
+    return kind | stat.S_IMODE(info.mode)
+
+def _compress_block(data):
+    """
+    Compress one payload block into a standalone gzip member. The timestamp is
+    fixed so the same content always yields the same shard SHA.
+    """
+    buf = StringIO()
+    gz = gzip.GzipFile(fileobj=buf, mode='wb', mtime=0)
+    gz.write(data)
+    gz.close()
+    return buf.getvalue()
+
+def _decompress_block(data):
+    """
+    Decompress one standalone gzip member produced by `_compress_block`.
+    """
+    return zlib.decompress(data, 16 + zlib.MAX_WBITS)
+
+# With the default number of workers, this many items are handled in process
+# before a pool is started, so small payloads never pay for one.
+PARALLEL_MIN = 4
+
+def _ordered_map(func, items, workers, threads=False):
+    """
+    Map `func` over `items` on a pool of `workers` processes, yielding the
+    results in order. Only a couple of items per worker are in flight at once,
+    so arbitrarily large payloads can be streamed through. A `workers` of None
+    means the first `PARALLEL_MIN` items are handled in process, and only if
+    there are more is a pool of one worker per CPU started for the rest. With
+    `threads` set a thread pool is used instead, even for a single worker, so
+    the work overlaps with whatever consumes it.
+    """
+    if workers is None:
+        items = iter(items)
+
+        for i, item in enumerate(items):
+            yield func(item)
+
+            if i + 1 >= PARALLEL_MIN:
+                break
+        else:
+            return
+
+        workers = multiprocessing.cpu_count()
+
+    if threads:
+        pool = ThreadPool(max(workers, 1))
+    elif workers <= 1:
+        for item in items:
+            yield func(item)
+        return
+    else:
+        pool = multiprocessing.Pool(workers)
+
+    try:
+        pending = collections.deque()
+
+        for item in items:
+            pending.append(pool.apply_async(func, (item,)))
+
+            if len(pending) >= workers * 2:
+                yield pending.popleft().get()
+
+        while pending:
+            yield pending.popleft().get()
+    finally:
+        pool.terminate()
+        pool.join()
+
+class _ChainReader(object):
+    """
+    Read-only file-like object over an iterator of strings.
+    """
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.buf = ''
+        self.pos = 0
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buf) - self.pos < size:
+            try:
+                chunk = next(self.chunks)
+            except StopIteration:
+                break
+
+            self.buf = self.buf[self.pos:] + chunk
+            self.pos = 0
+
+        if size < 0:
+            size = len(self.buf) - self.pos
+
+        ret = self.buf[self.pos:self.pos + size]
+        self.pos += len(ret)
+        return ret
+
+class _ClippedFile(object):
+    """
+    Read at most `size` bytes from a file, padding with NULs if it turns out
+    to be shorter, so a tar member stays well formed if the file changes
+    under us.
+    """
+
+    def __init__(self, f, size):
+        self.f = f
+        self.remaining = size
+
+    def read(self, size):
+        size = min(size, self.remaining)
+        buf = self.f.read(size)
+        buf += tarfile.NUL * (size - len(buf))
+        self.remaining -= len(buf)
+        return buf
+
+def _file_items(entries):
+    """
+    Turn (path, arcname) pairs into (TarInfo, file) pairs for files on disk.
+    The file is None for anything but regular files.
+    """
+    tar = tarfile.TarFile(fileobj=StringIO(), mode='w')
+
+    for path, arcname in entries:
+        info = tar.gettarinfo(path, arcname)
+
+        if not info.isreg():
+            yield info, None
+            continue
+
+        with open(path, 'rb') as f:
+            yield info, _ClippedFile(f, info.size)
+
+class _Blocker(object):
+    """
+    File-like sink that cuts everything written to it into raw blocks that
+    compress to roughly `size` bytes each. The first `SAMPLE` bytes of every
+    `STEP` are deflated and flushed, and the flushed output, scaled up,
+    estimates the compressed size of the whole step. Where blocks are cut
+    depends only on the content. No block grows past `limit` bytes
+    uncompressed.
+    """
+
+    STEP = 1 << 16
+    SAMPLE = 1 << 12
+
+    def __init__(self, size, limit):
+        self.size = size
+        self.limit = limit
+        self.buf = []
+        self.buflen = 0
+        self.ready = []
+        self.count = 0
+        self.estimator = zlib.compressobj(9)
+        self.estimate = 0
+        self.sampled = 0
+
+    def write(self, data):
+        while len(data) > 0:
+            pos = self.buflen % self.STEP
+            take = data[:min(self.STEP - pos, self.limit - self.buflen)]
+            data = data[len(take):]
+            self.buf.append(take)
+            self.buflen += len(take)
+
+            if pos < self.SAMPLE:
+                self.sampled += len(self.estimator.compress(
+                    take[:self.SAMPLE - pos]))
+
+            if self.buflen % self.STEP == 0:
+                self._estimate()
+
+            if self.estimate >= self.size or self.buflen == self.limit:
+                self.cut()
+
+    def _estimate(self):
+        """
+        Add the compressed size of the step just finished to the estimate.
+        """
+        self.sampled += len(self.estimator.flush(zlib.Z_SYNC_FLUSH))
+        self.estimate += self.sampled * self.STEP // self.SAMPLE
+        self.sampled = 0
+
+    def tell(self):
+        """
+        Get the index of the block the next write lands in, and its position
+        within that block.
+        """
+        return self.count + len(self.ready), self.buflen
+
+    def cut(self):
+        """
+        End the current block, so the next write starts a fresh one.
+        """
+        if self.buflen > 0:
+            self.ready.append("".join(self.buf))
+            self.buf = []
+            self.buflen = 0
+            self.estimator = zlib.compressobj(9)
+            self.estimate = 0
+            self.sampled = 0
+
+    def drain(self):
+        """
+        Return and forget all completed blocks.
+        """
+        ready = self.ready
+        self.ready = []
+        self.count += len(ready)
+        return ready
+
+class _MemberFile(object):
+    """
+    A member's content as returned by `Shard.open_member`, which closes the
+    shard file it reads from when it is closed.
+    """
+
+    def __init__(self, f, member):
+        self.f = f
+        self.member = member
+
+    def read(self, size=None):
+        return self.member.read(size)
+
+    def close(self):
+        self.member.close()
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
 class Shard(object):
     """
     A Gauntlet Shard is a piece of an image file. It contains dependencies on
     other shards, and when combined with its dependencies it forms a complete
     disk image.
 
-    Fundimentally a gauntlet file is a tar.gz with a header bolted on.
+    Fundimentally a gauntlet file is a tar.gz with a header bolted on. Since
+    version 2 the tar stream is compressed as a series of independent gzip
+    members of about `BLOCK_SIZE` bytes each, and the payload is followed by
+    an index giving the block each member starts in and where in it, so
+    single files can be found without decompressing the whole payload. A
+    fixed size trailer gives the offset of the index, so a shard can be
+    produced in a single pass. The payload is still a valid (multi-member)
+    tar.gz.
     """
 
     HEADER_MAGIC_STR = "gauntsh"
-    HEADER_MAGIC_VER = 1
+    HEADER_MAGIC_VER = 2
+    INDEX_MAGIC_STR = "gauntix"
+
+    # Target compressed size of a block, and the most a block may hold
+    # uncompressed.
+    BLOCK_SIZE = 1 << 20
+    BLOCK_LIMIT = 8 << 20
 
     def __init__(self, gz_stream, name, compose=[], compose_buildonly=[],
             drop_list=[], chmod_list={}):
@@ -58,102 +358,377 @@ class Shard(object):
         self.compose_buildonly = compose_buildonly
         self.drop_list = drop_list
         self.chmod_list = chmod_list
+        self.entries = None
+        self.sha = None
+
+        # Only set for shards loaded from a file with a member index.
+        self.path = None
+        self.members = None
+        self.member_map = None
+        self.blocks = None
+        self.block_offsets = None
+        self.payload_start = None
+
+    @classmethod
+    def from_files(cls, entries, name, *args, **kwargs):
+        """
+        Create a shard whose content is read straight from disk as the shard
+        is written. `entries` is an iterable of (path, arcname) pairs, each
+        naming a file, directory or link on disk and where it goes in the
+        shard. The remaining arguments are as for the constructor.
+        """
+        shard = cls(None, name, *args, **kwargs)
+        shard.entries = entries
+        return shard
 
-    def write_out(self, path):
+    def _compressed_blocks(self):
         """
-        Write out our shard to `path` and return the SHA-1 of the result.
+        Read the compressed blocks of a loaded shard's payload in order.
         """
+        for size in self.blocks:
+            yield self.gz_stream.read(size)
 
+    def _payload_tar(self, workers=1):
+        """
+        Open our payload as a streaming tarfile. If we know where our blocks
+        are, they are decompressed in parallel on `workers` processes.
+        """
+        if self.blocks is None:
+            return tarfile.open(fileobj=self.gz_stream, mode='r|*')
+
+        # The tarfile module only decodes the first member of a multi-member
+        # gzip stream, so we hand it the decompressed blocks instead.
+        blocks = _ordered_map(_decompress_block, self._compressed_blocks(),
+                workers)
+        return tarfile.open(fileobj=_ChainReader(blocks), mode='r|')
+
+    def _items(self, workers=1):
+        """
+        Generate (TarInfo, file) pairs for our content, whether it comes from
+        disk or from a tar payload. The file is None for anything but regular
+        files.
+        """
+        if self.entries is not None:
+            for item in _file_items(self.entries):
+                yield item
+            return
+
+        tar = self._payload_tar(workers)
+
+        for info in tar:
+            if info.isreg():
+                yield info, tar.extractfile(info)
+            else:
+                yield info, None
+
+    def _raw_blocks(self, items, members):
+        """
+        Encode (TarInfo, file) pairs as a tar stream cut into uncompressed
+        blocks. Index entries are appended to `members` as we go, with the
+        offset set to the index of the starting block.
+        """
+        blocker = _Blocker(self.BLOCK_SIZE, self.BLOCK_LIMIT)
+
+        for info, data in items:
+            block, start = blocker.tell()
+            sha = hashlib.sha1()
+            blocker.write(info.tobuf(tarfile.PAX_FORMAT))
+
+            if data is not None:
+                buf = 'a'
+                while len(buf) > 0:
+                    buf = data.read(self.BLOCK_SIZE)
+                    sha.update(buf)
+                    blocker.write(buf)
+
+                    for raw in blocker.drain():
+                        yield raw
+
+                remainder = info.size % tarfile.BLOCKSIZE
+                if remainder:
+                    blocker.write(tarfile.NUL * (tarfile.BLOCKSIZE - remainder))
+            elif info.issym() or info.islnk():
+                sha.update(info.linkname)
+
+            members.append(ShardMember(info.name, block, info.size,
+                _member_mode(info), sha.hexdigest(), start))
+
+            for raw in blocker.drain():
+                yield raw
+
+        blocker.write(tarfile.NUL * (tarfile.BLOCKSIZE * 2))
+        blocker.cut()
+
+        for raw in blocker.drain():
+            yield raw
+
+    def _header(self):
+        """
+        Encode everything that precedes the payload.
+        """
+        buf = [struct.pack(">7sBB{}sHHHH".format(len(self.name)),
+                self.HEADER_MAGIC_STR, self.HEADER_MAGIC_VER,
+                len(self.name), self.name, len(self.compose),
+                len(self.compose_buildonly), len(self.drop_list),
+                len(self.chmod_list))]
+
+        for item in self.compose + self.compose_buildonly:
+            buf.append(binascii.unhexlify(item))
+
+        for item in self.drop_list:
+            buf.append(struct.pack(">H{}s".format(len(item)), len(item), item))
+
+        for item, mod in self.chmod_list.iteritems():
+            buf.append(struct.pack(">HH{}s".format(len(item)), len(item), mod,
+                item))
+
+        return "".join(buf)
+
+    def chunks(self, workers=1, threads=True):
+        """
+        Generate the encoded shard, start to end, in a single pass over our
+        content. Blocks are compressed on `workers` threads (or processes, if
+        `threads` is False) while the next ones are read, so reading,
+        compression and whatever consumes the output all overlap. Once the
+        generator is exhausted, `sha` holds the SHA-1 of the result.
+        """
         sha = hashlib.sha1()
+        members = []
+        block_sizes = []
 
-        with open(path, "w") as f:
-            buf = struct.pack(">7sBB{}sHHHH".format(len(self.name)),
-                    self.HEADER_MAGIC_STR, self.HEADER_MAGIC_VER,
-                    len(self.name), self.name, len(self.compose),
-                    len(self.compose_buildonly), len(self.drop_list),
-                    len(self.chmod_list))
-            sha.update(buf)
-            f.write(buf)
-
-            for item in self.compose + self.compose_buildonly:
-                buf = struct.pack(">" + ("Q" * 5),
-                        [ int(item[x:x + 8],16) for x in range(0, 40, 8)])
-                sha.update(buf)
-                f.write(buf)
+        header = self._header()
+        sha.update(header)
+        yield header
 
-            for item in self.drop_list:
-                buf = struct.pack(">H{}s".format(len(item)), len(item), item)
-                sha.update(buf)
-                f.write(buf)
+        raw_blocks = self._raw_blocks(self._items(workers), members)
 
-            for item, mod in self.chmod_list.iteritems():
-                buf = struct.pack(">HH{}s".format(len(item)), len(item), mod,
-                        item)
-                sha.update(buf)
-                f.write(buf)
+        for block in _ordered_map(_compress_block, raw_blocks, workers,
+                threads):
+            block_sizes.append(len(block))
+            sha.update(block)
+            yield block
+
+        block_offsets = [0]
+        for size in block_sizes:
+            block_offsets.append(block_offsets[-1] + size)
 
-            buf = 'a'
-            while len(buf) > 0:
-                buf = self.gz_stream.read(4096)
-                sha.update(buf)
+        for member in members:
+            member.offset = block_offsets[member.offset]
+
+        buf = [struct.pack(">II", len(block_sizes), len(members)),
+                struct.pack(">{}I".format(len(block_sizes)), *block_sizes)]
+
+        for member in members:
+            buf.append(struct.pack(">HQQQI20s{}s".format(len(member.path)),
+                len(member.path), member.offset, member.start, member.size,
+                member.mode, binascii.unhexlify(member.sha), member.path))
+
+        buf.append(struct.pack(">Q7s", len(header) + block_offsets[-1],
+            self.INDEX_MAGIC_STR))
+
+        buf = "".join(buf)
+        sha.update(buf)
+        self.sha = sha.hexdigest()
+        yield buf
+
+    def write_out(self, path, workers=None):
+        """
+        Write out our shard to `path` and return the SHA-1 of the result.
+        Blocks are compressed on `workers` processes. By default small shards
+        are compressed in process, and larger ones on one process per CPU.
+        """
+
+        with open(path, "wb") as f:
+            for buf in self.chunks(workers, threads=False):
                 f.write(buf)
 
-        return sha.hexdigest()
+        return self.sha
+
+    def upload(self, server, workers=1):
+        """
+        Stream our shard straight to a gauntlet Server without writing it
+        anywhere first, and return its SHA-1.
+        """
+        sha = server.post(self.chunks(workers))
+
+        if sha != self.sha:
+            raise InvalidShardError("Server stored shard as " + sha +
+                    " but we wrote " + self.sha)
+
+        return sha
+
+    @classmethod
+    def _read_index(cls, f):
+        """
+        Read a block table and member index. Returns the list of compressed
+        block sizes and the list of ShardMembers.
+        """
+        (block_count, member_count) = struct.unpack(">II", f.read(8))
+        blocks = list(struct.unpack(">{}I".format(block_count),
+            f.read(4 * block_count)))
+
+        members = []
+
+        while member_count:
+            (plen, offset, start, size, mode, sha) = struct.unpack(
+                    ">HQQQI20s", f.read(50))
+
+            members += [ShardMember(f.read(plen), offset, size, mode,
+                binascii.hexlify(sha), start)]
+            member_count -= 1
+
+        return blocks, members
+
+    @classmethod
+    def read_header(cls, f):
+        """
+        Read everything that precedes the payload from a file-like object.
+        Returns (version, name, compose, compose_buildonly, drop_list,
+        chmod_list). Raises InvalidShardError if `f` doesn't hold a shard.
+        """
+        try:
+            (magic, version, namelen) = struct.unpack(">7sBB", f.read(9))
+
+            if magic != cls.HEADER_MAGIC_STR:
+                raise InvalidShardError("Bad shard magic")
+            if version not in (1, cls.HEADER_MAGIC_VER):
+                raise InvalidShardError("Bad shard version")
+
+            (name, compose_count, compose_buildonly_count, drop_count,
+                    chmod_count) = struct.unpack(">{}sHHHH".format(namelen),
+                            f.read(namelen+8))
+
+            compose = []
+
+            compose_total = compose_count + compose_buildonly_count;
+
+            while compose_total:
+                sha = f.read(20)
+
+                if len(sha) != 20:
+                    raise InvalidShardError("Truncated shard header")
+
+                compose += [binascii.hexlify(sha)]
+                compose_total -= 1
+
+            compose_buildonly = compose[compose_count:]
+            compose = compose[:compose_count]
+
+            drop_list = []
+
+            while drop_count:
+                (slen,) = struct.unpack(">H", f.read(2))
+                drop_list += [f.read(slen)]
+                drop_count -= 1
+
+            chmod_list = {}
+
+            while chmod_count:
+                slen, mod = struct.unpack(">HH", f.read(4))
+                chmod_list[f.read(slen)] = mod
+                chmod_count -= 1
+        except struct.error:
+            raise InvalidShardError("Truncated shard header")
+
+        return (version, name, compose, compose_buildonly, drop_list,
+                chmod_list)
 
     @classmethod
     def load(cls, path):
         """
-        Load a shard from a file.
+        Load a shard from a file. Version 1 shards are accepted too, but have
+        no member index.
         """
 
-        f = open(path, 'r')
+        f = open(path, 'rb')
+
+        (version, name, compose, compose_buildonly, drop_list,
+                chmod_list) = cls.read_header(f)
+
+        if version < 2:
+            return cls(f, name, compose, compose_buildonly, drop_list,
+                    chmod_list)
+
+        payload_start = f.tell()
+        f.seek(-15, 2)
+        (index_offset, magic) = struct.unpack(">Q7s", f.read(15))
 
-        (magic, version, namelen) = struct.unpack(">7sBB", f.read(9))
-        (name, compose_count, compose_buildonly_count, drop_count,
-                chmod_count) = struct.unpack(">{}sHHHH".format(namelen),
-                        f.read(namelen+8))
+        if magic != cls.INDEX_MAGIC_STR:
+            raise InvalidShardError("Bad shard index magic")
 
-        if magic != cls.HEADER_MAGIC_STR:
-            raise InvalidShardError("Bad shard magic")
-        if version != cls.HEADER_MAGIC_VER:
-            raise InvalidShardError("Bad shard version")
+        f.seek(index_offset)
+        blocks, members = cls._read_index(f)
+        f.seek(payload_start)
 
-        compose = []
+        shard = cls(f, name, compose, compose_buildonly, drop_list,
+                chmod_list)
+        shard.path = path
+        shard.blocks = blocks
+        shard.members = members
+        shard.member_map = dict((m.path, m) for m in members)
+        shard.payload_start = payload_start
 
-        compose_total = compose_count + compose_buildonly_count;
+        shard.block_offsets = [0]
+        for size in blocks:
+            shard.block_offsets.append(shard.block_offsets[-1] + size)
 
-        while compose_total:
-            sha_words = struct.unpack(">" + ("Q" * 5), f.read(20))
-            sha = "".join([ hex(x)[2:] for x in sha_words ])
-            compose += [sha]
-            compose_total -= 1
+        return shard
 
-        compose_buildonly = compose[compose_count:]
-        compose = compose[:compose_count]
+    def list_members(self):
+        """
+        Get the index entries for everything in this shard, in payload order.
+        """
+        if self.members is None:
+            raise InvalidShardError("Shard has no member index")
+
+        return list(self.members)
+
+    def get_member(self, path):
+        """
+        Get the index entry for the member at `path`. Raises KeyError if there
+        is no such member.
+        """
+        if self.member_map is None:
+            raise InvalidShardError("Shard has no member index")
+
+        return self.member_map[path]
+
+    def open_member(self, path):
+        """
+        Get a file-like object for the content of the regular file at `path`
+        in this shard. Only the blocks holding that file are decompressed.
+        The shard file stays open until the result is closed, so use it in a
+        with statement.
+        """
+        member = self.get_member(path)
 
-        drop_list = []
+        if not member.isreg():
+            raise InvalidShardError("'{}' is not a regular file".format(path))
 
-        while drop_count:
-            (slen,) = struct.unpack(">H", f.read(2))
-            string = struct.unpack(">" + str(slen) + 's', f.read(slen))
-            drop_list += [string]
-            drop_count -= 1
+        f = open(self.path, 'rb')
 
-        chmod_list = {}
+        try:
+            f.seek(self.payload_start + member.offset)
 
-        while chmod_count:
-            slen, mod = struct.unpack(">HH", f.read(4))
-            string = struct.unpack(">" + str(slen) + 's', f.read(slen))
-            chmod_list[string] = mod
-            chmod_count -= 1
+            first = bisect.bisect_left(self.block_offsets, member.offset)
+            blocks = (_decompress_block(f.read(x)) for x in
+                    self.blocks[first:])
 
-        return cls(f, name, compose, compose_buildonly, drop_list, chmod_list)
+            reader = _ChainReader(blocks)
+            reader.read(member.start)
+            tar = tarfile.open(fileobj=reader, mode='r|')
+            return _MemberFile(f, tar.extractfile(tar.next()))
+        except:
+            f.close()
+            raise
 
-    def explode(self, path):
+    def explode(self, path, workers=None):
         """
-        Extract the unique contents of this shard to the given location
+        Extract the unique contents of this shard to the given location. If
+        we have a block index, blocks are decompressed on `workers` processes,
+        or as for `write_out` by default.
         """
-        tarfile.open(fileobj=self.gz_stream, mode='r|*').extractall(path)
+        self._payload_tar(workers).extractall(path)
 
 if __name__ == "__main__":
     stream = open(sys.argv[2], 'r')
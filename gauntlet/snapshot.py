@@ -0,0 +1,262 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014 Casey Dahlin
+#
+# This file is part of Gauntlet.
+#
+# Gauntlet is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# Gauntlet is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# Gauntlet.  If not, see <http://www.gnu.org/licenses/>.
+
+import errno
+import hashlib
+import os
+import stat
+import time
+from multiprocessing.pool import ThreadPool
+from shard import Shard
+
+__all__ = ["Snapshot", "SnapshotDiff"]
+
+class _Entry(object):
+    """
+    The metadata we keep for one path in a snapshot.
+    """
+    __slots__ = ["ino", "size", "mode", "mtime", "ctime", "rdev", "link"]
+
+    def __init__(self, st, link):
+        self.ino = st.st_ino
+        self.size = st.st_size
+        self.mode = st.st_mode
+        self.mtime = st.st_mtime
+        self.ctime = st.st_ctime
+        self.rdev = st.st_rdev
+        self.link = link
+
+def _scan_dir(root, dev, rel):
+    """
+    Stat everything in one directory of the tree at `root`. Returns a list of
+    (path, entry) pairs and a list of subdirectories to scan next. We don't
+    descend into other filesystems mounted in the tree.
+    """
+    found = []
+    subdirs = []
+
+    try:
+        names = os.listdir(os.path.join(root, rel))
+    except OSError, e:
+        if e.errno not in [errno.ENOENT, errno.ENOTDIR]:
+            raise
+        return found, subdirs
+
+    for name in names:
+        path = os.path.join(rel, name)
+        full = os.path.join(root, path)
+
+        try:
+            st = os.lstat(full)
+            link = os.readlink(full) if stat.S_ISLNK(st.st_mode) else None
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            continue
+
+        found.append((path, _Entry(st, link)))
+
+        if stat.S_ISDIR(st.st_mode) and st.st_dev == dev:
+            subdirs.append(path)
+
+    return found, subdirs
+
+def _scan(root, pool):
+    """
+    Stat the whole tree at `root`, one directory per task on `pool`. Returns
+    a dict of relative paths to entries.
+    """
+    dev = os.lstat(root).st_dev
+    found = {}
+    level = ['']
+
+    while len(level):
+        results = pool.map(lambda x: _scan_dir(root, dev, x), level)
+        level = []
+
+        for entries, subdirs in results:
+            found.update(entries)
+            level += subdirs
+
+    return found
+
+def _hash_file(path):
+    """
+    SHA-1 of a file's content, or None if it has gone away.
+    """
+    sha = hashlib.sha1()
+
+    try:
+        with open(path, 'rb') as f:
+            buf = 'a'
+            while len(buf) > 0:
+                buf = f.read(1 << 20)
+                sha.update(buf)
+    except IOError, e:
+        if e.errno != errno.ENOENT:
+            raise
+        return None
+
+    return sha.hexdigest()
+
+class SnapshotDiff(object):
+    """
+    The changes to a tree since a snapshot was taken. `added` and `changed`
+    are lists of relative paths whose content belongs in a new shard,
+    `dropped` lists removed paths (only the top-most of a removed subtree)
+    and `chmods` maps paths whose content is unchanged to their new
+    permission bits.
+    """
+
+    def __init__(self, root, added, changed, dropped, chmods):
+        self.root = root
+        self.added = added
+        self.changed = changed
+        self.dropped = dropped
+        self.chmods = chmods
+
+    def paths(self):
+        """
+        All paths whose content goes in the shard, parents before children.
+        """
+        return sorted(self.added + self.changed)
+
+    def shard(self, name, compose=[], compose_buildonly=[]):
+        """
+        Get a Shard holding these changes. File content is read from the tree
+        as the shard is written out.
+        """
+        entries = [(os.path.join(self.root, x), x) for x in self.paths()]
+        drop_list = ["/" + x for x in self.dropped]
+        chmod_list = dict(("/" + x, y) for x, y in self.chmods.iteritems())
+
+        return Shard.from_files(entries, name, compose, compose_buildonly,
+                drop_list, chmod_list)
+
+class Snapshot(object):
+    """
+    A record of the metadata of everything in a directory tree, which can be
+    compared with the tree later to find what changed.
+
+    Regular files whose size differs are changed. Files whose inode, mtime and
+    ctime all match are not. Anything in between is ambiguous, and only those
+    files are hashed and compared with their content hash from before. Those
+    hashes come from the `known` map given when the snapshot is taken, which
+    is usually filled from shard member indexes. Files modified too recently
+    to trust their timestamps are hashed when the snapshot is taken.
+    """
+
+    RACY_WINDOW = 2.0
+
+    def __init__(self, root, entries, hashes, racy):
+        self.root = root
+        self.entries = entries
+        self.hashes = hashes
+        self.racy = racy
+
+    @classmethod
+    def take(cls, root, known={}, jobs=16):
+        """
+        Snapshot the tree at `root`. `known` maps relative paths to the SHA-1
+        of their content, where we already know it. Directories are scanned
+        on `jobs` threads.
+        """
+        pool = ThreadPool(jobs)
+
+        try:
+            taken = time.time()
+            entries = _scan(root, pool)
+
+            racy = set(path for path, entry in entries.iteritems() if
+                    stat.S_ISREG(entry.mode) and
+                    max(entry.mtime, entry.ctime) >= taken - cls.RACY_WINDOW)
+
+            hashes = dict((x, known[x]) for x in known if x in entries and
+                    stat.S_ISREG(entries[x].mode))
+
+            unknown = [x for x in racy if x not in hashes]
+            digests = pool.map(lambda x: _hash_file(os.path.join(root, x)),
+                    unknown)
+            hashes.update(zip(unknown, digests))
+        finally:
+            pool.close()
+            pool.join()
+
+        return cls(root, entries, hashes, racy)
+
+    def diff(self, jobs=16):
+        """
+        Rescan the tree and return a SnapshotDiff of what changed.
+        """
+        pool = ThreadPool(jobs)
+
+        try:
+            after = _scan(self.root, pool)
+
+            added = []
+            changed = []
+            ambiguous = []
+            chmods = {}
+
+            for path, new in after.iteritems():
+                old = self.entries.get(path)
+
+                if old is None:
+                    added.append(path)
+                    continue
+
+                if stat.S_IFMT(old.mode) != stat.S_IFMT(new.mode):
+                    changed.append(path)
+                    continue
+
+                if stat.S_ISREG(new.mode):
+                    if new.size != old.size:
+                        changed.append(path)
+                    elif ((new.ino, new.mtime, new.ctime) !=
+                            (old.ino, old.mtime, old.ctime) or
+                            path in self.racy):
+                        ambiguous.append(path)
+                    continue
+
+                if stat.S_ISLNK(new.mode):
+                    if new.link != old.link:
+                        changed.append(path)
+                    continue
+
+                if new.rdev != old.rdev:
+                    changed.append(path)
+                elif stat.S_IMODE(new.mode) != stat.S_IMODE(old.mode):
+                    chmods[path] = stat.S_IMODE(new.mode)
+
+            digests = pool.map(lambda x: _hash_file(os.path.join(self.root,
+                x)), ambiguous)
+        finally:
+            pool.close()
+            pool.join()
+
+        for path, digest in zip(ambiguous, digests):
+            if digest != self.hashes.get(path):
+                changed.append(path)
+            elif stat.S_IMODE(after[path].mode) != \
+                    stat.S_IMODE(self.entries[path].mode):
+                chmods[path] = stat.S_IMODE(after[path].mode)
+
+        gone = set(x for x in self.entries if x not in after)
+        dropped = [x for x in gone if os.path.dirname(x) not in gone]
+
+        return SnapshotDiff(self.root, added, changed, sorted(dropped),
+                chmods)
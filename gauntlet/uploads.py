@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014 Casey Dahlin
+#
+# This file is part of Gauntlet.
+#
+# Gauntlet is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# Gauntlet is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# Gauntlet.  If not, see <http://www.gnu.org/licenses/>.
+
+import errno
+import hashlib
+import os
+import re
+import shutil
+import time
+import uuid
+
+__all__ = ["UploadSessions", "UploadError"]
+
+session_re = re.compile(r'^[0-9a-f]{32}$')
+
+class UploadError(Exception):
+    """
+    An exception indicating an upload session doesn't exist or can't be
+    committed.
+    """
+    pass
+
+class UploadSessions(object):
+    """
+    Uploads in progress on a gauntlet server. Each session is a directory
+    under `root` holding the numbered parts received so far. Parts can arrive
+    in any order and be sent again, so a client can resume after a failure by
+    asking which parts we have. Committing concatenates the parts into an
+    object in an ObjectStore. Sessions untouched for longer than `max_age`
+    seconds are abandoned, and removed the next time one is created.
+    """
+
+    def __init__(self, root, max_age=24 * 60 * 60):
+        self.root = root
+        self.max_age = max_age
+
+        try:
+            os.makedirs(root)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    def path(self, session):
+        """
+        The directory holding a session's parts. Raises UploadError if there
+        is no such session.
+        """
+        if not session_re.match(session):
+            raise UploadError("Bad upload session " + session)
+
+        path = os.path.join(self.root, session)
+
+        if not os.path.isdir(path):
+            raise UploadError("No upload session " + session)
+
+        return path
+
+    def create(self):
+        """
+        Start a new upload session and return its id.
+        """
+        self.collect()
+
+        session = uuid.uuid4().hex
+        os.mkdir(os.path.join(self.root, session))
+        return session
+
+    def parts(self, session):
+        """
+        Get a sorted list of (part number, size) for the parts we have.
+        """
+        path = self.path(session)
+
+        return sorted((int(x), os.path.getsize(os.path.join(path, x))) for x
+                in os.listdir(path) if x.isdigit())
+
+    def add_part(self, session, number, stream):
+        """
+        Store part `number` of a session from a file-like object, replacing
+        any earlier copy. Returns the SHA-1 of the part.
+        """
+        path = self.path(session)
+        tmp = os.path.join(path, "tmp-" + uuid.uuid4().hex)
+        sha = hashlib.sha1()
+
+        try:
+            with open(tmp, 'wb') as output:
+                buf = 'a'
+                while len(buf) > 0:
+                    buf = stream.read(1 << 16)
+                    sha.update(buf)
+                    output.write(buf)
+        except:
+            os.unlink(tmp)
+            raise
+
+        os.rename(tmp, os.path.join(path, "{:08d}".format(number)))
+        os.utime(path, None)
+        return sha.hexdigest()
+
+    def commit(self, session, store, sha=None):
+        """
+        Join a session's parts into an object in `store` and end the session.
+        If `sha` is given the object must have that SHA-1. Returns the SHA-1.
+        """
+        path = self.path(session)
+        numbers = [x for x, size in self.parts(session)]
+
+        if numbers != range(len(numbers)):
+            raise UploadError("Upload session " + session + " is missing parts")
+
+        tmp = store.tmp_path()
+        digest = hashlib.sha1()
+
+        with open(tmp, 'wb') as output:
+            for number in numbers:
+                with open(os.path.join(path, "{:08d}".format(number)),
+                        'rb') as part:
+                    buf = 'a'
+                    while len(buf) > 0:
+                        buf = part.read(1 << 20)
+                        digest.update(buf)
+                        output.write(buf)
+
+        digest = digest.hexdigest()
+
+        if sha is not None and sha != digest:
+            os.unlink(tmp)
+            raise UploadError("Upload session " + session + " does not "
+                    "make up " + sha)
+
+        store.add_file(tmp, digest)
+        shutil.rmtree(path)
+        return digest
+
+    def abort(self, session):
+        """
+        Throw away a session and its parts.
+        """
+        shutil.rmtree(self.path(session))
+
+    def sessions(self):
+        """
+        Generate (session, bytes received so far) for every upload in
+        progress, counting parts still being received.
+        """
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            size = 0
+
+            try:
+                for part in os.listdir(path):
+                    size += os.path.getsize(os.path.join(path, part))
+            except OSError, e:
+                if e.errno not in [errno.ENOENT, errno.ENOTDIR]:
+                    raise
+                continue
+
+            yield name, size
+
+    def collect(self):
+        """
+        Remove sessions nobody has touched for `max_age` seconds.
+        """
+        cutoff = time.time() - self.max_age
+
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    shutil.rmtree(path)
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    raise
@@ -36,7 +36,10 @@ setup(
     ],
     entry_points={
         "console_scripts": [
-            "git-gauntlet = gauntlet.gitcmd:main"
+            "git-gauntlet = gauntlet.gitcmd:main",
+            "gauntlet-server = gauntlet.server:main",
+            "gauntlet-gc = gauntlet.collector:main",
+            "gauntlet-rebalance = gauntlet.cluster:main",
         ]
     },
     install_requires=[
@@ -45,5 +48,8 @@ setup(
         "flask",
         "ansi",
         "progressbar2",
-    ]
+    ],
+    extras_require={
+        "async": ["gevent"],
+    }
 )
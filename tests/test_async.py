@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014 Casey Dahlin
+#
+# This file is part of Gauntlet.
+#
+# Gauntlet is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# Gauntlet is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# Gauntlet.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import subprocess
+import sys
+import unittest
+
+try:
+    import gevent
+except ImportError:
+    gevent = None
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CHECK = """
+from gevent import monkey
+import gevent.thread
+import gauntlet.server as server
+assert monkey.is_module_patched("threading")
+assert isinstance(server.pulls_lock, type(gevent.thread.allocate_lock()))
+assert isinstance(server.metrics.lock, type(gevent.thread.allocate_lock()))
+"""
+
+@unittest.skipIf(gevent is None, "gevent is not installed")
+class AsyncTest(unittest.TestCase):
+    """
+    gevent must patch the standard library before gauntlet creates any locks.
+    """
+
+    def test_patched_before_import(self):
+        env = dict(os.environ, GAUNTLET_GEVENT="1")
+        self.assertEqual(subprocess.call([sys.executable, "-c", CHECK],
+            cwd=ROOT, env=env), 0)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014 Casey Dahlin
+#
+# This file is part of Gauntlet.
+#
+# Gauntlet is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# Gauntlet is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# Gauntlet.  If not, see <http://www.gnu.org/licenses/>.
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from StringIO import StringIO
+from gauntlet.cache import ObjectCache
+
+DATA = "hello\n"
+SHA = hashlib.sha1(DATA).hexdigest()
+
+class ObjectCacheTest(unittest.TestCase):
+    """
+    Placing cached objects and keeping track of their use.
+    """
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.cache = ObjectCache(os.path.join(self.root, "cache"))
+        self.cache.add(SHA, StringIO(DATA))
+
+    def tearDown(self):
+        self.cache.touched = {}
+        shutil.rmtree(self.root)
+
+    def _atime(self):
+        with open(self.cache.state_path) as f:
+            return json.load(f)[SHA]['atime']
+
+    def test_materialize_copies(self):
+        dest = os.path.join(self.root, "out")
+        self.assertTrue(self.cache.materialize(SHA, dest))
+
+        with open(dest) as f:
+            self.assertEqual(f.read(), DATA)
+
+        placed = os.stat(dest)
+        self.assertNotEqual(placed.st_ino, os.stat(self.cache.path(SHA)).st_ino)
+        self.assertEqual(placed.st_mode & 0777, 0644)
+
+        with open(dest, "a") as f:
+            f.write("more\n")
+
+        self.assertEqual(self.cache.open(SHA).read(), DATA)
+
+    def test_touches_batched(self):
+        with self.cache._locked() as state:
+            state[SHA]['atime'] = 0
+
+        self.cache.open(SHA).close()
+        self.assertEqual(self._atime(), 0)
+
+        self.cache.flush()
+        self.assertGreater(self._atime(), 0)
+        self.assertEqual(self.cache.touched, {})
+
+    def test_touches_flushed_when_due(self):
+        self.cache.flushed -= ObjectCache.TOUCH_INTERVAL
+        self.cache.open(SHA).close()
+        self.assertEqual(self.cache.touched, {})
+
+if __name__ == "__main__":
+    unittest.main()
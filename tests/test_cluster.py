@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014 Casey Dahlin
+#
+# This file is part of Gauntlet.
+#
+# Gauntlet is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# Gauntlet is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# Gauntlet.  If not, see <http://www.gnu.org/licenses/>.
+
+import hashlib
+import StringIO
+import unittest
+from gauntlet import cluster
+from gauntlet.cluster import Cluster, HashRing, rebalance
+
+URIS = ["http://127.0.0.1:5021", "http://127.0.0.1:5022",
+        "http://127.0.0.1:5023"]
+
+def _shas(count):
+    return [hashlib.sha1(str(x)).hexdigest() for x in range(count)]
+
+class ClusterTest(unittest.TestCase):
+    """
+    Clusters built from URIs as they are configured, without trailing
+    slashes, with each server's requests answered locally.
+    """
+
+    def setUp(self):
+        self.cluster = Cluster(URIS, replicas=2)
+        self.asked = {}
+
+        for uri, server in self.cluster.servers.items():
+            def have(shas, batch=10000, uri=uri):
+                self.asked.setdefault(uri, []).extend(shas)
+                return dict((x, 1) for x in shas)
+
+            def get_many(shas, uri=uri):
+                for sha in shas:
+                    yield sha, StringIO.StringIO(sha)
+
+            server.have = have
+            server.get_many = get_many
+
+    def test_servers_keyed_like_server_uris(self):
+        for uri, server in self.cluster.servers.items():
+            self.assertEqual(uri, server.uri)
+
+        self.assertEqual(sorted(self.cluster.ring.nodes),
+                sorted(self.cluster.servers))
+
+    def test_have(self):
+        shas = _shas(100)
+        self.assertEqual(sorted(self.cluster.have(shas)), sorted(shas))
+
+        for sha in shas:
+            owners = [x.uri for x in self.cluster.owners(sha)]
+            self.assertEqual(len(owners), 2)
+
+            for uri in owners:
+                self.assertIn(sha, self.asked[uri])
+
+    def test_get_many(self):
+        shas = _shas(100)
+        got = dict((sha, stream.read()) for sha, stream in
+                self.cluster.get_many(shas))
+        self.assertEqual(got, dict((x, x) for x in shas))
+
+    def test_trailing_slash_places_the_same(self):
+        other = Cluster([x + "/" for x in URIS], replicas=2)
+
+        for sha in _shas(100):
+            self.assertEqual([x.uri for x in self.cluster.owners(sha)],
+                    [x.uri for x in other.owners(sha)])
+
+class HashRingTest(unittest.TestCase):
+    def test_owners_distinct(self):
+        ring = HashRing(["a", "b", "c"])
+
+        for sha in _shas(100):
+            owners = ring.owners(sha, 2)
+            self.assertEqual(len(set(owners)), 2)
+
+class _FakeServer(object):
+    """
+    A server holding objects in a dict, counting the have() calls made.
+    """
+
+    objects = {}
+    calls = {}
+
+    def __init__(self, uri):
+        self.uri = uri
+        self.objects.setdefault(uri, {})
+
+    def list(self):
+        return iter(sorted(self.objects[self.uri]))
+
+    def have(self, shas, batch=10000):
+        self.calls[self.uri] = self.calls.get(self.uri, 0) + 1
+        held = self.objects[self.uri]
+        return dict((x, len(held[x])) for x in shas if x in held)
+
+    def get(self, sha):
+        return StringIO.StringIO(self.objects[self.uri][sha])
+
+    def post(self, src):
+        data = src.read()
+        sha = hashlib.sha1(data).hexdigest()
+        self.objects[self.uri][sha] = data
+        return sha
+
+    def delete(self, sha):
+        del self.objects[self.uri][sha]
+
+class RebalanceTest(unittest.TestCase):
+    """
+    Moving objects between rings, against servers answered locally.
+    """
+
+    def setUp(self):
+        self.server = cluster.Server
+        cluster.Server = _FakeServer
+        _FakeServer.objects.clear()
+        _FakeServer.calls.clear()
+
+    def tearDown(self):
+        cluster.Server = self.server
+
+    def test_rebalance_batches_have(self):
+        new = [x + "/" for x in URIS]
+        old = new[:2]
+        _FakeServer.objects.update((x, {}) for x in old)
+
+        for data in (str(x) for x in range(100)):
+            for uri in HashRing(old).owners(hashlib.sha1(data).hexdigest(),
+                    2):
+                _FakeServer(uri).post(StringIO.StringIO(data))
+
+        rebalance(old, new, prune=True, batch=40)
+
+        ring = HashRing(new)
+        for data in (str(x) for x in range(100)):
+            sha = hashlib.sha1(data).hexdigest()
+            self.assertEqual(sorted(x for x in new if sha in
+                _FakeServer.objects[x]), sorted(ring.owners(sha, 2)))
+
+        # Each old server lists 100 objects in pages of 40, and each page
+        # asks each new server at most once.
+        self.assertTrue(all(x <= 6 for x in _FakeServer.calls.values()))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014 Casey Dahlin
+#
+# This file is part of Gauntlet.
+#
+# Gauntlet is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# Gauntlet is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# Gauntlet.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from StringIO import StringIO
+from gauntlet.collector import GarbageCollector
+from gauntlet.headers import HeaderIndex
+from gauntlet.objects import ObjectStore
+
+OLD = time.time() - 30 * 24 * 60 * 60
+
+class CollectorTest(unittest.TestCase):
+    """
+    Objects a client was told we have must survive collection.
+    """
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.store = ObjectStore(self.root)
+        self.collector = GarbageCollector(self.store,
+                HeaderIndex(os.path.join(self.root, "headers.sqlite")))
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def _add_old(self, data):
+        sha = self.store.add(StringIO(data))
+        os.utime(self.store.path(sha), (OLD, OLD))
+        return sha
+
+    def _pack_mtime(self, sha):
+        return os.path.getmtime(self.store.packs.find(sha)[0].path + ".idx")
+
+    def test_dedup_touches(self):
+        sha = self._add_old("hello\n")
+        self.store.add(StringIO("hello\n"))
+        self.assertGreater(os.path.getmtime(self.store.path(sha)), OLD)
+
+    def test_repack_keeps_mtime(self):
+        sha = self._add_old("hello\n")
+        self.store.repack(1 << 20)
+
+        self.assertEqual(int(self._pack_mtime(sha)), int(OLD))
+        self.assertFalse(os.path.exists(self.store.path(sha)))
+
+        self.assertTrue(self.store.touch(sha))
+        self.assertGreater(self._pack_mtime(sha), OLD)
+
+    def test_touch_missing(self):
+        self.assertFalse(self.store.touch("0" * 40))
+
+    def test_collect_old(self):
+        sha = self._add_old("hello\n")
+        self.assertEqual(self.collector.collect(), (1, 0))
+        self.assertFalse(sha in self.store)
+
+    def test_touched_while_marking(self):
+        packed = self._add_old("packed\n")
+        self.store.repack(1 << 20)
+        loose = self._add_old("loose\n")
+
+        objects = list(self.collector.objects())
+        self.assertTrue(all(x[2] < time.time() - self.collector.grace for x in
+            objects))
+
+        self.store.touch(loose)
+        self.store.touch(packed)
+
+        self.assertEqual(self.collector.sweep(set(), objects), 0)
+        self.assertTrue(loose in self.store)
+        self.assertTrue(packed in self.store)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014 Casey Dahlin
+#
+# This file is part of Gauntlet.
+#
+# Gauntlet is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# Gauntlet is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# Gauntlet.  If not, see <http://www.gnu.org/licenses/>.
+
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from gauntlet import server
+from gauntlet.gitindex import GitIndex
+
+class GitIndexTest(unittest.TestCase):
+    """
+    The git commit index, and the server's shared instance of it.
+    """
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_lookup(self):
+        index = GitIndex(os.path.join(self.root, "index.sqlite"))
+        sha = hashlib.sha1("commit").hexdigest()
+        repo_id = index.add_repo("git://example.com/repo", "0")
+        index.add_commits(repo_id, [sha], [sha])
+
+        self.assertEqual(index.lookup(sha), "git://example.com/repo")
+        self.assertEqual(index.lookup(hashlib.sha1("other").hexdigest()),
+                None)
+        self.assertEqual(index.heads(repo_id), [sha])
+
+    def test_server_index_shared(self):
+        server.app.config["GAUNTLET_OBJECTS_DIR"] = self.root
+        found = []
+        threads = [threading.Thread(target=lambda: found.append(
+            (server.git_index(), server.header_index()))) for x in range(8)]
+
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(found), 8)
+        self.assertEqual(len(set(x[0] for x in found)), 1)
+        self.assertEqual(len(set(x[1] for x in found)), 1)
+
+if __name__ == "__main__":
+    unittest.main()
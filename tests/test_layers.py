@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014 Casey Dahlin
+#
+# This file is part of Gauntlet.
+#
+# Gauntlet is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# Gauntlet is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# Gauntlet.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import shutil
+import stat
+import tempfile
+import unittest
+from gauntlet.layers import LayerStore
+from gauntlet.shard import Shard
+
+class LayerStoreTest(unittest.TestCase):
+    """
+    Adding shards to a LayerStore.
+    """
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.store = LayerStore(os.path.join(self.root, "store"))
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def _write(self, entries):
+        path = os.path.join(self.root, "shard")
+        sha = Shard.from_files(entries, "test").write_out(path, workers=1)
+        return sha, Shard.load(path)
+
+    def test_add_empty_shard(self):
+        sha, shard = self._write([])
+        self.store.add(sha, shard, workers=1)
+        self.assertTrue(sha in self.store)
+        self.assertEqual(os.listdir(self.store.path(sha)), [])
+
+    def test_add_shard(self):
+        src = os.path.join(self.root, "hello")
+
+        with open(src, "w") as f:
+            f.write("hello\n")
+
+        sha, shard = self._write([(src, "hello")])
+        self.store.add(sha, shard, workers=1)
+
+        with open(os.path.join(self.store.path(sha), "hello")) as f:
+            self.assertEqual(f.read(), "hello\n")
+
+    def test_materialize_never_hardlinks(self):
+        src = os.path.join(self.root, "hello")
+
+        with open(src, "w") as f:
+            f.write("hello\n")
+
+        sha, shard = self._write([(src, "hello")])
+        self.store.add(sha, shard, workers=1)
+        dest = os.path.join(self.root, "root")
+        self.store.materialize(sha, dest)
+
+        stored = os.stat(os.path.join(self.store.path(sha), "hello"))
+        placed = os.stat(os.path.join(dest, "hello"))
+        self.assertNotEqual(stored.st_ino, placed.st_ino)
+        self.assertEqual(placed.st_nlink, 1)
+
+    def _layer(self):
+        """
+        Make a layer by hand, for content a shard built from disk by a
+        non-root user couldn't hold.
+        """
+        sha = "0" * 40
+        os.makedirs(self.store.path(sha))
+        return sha, self.store.path(sha)
+
+    def test_materialize_fifo(self):
+        sha, layer = self._layer()
+        os.mkfifo(os.path.join(layer, "fifo"))
+        os.chmod(os.path.join(layer, "fifo"), 0640)
+        dest = os.path.join(self.root, "root")
+        self.store.materialize(sha, dest)
+
+        placed = os.lstat(os.path.join(dest, "fifo"))
+        self.assertTrue(stat.S_ISFIFO(placed.st_mode))
+        self.assertEqual(stat.S_IMODE(placed.st_mode), 0640)
+
+    @unittest.skipUnless(os.geteuid() == 0, "needs root")
+    def test_materialize_device(self):
+        sha, layer = self._layer()
+        os.mknod(os.path.join(layer, "zero"), stat.S_IFCHR | 0666,
+                os.makedev(1, 5))
+        os.chmod(os.path.join(layer, "zero"), 0666)
+        dest = os.path.join(self.root, "root")
+        self.store.materialize(sha, dest)
+
+        placed = os.lstat(os.path.join(dest, "zero"))
+        self.assertTrue(stat.S_ISCHR(placed.st_mode))
+        self.assertEqual(placed.st_rdev, os.makedev(1, 5))
+        self.assertEqual(stat.S_IMODE(placed.st_mode), 0666)
+
+    @unittest.skipUnless(os.geteuid() == 0, "needs root")
+    def test_materialize_keeps_owner(self):
+        sha, layer = self._layer()
+        os.mkdir(os.path.join(layer, "dir"))
+        os.chown(os.path.join(layer, "dir"), 1234, 2345)
+
+        path = os.path.join(layer, "dir", "file")
+        with open(path, "w") as f:
+            f.write("hello\n")
+        os.chown(path, 1235, 2346)
+        os.chmod(path, 04755)
+
+        os.symlink("file", os.path.join(layer, "dir", "link"))
+        os.lchown(os.path.join(layer, "dir", "link"), 1236, 2347)
+
+        dest = os.path.join(self.root, "root")
+        self.store.materialize(sha, dest)
+
+        for name, owner in [("dir", (1234, 2345)), ("dir/file", (1235, 2346)),
+                ("dir/link", (1236, 2347))]:
+            placed = os.lstat(os.path.join(dest, name))
+            self.assertEqual((placed.st_uid, placed.st_gid), owner)
+
+        self.assertEqual(stat.S_IMODE(os.lstat(os.path.join(dest,
+            "dir/file")).st_mode), 04755)
+
+    def test_acquire_over_budget(self):
+        src = os.path.join(self.root, "hello")
+
+        with open(src, "w") as f:
+            f.write("hello\n" * 1000)
+
+        sha, shard = self._write([(src, "hello")])
+        path = os.path.join(self.root, "shard")
+        store = LayerStore(os.path.join(self.root, "small"), budget=1)
+
+        class Server(object):
+            def get(self, want):
+                return open(path, "rb")
+
+        layer = store.acquire(sha, Server(), 1)
+        self.assertTrue(os.path.exists(os.path.join(layer, "hello")))
+
+        store.evict()
+        self.assertTrue(sha in store)
+
+        store.release(sha)
+        self.assertFalse(sha in store)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014 Casey Dahlin
+#
+# This file is part of Gauntlet.
+#
+# Gauntlet is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# Gauntlet is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# Gauntlet.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import shutil
+import tempfile
+import unittest
+from StringIO import StringIO
+from gauntlet.objects import ObjectStore, ObjectStoreBusyError
+
+class ObjectStoreTest(unittest.TestCase):
+    """
+    Removing objects from the store leaves no empty fan-out directories.
+    """
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.store = ObjectStore(self.root)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def _fan_out(self, sha):
+        return os.path.dirname(self.store.path(sha))
+
+    def test_repack_prunes(self):
+        shas = [self.store.add(StringIO(str(x))) for x in range(20)]
+        self.store.repack(1 << 20)
+
+        for sha in shas:
+            self.assertFalse(os.path.exists(self._fan_out(sha)))
+            self.assertEqual(self.store.open(sha).read(), str(shas.index(sha)))
+
+        self.assertEqual(list(self.store.loose()), [])
+
+    def test_delete_prunes(self):
+        sha = self.store.add(StringIO("hello\n"))
+        self.assertTrue(self.store.delete(sha))
+        self.assertFalse(os.path.exists(self._fan_out(sha)))
+
+    def test_delete_keeps_shared_directory(self):
+        # Both SHA-1s start with "0a".
+        first = self.store.add(StringIO("9"))
+        second = self.store.add(StringIO("28"))
+        self.assertEqual(self._fan_out(first), self._fan_out(second))
+
+        self.store.delete(first)
+        self.assertTrue(second in self.store)
+
+    def test_add_after_prune(self):
+        sha = self.store.add(StringIO("hello\n"))
+        self.store.delete(sha)
+        self.assertEqual(self.store.add(StringIO("hello\n")), sha)
+        self.assertTrue(sha in self.store)
+
+    def test_delete_packed_while_repacking(self):
+        sha = self.store.add(StringIO("hello\n"))
+        self.store.repack(1 << 20)
+
+        lock = self.store.packs._lock()
+        try:
+            self.assertRaises(ObjectStoreBusyError, self.store.delete, sha)
+        finally:
+            lock.close()
+
+        self.assertTrue(self.store.delete(sha))
+        self.assertFalse(sha in self.store)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,731 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014 Casey Dahlin
+#
+# This file is part of Gauntlet.
+#
+# Gauntlet is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# Gauntlet is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# Gauntlet.  If not, see <http://www.gnu.org/licenses/>.
+
+import gzip
+import hashlib
+import os
+import shutil
+import struct
+import subprocess
+import tempfile
+import threading
+import time
+import unittest
+import requests
+from StringIO import StringIO
+from gauntlet import headers, objects, server
+from gauntlet.shard import Shard
+from gauntlet.server import app, sha_re, BULK_FRAME, GitResult, Server, \
+        ServerError
+
+class ShaTest(unittest.TestCase):
+    """
+    Only whole lower case hex SHA-1s name objects.
+    """
+
+    def test_sha_re(self):
+        sha = hashlib.sha1("hello").hexdigest()
+
+        self.assertTrue(sha_re.match(sha))
+        self.assertFalse(sha_re.match(sha.upper()))
+        self.assertFalse(sha_re.match(sha + "0"))
+        self.assertFalse(sha_re.match(sha + "/../../etc/passwd"))
+        self.assertFalse(sha_re.match("g" * 40))
+        self.assertFalse(sha_re.match(sha[:39]))
+
+    def test_one_pattern(self):
+        self.assertIs(server.sha_re, objects.sha_re)
+        self.assertIs(headers.sha_re, objects.sha_re)
+
+class ServerTestCase(unittest.TestCase):
+    """
+    A server on an empty objects directory, driven through the Flask test
+    client.
+    """
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.config = dict(app.config)
+        app.config["GAUNTLET_OBJECTS_DIR"] = self.root
+        self.client = app.test_client()
+
+    def tearDown(self):
+        app.config.clear()
+        app.config.update(self.config)
+        shutil.rmtree(self.root)
+
+    def post(self, data):
+        return self.client.post("/", data=data).data
+
+    def metric(self, name, **labels):
+        return server.metrics.values.get((name, tuple(sorted(labels.items()))),
+                0)
+
+class MetricsTest(ServerTestCase):
+    """
+    The Prometheus text endpoint.
+    """
+
+    def samples(self):
+        req = self.client.get("/metrics")
+        self.assertTrue(req.headers["Content-Type"].startswith(
+            "text/plain; version=0.0.4"))
+
+        samples = {}
+
+        for line in req.data.splitlines():
+            if not line.startswith("#"):
+                name, value = line.rsplit(" ", 1)
+                samples[name] = float(value)
+
+        return req.data, samples
+
+    def test_described(self):
+        text, samples = self.samples()
+
+        self.assertIn("# TYPE gauntlet_disk_free_bytes gauge\n", text)
+        self.assertIn("# HELP gauntlet_sent_bytes_total Response body bytes "
+                "sent, by route.\n", text)
+        self.assertGreater(samples["gauntlet_disk_size_bytes"], 0)
+
+    def test_requests_counted(self):
+        missing = hashlib.sha1("missing").hexdigest()
+        key = 'gauntlet_requests_total{method="GET",route="/<sha>",' \
+                'status="404"}'
+        before = self.samples()[1].get(key, 0)
+
+        self.client.get("/" + missing)
+        self.client.get("/" + missing)
+        text, samples = self.samples()
+
+        self.assertEqual(samples[key] - before, 2)
+        self.assertGreater(samples['gauntlet_object_requests_total'
+            '{result="miss"}'], 0)
+
+        count = samples['gauntlet_request_seconds_count{route="/<sha>"}']
+        self.assertEqual(samples['gauntlet_request_seconds_bucket'
+            '{route="/<sha>",le="+Inf"}'], count)
+
+    def test_uploads_sampled(self):
+        session = self.client.post("/uploads").data
+        self.client.put("/uploads/{}/0".format(session), data="x" * 1000)
+        samples = self.samples()[1]
+
+        self.assertEqual(samples["gauntlet_uploads_in_flight"], 1)
+        self.assertEqual(samples["gauntlet_upload_bytes_in_flight"], 1000)
+        self.assertEqual(samples["gauntlet_upload_largest_bytes"], 1000)
+
+class ByteMetricsTest(ServerTestCase):
+    """
+    Bodies are counted as they are read and sent, whatever their framing.
+    """
+
+    def test_chunked_request(self):
+        before = self.metric("gauntlet_received_bytes_total", route="/")
+        data = "hello\n" * 1000
+        req = self.client.post("/", input_stream=StringIO(data),
+                headers={"Transfer-Encoding": "chunked"}, buffered=True)
+
+        self.assertEqual(req.data, hashlib.sha1(data).hexdigest())
+        self.assertEqual(self.metric("gauntlet_received_bytes_total",
+            route="/") - before, len(data))
+
+    def test_streamed_response(self):
+        shas = sorted(self.post(str(x)) for x in range(3))
+        before = self.metric("gauntlet_sent_bytes_total", route="/objects")
+        req = self.client.get("/objects", buffered=True)
+
+        self.assertEqual(req.content_length, None)
+        self.assertEqual(sorted(req.data.split()), shas)
+        self.assertEqual(self.metric("gauntlet_sent_bytes_total",
+            route="/objects") - before, len(req.data))
+
+class FetchParallelTest(unittest.TestCase):
+    """
+    Ranged downloads whose connections misbehave still give the object.
+    """
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.path = os.path.join(self.root, "object")
+        self.data = os.urandom(3 << 20)
+        self.sha = hashlib.sha1(self.data).hexdigest()
+        self.server = Server("http://127.0.0.1:1")
+        self.server.get_size = lambda sha: len(self.data)
+        self.failed = set()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def fetch(self, get):
+        self.server.get = get
+        self.server.fetch(self.sha, self.path, connections=3)
+
+        with open(self.path, 'rb') as f:
+            self.assertEqual(f.read(), self.data)
+
+    def test_failed_range(self):
+        def get(sha, start=0, end=None):
+            if start > 0 and start not in self.failed:
+                self.failed.add(start)
+                raise requests.ConnectionError()
+
+            return StringIO(self.data[start:end + 1])
+
+        self.fetch(get)
+
+    def test_short_range(self):
+        def get(sha, start=0, end=None):
+            if start > 0 and start % (1 << 20) == 0 and \
+                    start not in self.failed:
+                self.failed.add(start)
+                end = start + 1000
+
+            return StringIO(self.data[start:end + 1])
+
+        self.fetch(get)
+
+    def test_bad_ranges_fall_back(self):
+        def get(sha, start=0, end=None):
+            if end is None:
+                return StringIO(self.data[start:])
+
+            return StringIO("\0" * (end - start + 1))
+
+        self.fetch(get)
+
+    def test_git_result(self):
+        self.server.get = lambda sha, start=0, end=None: GitResult("url", sha)
+        self.assertRaises(ServerError, self.server.fetch, self.sha, self.path,
+                connections=3)
+
+class UploadRetryTest(unittest.TestCase):
+    """
+    Parts of a multi-part upload are retried when the connection times out.
+    """
+
+    def test_timeout_retried(self):
+        root = tempfile.mkdtemp()
+        path = os.path.join(root, "object")
+
+        with open(path, 'wb') as f:
+            f.write("hello\n")
+
+        sha = hashlib.sha1("hello\n").hexdigest()
+        server = Server("http://127.0.0.1:1")
+        puts = []
+
+        class Reply(object):
+            status_code = requests.codes.ok
+
+            def __init__(self, text):
+                self.text = text
+
+        def post(uri, data=None):
+            return Reply(sha if uri.endswith("/s") else "s")
+
+        def put(uri, data=None):
+            puts.append(uri)
+
+            if len(puts) == 1:
+                raise requests.Timeout()
+
+            return Reply(hashlib.sha1(data).hexdigest())
+
+        server.session.post = post
+        server.session.put = put
+
+        try:
+            self.assertEqual(server.upload(path), sha)
+        finally:
+            shutil.rmtree(root)
+
+        self.assertEqual(len(puts), 2)
+
+class RangeTest(ServerTestCase):
+    """
+    Single byte ranges of objects, checked against If-Range.
+    """
+
+    def setUp(self):
+        ServerTestCase.setUp(self)
+        self.data = "".join(chr(x % 256) for x in range(1000))
+        self.sha = self.post(self.data)
+
+    def get(self, **headers):
+        return self.client.get("/" + self.sha, headers=headers, buffered=True)
+
+    def test_whole(self):
+        req = self.get()
+
+        self.assertEqual(req.status_code, 200)
+        self.assertEqual(req.data, self.data)
+        self.assertEqual(req.headers["Accept-Ranges"], "bytes")
+        self.assertEqual(req.headers["ETag"], '"{}"'.format(self.sha))
+
+    def test_range(self):
+        req = self.get(Range="bytes=100-199")
+
+        self.assertEqual(req.status_code, 206)
+        self.assertEqual(req.data, self.data[100:200])
+        self.assertEqual(req.headers["Content-Range"], "bytes 100-199/1000")
+
+    def test_open_and_suffix_ranges(self):
+        self.assertEqual(self.get(Range="bytes=900-").data, self.data[900:])
+        self.assertEqual(self.get(Range="bytes=-10").data, self.data[-10:])
+        self.assertEqual(self.get(Range="bytes=990-5000").data,
+                self.data[990:])
+
+    def test_unsatisfiable(self):
+        req = self.get(Range="bytes=1000-")
+
+        self.assertEqual(req.status_code, 416)
+        self.assertEqual(req.headers["Content-Range"], "bytes */1000")
+
+    def test_if_range(self):
+        req = self.get(Range="bytes=0-9", **{"If-Range": '"{}"'.format(
+            self.sha)})
+        self.assertEqual(req.status_code, 206)
+        self.assertEqual(req.data, self.data[:10])
+
+        req = self.get(Range="bytes=0-9", **{"If-Range": '"{}"'.format(
+            "0" * 40)})
+        self.assertEqual(req.status_code, 200)
+        self.assertEqual(req.data, self.data)
+
+    def test_multiple_ranges_get_whole(self):
+        req = self.get(Range="bytes=0-9,20-29")
+
+        self.assertEqual(req.status_code, 200)
+        self.assertEqual(req.data, self.data)
+
+class UploadSessionTest(ServerTestCase):
+    """
+    Multi-part uploads, resumed and checked as they are finished.
+    """
+
+    def setUp(self):
+        ServerTestCase.setUp(self)
+        self.session = self.client.post("/uploads").data
+        self.uri = "/uploads/" + self.session
+
+    def put(self, number, data):
+        return self.client.put("{}/{}".format(self.uri, number), data=data)
+
+    def test_upload(self):
+        self.assertEqual(self.put(1, "world\n").data,
+                hashlib.sha1("world\n").hexdigest())
+        self.put(0, "hello ")
+
+        self.assertEqual(self.client.get(self.uri).data, "0 6\n1 6\n")
+
+        sha = hashlib.sha1("hello world\n").hexdigest()
+        self.assertEqual(self.client.post(self.uri, data=sha).data, sha)
+        self.assertEqual(self.client.get("/" + sha).data, "hello world\n")
+        self.assertEqual(self.client.get(self.uri).status_code, 404)
+
+    def test_wrong_sha(self):
+        self.put(0, "hello\n")
+        req = self.client.post(self.uri, data="0" * 40)
+
+        self.assertEqual(req.status_code, 400)
+        self.assertEqual(self.client.get("/" + "0" * 40).status_code, 404)
+
+    def test_abort(self):
+        self.put(0, "hello\n")
+
+        self.assertEqual(self.client.delete(self.uri).status_code, 200)
+        self.assertEqual(self.client.get(self.uri).status_code, 404)
+        self.assertEqual(self.put(1, "world\n").status_code, 404)
+
+    def test_unknown_session(self):
+        uri = "/uploads/" + "0" * 32
+
+        self.assertEqual(self.client.get(uri).status_code, 404)
+        self.assertEqual(self.client.post(uri).status_code, 404)
+        self.assertEqual(self.client.get("/uploads/../../etc").status_code,
+                404)
+
+class HaveTest(ServerTestCase):
+    """
+    Asking which objects the server already has.
+    """
+
+    def test_have(self):
+        sha = self.post("hello\n")
+        missing = hashlib.sha1("missing").hexdigest()
+        req = self.client.post("/have", data="\n".join([sha, missing,
+            sha.upper(), "../etc/passwd"]))
+
+        self.assertEqual(req.data, "{} 6\n".format(sha))
+
+    def test_have_touches(self):
+        sha = self.post("hello\n")
+        path = server.object_store().path(sha)
+        os.utime(path, (0, 0))
+
+        self.client.post("/have", data=sha)
+        self.assertGreater(os.path.getmtime(path), 0)
+
+class ClosureTest(ServerTestCase):
+    """
+    Everything a shard composes, worked out on the server.
+    """
+
+    def shard(self, name, compose=[], compose_buildonly=[]):
+        path = os.path.join(self.root, name + ".shard")
+        Shard.from_files([], name, compose, compose_buildonly).write_out(path,
+                workers=1)
+
+        with open(path, 'rb') as f:
+            return self.post(f.read())
+
+    def closure(self, roots, query=""):
+        return self.client.post("/closure" + query, data="\n".join(roots))
+
+    def test_order(self):
+        base = self.shard("base")
+        tools = self.shard("tools")
+        lib = self.shard("lib", [base], [tools])
+        app_sha = self.shard("app", [lib, base])
+
+        lines = self.closure([app_sha]).data.splitlines()
+        order = [x.split()[0] for x in lines]
+        self.assertEqual(order, [base, lib, app_sha])
+        self.assertEqual(lines[1].split()[2:], [base])
+
+        order = [x.split()[0] for x in self.closure([app_sha],
+            "?buildonly=1").data.splitlines()]
+        self.assertEqual(sorted(order[:2]), sorted([base, tools]))
+        self.assertEqual(order[2:], [lib, app_sha])
+
+    def test_plain_object(self):
+        sha = self.post("hello\n")
+        self.assertEqual(self.closure([sha]).data, "{} 6\n".format(sha))
+
+    def test_missing(self):
+        missing = hashlib.sha1("missing").hexdigest()
+        lib = self.shard("lib", [missing])
+        req = self.closure([lib])
+
+        self.assertEqual(req.status_code, 404)
+        self.assertEqual(req.data, missing)
+
+class BulkTest(ServerTestCase):
+    """
+    Many objects streamed back in one framed response.
+    """
+
+    def frames(self, data):
+        objects = []
+        frame_size = struct.calcsize(BULK_FRAME)
+
+        while data:
+            sha, size = struct.unpack(BULK_FRAME, data[:frame_size])
+            objects.append((sha, data[frame_size:frame_size + size]))
+            data = data[frame_size + size:]
+
+        return objects
+
+    def test_bulk(self):
+        contents = ["hello\n", "", "x" * 100000]
+        shas = [self.post(x) for x in contents]
+        missing = hashlib.sha1("missing").hexdigest()
+        req = self.client.post("/bulk", data="\n".join([shas[2], missing] +
+            shas[:2]), buffered=True)
+
+        self.assertEqual(self.frames(req.data), [(shas[2], contents[2]),
+            (shas[0], contents[0]), (shas[1], contents[1])])
+
+    def test_empty(self):
+        req = self.client.post("/bulk", data="not-a-sha")
+
+        self.assertEqual(req.status_code, 200)
+        self.assertEqual(req.data, "")
+
+class _FakeUpstream(object):
+    """
+    An upstream server holding objects in a dict. Gets wait for `gate`.
+    """
+
+    def __init__(self, objects):
+        self.objects = objects
+        self.gate = threading.Event()
+        self.gate.set()
+        self.gets = 0
+
+    def get(self, sha):
+        self.gets += 1
+        self.gate.wait()
+
+        if sha not in self.objects:
+            raise ServerError("No " + sha)
+
+        src = StringIO(self.objects[sha])
+        src.headers = {'content-length': str(len(self.objects[sha]))}
+        return src
+
+class ProxyTest(ServerTestCase):
+    """
+    Objects we don't have pulled through from upstream, once each.
+    """
+
+    def setUp(self):
+        ServerTestCase.setUp(self)
+        self.data = "hello\n" * 10000
+        self.sha = hashlib.sha1(self.data).hexdigest()
+        self.upstream = _FakeUpstream({self.sha: self.data})
+        uri = "http://upstream.invalid/"
+        app.config["GAUNTLET_UPSTREAM"] = uri
+        server.upstreams[uri] = self.upstream
+
+    def tearDown(self):
+        server.upstreams.clear()
+        ServerTestCase.tearDown(self)
+
+    def test_pull_through(self):
+        req = self.client.get("/" + self.sha, buffered=True)
+
+        self.assertEqual(req.data, self.data)
+        self.assertTrue(self.sha in server.object_store())
+
+        self.assertEqual(self.client.get("/" + self.sha).data, self.data)
+        self.assertEqual(self.upstream.gets, 1)
+
+    def test_collapse(self):
+        self.upstream.gate.clear()
+        got = []
+
+        def fetch():
+            got.append(app.test_client().get("/" + self.sha,
+                buffered=True).data)
+
+        threads = [threading.Thread(target=fetch) for x in range(3)]
+        for thread in threads:
+            thread.start()
+
+        # Let them all ask before upstream answers.
+        time.sleep(0.2)
+        self.upstream.gate.set()
+
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(got, [self.data] * 3)
+        self.assertEqual(self.upstream.gets, 1)
+
+    def test_upstream_miss(self):
+        missing = hashlib.sha1("missing").hexdigest()
+
+        self.assertEqual(self.client.get("/" + missing).status_code, 404)
+        self.assertFalse(missing in server.object_store())
+
+class _FileWrapper(object):
+    """
+    A WSGI file_wrapper remembering the files it was given.
+    """
+
+    wrapped = []
+
+    def __init__(self, f, block_size=8192):
+        self.f = f
+        self.block_size = block_size
+        self.wrapped.append(f)
+
+    def __iter__(self):
+        return iter(lambda: self.f.read(self.block_size), '')
+
+    def close(self):
+        self.f.close()
+
+class OffloadTest(ServerTestCase):
+    """
+    Loose objects left for the WSGI or fronting web server to send.
+    """
+
+    def setUp(self):
+        ServerTestCase.setUp(self)
+        self.sha = self.post("hello\n")
+
+    def test_x_accel(self):
+        app.config["GAUNTLET_OFFLOAD"] = "x-accel"
+        app.config["GAUNTLET_OFFLOAD_PREFIX"] = "/internal/"
+        req = self.client.get("/" + self.sha, headers={"Range": "bytes=0-1"})
+
+        self.assertEqual(req.status_code, 200)
+        self.assertEqual(req.data, "")
+        self.assertEqual(req.headers["X-Accel-Redirect"],
+                "/internal/{}/{}".format(self.sha[:2], self.sha[2:]))
+        self.assertEqual(req.headers["ETag"], '"{}"'.format(self.sha))
+
+    def test_x_sendfile(self):
+        app.config["GAUNTLET_OFFLOAD"] = "x-sendfile"
+        req = self.client.get("/" + self.sha)
+
+        self.assertEqual(req.data, "")
+        self.assertEqual(req.headers["X-Sendfile"],
+                os.path.abspath(server.object_store().path(self.sha)))
+
+    def test_packed_not_offloaded(self):
+        app.config["GAUNTLET_OFFLOAD"] = "x-accel"
+        server.object_store().repack(1 << 20)
+        req = self.client.get("/" + self.sha)
+
+        self.assertFalse("X-Accel-Redirect" in req.headers)
+        self.assertEqual(req.data, "hello\n")
+
+    def test_file_wrapper(self):
+        del _FileWrapper.wrapped[:]
+        before = self.metric("gauntlet_sent_bytes_total", route="/<sha>")
+        req = self.client.get("/" + self.sha, buffered=True,
+                environ_overrides={"wsgi.file_wrapper": _FileWrapper})
+
+        self.assertEqual(req.data, "hello\n")
+        self.assertEqual(len(_FileWrapper.wrapped), 1)
+        self.assertEqual(self.metric("gauntlet_sent_bytes_total",
+            route="/<sha>") - before, 6)
+
+class CompressedTest(ServerTestCase):
+    """
+    Objects stored gzipped, sent as they are to clients that take gzip.
+    """
+
+    def setUp(self):
+        ServerTestCase.setUp(self)
+        app.config["GAUNTLET_COMPRESS"] = True
+        self.data = "hello world\n" * 10000
+        self.sha = self.post(self.data)
+        self.store = server.object_store()
+
+    def test_stored_compressed(self):
+        self.assertFalse(os.path.exists(self.store.path(self.sha)))
+        self.assertTrue(os.path.exists(self.store.compressed_path(self.sha)))
+
+    def test_gzip(self):
+        req = self.client.get("/" + self.sha, buffered=True,
+                headers={"Accept-Encoding": "gzip"})
+
+        self.assertEqual(req.headers["Content-Encoding"], "gzip")
+        self.assertEqual(req.headers["X-Gauntlet-Size"], str(len(self.data)))
+        self.assertEqual(req.headers["ETag"], '"{}-gzip"'.format(self.sha))
+        self.assertEqual(int(req.headers["Content-Length"]), len(req.data))
+        self.assertLess(len(req.data), len(self.data))
+        self.assertEqual(gzip.GzipFile(fileobj=StringIO(req.data)).read(),
+                self.data)
+
+    def test_identity(self):
+        req = self.client.get("/" + self.sha, buffered=True,
+                headers={"Accept-Encoding": "identity"})
+
+        self.assertFalse("Content-Encoding" in req.headers)
+        self.assertEqual(req.headers["ETag"], '"{}"'.format(self.sha))
+        self.assertEqual(req.data, self.data)
+
+    def test_range_of_uncompressed(self):
+        req = self.client.get("/" + self.sha, buffered=True,
+                headers={"Accept-Encoding": "gzip", "Range": "bytes=12-23"})
+
+        self.assertEqual(req.status_code, 206)
+        self.assertFalse("Content-Encoding" in req.headers)
+        self.assertEqual(req.data, self.data[12:24])
+
+    def test_incompressible_kept_plain(self):
+        data = os.urandom(10000)
+        sha = self.post(data)
+
+        self.assertTrue(os.path.exists(self.store.path(sha)))
+        self.assertEqual(self.client.get("/" + sha, headers={
+            "Accept-Encoding": "gzip"}).data, data)
+
+class MirrorTest(ServerTestCase):
+    """
+    Git repositories cloned and refreshed in the background.
+    """
+
+    def setUp(self):
+        ServerTestCase.setUp(self)
+        app.config["GAUNTLET_GIT_INTERVAL"] = 0
+        self.repo = os.path.join(self.root, "repo")
+        self.git("init", "-q", self.repo)
+
+    def git(self, *args):
+        return subprocess.check_output(["git", "-c", "user.name=Test", "-c",
+            "user.email=test@example.com"] + list(args),
+            cwd=self.root).strip()
+
+    def commit(self, message):
+        self.git("-C", self.repo, "commit", "-q", "--allow-empty", "-m",
+                message)
+        return self.git("-C", self.repo, "rev-parse", "HEAD")
+
+    def wait(self, job_id):
+        for attempt in range(300):
+            state = self.client.get("/git/jobs/" + job_id).data
+
+            if state.split("\n")[0] in ["done", "failed"]:
+                return state
+
+            time.sleep(0.1)
+
+        self.fail("Job {} never finished".format(job_id))
+
+    def test_clone_and_refresh(self):
+        first = self.commit("first")
+        self.assertEqual(self.wait(self.client.post("/git",
+            data=self.repo).data), "done\n")
+
+        req = self.client.get("/" + first)
+        self.assertEqual(req.status_code, 301)
+        self.assertEqual(req.headers["X-Gauntlet-Type"], "git")
+        self.assertTrue(req.headers["Location"].endswith(self.repo))
+
+        second = self.commit("second")
+        self.assertEqual(self.client.get("/" + second).status_code, 404)
+
+        self.assertEqual(self.wait(self.client.post("/git",
+            data=self.repo).data), "done\n")
+        self.assertEqual(self.client.get("/" + second).status_code, 301)
+
+    def test_hint(self):
+        self.commit("first")
+        self.assertEqual(self.client.post("/git/hint", data=self.repo).data,
+                "")
+
+        self.wait(self.client.post("/git", data=self.repo).data)
+        second = self.commit("second")
+        url, job_id = self.client.post("/git/hint",
+                data=self.repo).data.split()
+
+        self.assertEqual(url, self.repo)
+        self.assertEqual(self.wait(job_id), "done\n")
+        self.assertEqual(self.client.get("/" + second).status_code, 301)
+
+    def test_failed(self):
+        missing = os.path.join(self.root, "missing")
+        state = self.wait(self.client.post("/git", data=missing).data)
+
+        self.assertEqual(state.split("\n")[0], "failed")
+        self.assertNotEqual(state.split("\n")[1], "")
+        self.assertEqual(os.listdir(os.path.join(self.root, "git")),
+                ["index.sqlite"])
+
+    def test_bad_requests(self):
+        self.assertEqual(self.client.post("/git", data=" ").status_code, 400)
+        self.assertEqual(self.client.get("/git/jobs/12345").status_code, 404)
+
+if __name__ == "__main__":
+    unittest.main()
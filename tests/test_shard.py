@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014 Casey Dahlin
+#
+# This file is part of Gauntlet.
+#
+# Gauntlet is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# Gauntlet is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# Gauntlet.  If not, see <http://www.gnu.org/licenses/>.
+
+import gzip
+import os
+import random
+import shutil
+import tarfile
+import tempfile
+import unittest
+from gauntlet import shard as shard_module
+from gauntlet.shard import Shard
+
+class ShardTest(unittest.TestCase):
+    """
+    Writing shards and reading them back through the member index.
+    """
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.src = os.path.join(self.root, "src")
+        os.mkdir(self.src)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def _files(self, contents):
+        entries = []
+
+        for name, data in sorted(contents.items()):
+            path = os.path.join(self.src, name)
+
+            with open(path, "wb") as f:
+                f.write(data)
+
+            entries.append((path, name))
+
+        return entries
+
+    def _write(self, entries):
+        path = os.path.join(self.root, "shard")
+        Shard.from_files(entries, "test").write_out(path, workers=1)
+        return path, Shard.load(path)
+
+    def test_small_files_share_blocks(self):
+        contents = dict(("file{}".format(i), "line {}\n".format(i) * 20) for
+                i in range(500))
+        path, shard = self._write(self._files(contents))
+
+        self.assertEqual(len(shard.blocks), 1)
+
+        tgz = os.path.join(self.root, "plain.tar.gz")
+        tar = tarfile.open(tgz, "w:gz")
+        for name in sorted(contents):
+            tar.add(os.path.join(self.src, name), name)
+        tar.close()
+
+        self.assertLess(sum(shard.blocks), os.path.getsize(tgz) * 1.5)
+
+        for name, data in contents.items():
+            with shard.open_member(name) as f:
+                self.assertEqual(f.read(), data)
+
+    def test_members_across_blocks(self):
+        rand = random.Random(0)
+        contents = {}
+
+        for i in range(6):
+            size = rand.randint(1, 3 * Shard.BLOCK_SIZE // 4)
+            contents["file{}".format(i)] = "".join(chr(rand.getrandbits(8))
+                    for x in xrange(size))
+
+        path, shard = self._write(self._files(contents))
+
+        self.assertGreater(len(shard.blocks), 1)
+        self.assertTrue(any(x.start > 0 for x in shard.members))
+
+        for name, data in contents.items():
+            with shard.open_member(name) as f:
+                self.assertEqual(f.read(), data)
+
+        out = os.path.join(self.root, "out")
+        shard.explode(out, workers=1)
+
+        for name, data in contents.items():
+            with open(os.path.join(out, name), "rb") as f:
+                self.assertEqual(f.read(), data)
+
+    def test_payload_is_tar_gz(self):
+        contents = {"a": "a" * 1000, "b": "b" * 1000}
+        path, shard = self._write(self._files(contents))
+
+        with open(path, "rb") as f:
+            f.seek(shard.payload_start)
+            payload = f.read(sum(shard.blocks))
+
+        tgz = os.path.join(self.root, "payload.tar.gz")
+        with open(tgz, "wb") as f:
+            f.write(payload)
+
+        with gzip.open(tgz) as f:
+            tar = tarfile.open(fileobj=f, mode="r|")
+            self.assertEqual(sorted(x.name for x in tar), ["a", "b"])
+
+    def test_open_member_closes_shard(self):
+        path, shard = self._write(self._files({"a": "hello\n"}))
+
+        with shard.open_member("a") as f:
+            self.assertEqual(f.read(), "hello\n")
+
+        self.assertTrue(f.f.closed)
+
+    def test_small_shard_needs_no_pool(self):
+        def no_pool(*args):
+            raise AssertionError("Started a pool for a small shard")
+
+        entries = self._files({"a": "a" * 1000})
+        path = os.path.join(self.root, "shard")
+        mp = shard_module.multiprocessing
+        saved = mp.Pool, mp.cpu_count
+        mp.Pool, mp.cpu_count = no_pool, lambda: 4
+
+        try:
+            Shard.from_files(entries, "test").write_out(path)
+            Shard.load(path).explode(os.path.join(self.root, "out"))
+        finally:
+            mp.Pool, mp.cpu_count = saved
+
+        with open(os.path.join(self.root, "out", "a"), "rb") as f:
+            self.assertEqual(f.read(), "a" * 1000)
+
+if __name__ == "__main__":
+    unittest.main()
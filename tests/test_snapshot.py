@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+# Copyright © 2014 Casey Dahlin
+#
+# This file is part of Gauntlet.
+#
+# Gauntlet is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# Gauntlet is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# Gauntlet.  If not, see <http://www.gnu.org/licenses/>.
+
+import hashlib
+import os
+import shutil
+import tempfile
+import unittest
+from gauntlet.shard import Shard
+from gauntlet.snapshot import Snapshot
+
+class SnapshotTest(unittest.TestCase):
+    """
+    Finding what changed in a tree since a snapshot was taken.
+    """
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.tree = os.path.join(self.root, "tree")
+        os.makedirs(os.path.join(self.tree, "dir", "sub"))
+        self.write("same", "same\n")
+        self.write("edit", "before\n")
+        self.write("dir/sub/file", "gone\n")
+        os.symlink("same", os.path.join(self.tree, "link"))
+        self.snapshot = Snapshot.take(self.tree, jobs=2)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def write(self, path, data):
+        with open(os.path.join(self.tree, path), "wb") as f:
+            f.write(data)
+
+    def test_unchanged(self):
+        diff = self.snapshot.diff(jobs=2)
+
+        self.assertEqual(diff.paths(), [])
+        self.assertEqual(diff.dropped, [])
+        self.assertEqual(diff.chmods, {})
+
+    def test_changes(self):
+        # Same size, so only the recent timestamps give it away.
+        self.write("edit", "after!\n")
+        self.write("new", "new\n")
+        os.unlink(os.path.join(self.tree, "link"))
+        os.symlink("edit", os.path.join(self.tree, "link"))
+        shutil.rmtree(os.path.join(self.tree, "dir"))
+
+        diff = self.snapshot.diff(jobs=2)
+
+        self.assertEqual(sorted(diff.added), ["new"])
+        self.assertEqual(sorted(diff.changed), ["edit", "link"])
+        self.assertEqual(diff.dropped, ["dir"])
+
+    def test_touched_and_chmodded(self):
+        path = os.path.join(self.tree, "same")
+        os.utime(path, (0, 0))
+        os.chmod(path, 0600)
+
+        diff = self.snapshot.diff(jobs=2)
+
+        self.assertEqual(diff.paths(), [])
+        self.assertEqual(diff.chmods, {"same": 0600})
+
+    def test_known_hashes(self):
+        class Steady(Snapshot):
+            RACY_WINDOW = -60
+
+        known = {"same": hashlib.sha1("same\n").hexdigest(), "edit": "0" * 40}
+        snapshot = Steady.take(self.tree, known, jobs=2)
+        self.assertEqual(snapshot.racy, set())
+
+        # Only the timestamps changed, so the known hashes decide.
+        for path in ["same", "edit"]:
+            os.utime(os.path.join(self.tree, path), (0, 0))
+
+        self.assertEqual(snapshot.diff(jobs=2).changed, ["edit"])
+
+    def test_shard(self):
+        self.write("new", "new\n")
+        shutil.rmtree(os.path.join(self.tree, "dir"))
+        os.chmod(os.path.join(self.tree, "same"), 0600)
+
+        path = os.path.join(self.root, "shard")
+        self.snapshot.diff(jobs=2).shard("test").write_out(path, workers=1)
+        shard = Shard.load(path)
+
+        self.assertEqual([x.path for x in shard.members], ["new"])
+        self.assertEqual(shard.drop_list, ["/dir"])
+        self.assertEqual(shard.chmod_list, {"/same": 0600})
+
+        with shard.open_member("new") as f:
+            self.assertEqual(f.read(), "new\n")
+
+if __name__ == "__main__":
+    unittest.main()